@@ -0,0 +1,406 @@
+import hashlib
+import json
+import os
+import time
+from types import SimpleNamespace
+from typing import Dict, List, Sequence
+import numpy
+import llama_cpp
+from llama_cpp.llama import LlamaState
+
+# Special tokens of the chat templates used by the servers in ../dist
+SPECIALS = {
+	"qwen": ["<|endoftext|>", "<|im_start|>", "<|im_end|>", "<tool_call>", "</tool_call>", "<tool_response>", "</tool_response>"],
+	"mistral": ["<s>", "</s>", "[INST]", "[/INST]", "[TOOL_CALLS]", "[AVAILABLE_TOOLS]", "[/AVAILABLE_TOOLS]", "[TOOL_RESULTS]", "[/TOOL_RESULTS]", "[SYSTEM_PROMPT]", "[/SYSTEM_PROMPT]"],
+	"gemma3": ["<bos>", "<eos>", "<start_of_turn>", "<end_of_turn>"],
+}
+
+# The prompt ends after the last of these, the answer starts there
+PROMPT_ENDS = {
+	"qwen": ["<|im_start|>assistant\n"],
+	"mistral": ["[/INST]", "[/TOOL_RESULTS]"],
+	"gemma3": ["<start_of_turn>model\n"],
+}
+
+WORDS = (
+	"the channel discussed release plans and the new moderation rules while several members shared "
+	"links to the roadmap asked about voice quality and agreed to meet again on friday after the "
+	"community call where the team will summarize open questions about onboarding and events"
+).split()
+
+def _family(filename: str) -> str:
+	name = filename.lower()
+	for family in ("qwen", "mistral", "gemma"):
+		if family in name:
+			return "gemma3" if family == "gemma" else family
+	raise ValueError("Unknown model family: " + filename)
+
+# Stand-in for llama_cpp._internals.LlamaBatch, same arrays and set_batch()
+class FakeBatch:
+	def __init__(self, *, n_tokens: int, embd: int, n_seq_max: int, verbose: bool = True):
+		self.n_tokens_capacity = n_tokens
+		self.batch = SimpleNamespace(
+			n_tokens=0,
+			token=[0] * n_tokens,
+			pos=[0] * n_tokens,
+			seq_id=[[0] * n_seq_max for _ in range(n_tokens)],
+			n_seq_id=[0] * n_tokens,
+			logits=[False] * n_tokens,
+		)
+
+	def set_batch(self, batch: Sequence[int], n_past: int, logits_all: bool):
+		n_tokens = len(batch)
+		self.batch.n_tokens = n_tokens
+		for i in range(n_tokens):
+			self.batch.token[i] = batch[i]
+			self.batch.pos[i] = n_past + i
+			self.batch.seq_id[i][0] = 0
+			self.batch.n_seq_id[i] = 1
+			self.batch.logits[i] = logits_all
+		self.batch.logits[n_tokens - 1] = True
+
+# Stand-in for llama_cpp._internals.LlamaContext. It keeps the tokens of
+# every sequence in place of KV cells, and the "logits" of an output row are
+# the fake model's next token for that sequence. A decode() sleeps for the
+# model's prefill latency per prompt row plus one token latency if it has
+# output rows, so a batch of sequences costs one step like on a GPU.
+class FakeContext:
+	def __init__(self, *, model: "FakeLlama", params: llama_cpp.llama_context_params, verbose: bool = True):
+		self.model = model
+		self.params = params
+		# llama_perf_context() takes ctx.ctx
+		self.ctx = self
+		self.sequences: Dict[int, List[int]] = {}
+		# seq_id -> [prompt length, answer tokens, still following the answer]
+		self.answers: Dict[int, list] = {}
+		# batch index -> next token, of the last decode
+		self.outputs: Dict[int, int] = {}
+		self.last_output = -1
+		self.t_p_eval_ms = 0.0
+		self.n_p_eval = 0
+		self.t_eval_ms = 0.0
+		self.n_eval = 0
+
+	def n_ctx(self) -> int:
+		return self.params.n_ctx
+
+	# like llama_memory_seq_rm() through LlamaContext: seq_id -1 is sequence 0,
+	# a negative p0/p1 is an open end
+	def kv_cache_seq_rm(self, seq_id: int, p0: int, p1: int) -> bool:
+		seq_id = seq_id if seq_id >= 0 else 0
+		tokens = self.sequences.get(seq_id)
+		if tokens is None:
+			return True
+		p0 = max(p0, 0)
+		if p1 >= 0 and p1 < len(tokens):
+			# only the tail is ever removed, a hole would shift positions
+			raise ValueError("Fake context only removes up to the end of a sequence")
+		del tokens[p0:]
+		answer = self.answers.get(seq_id)
+		if answer is not None and p0 < answer[0]:
+			del self.answers[seq_id]
+		return True
+
+	# Replaces the tokens of a sequence, for a state loaded from a snapshot
+	def restore(self, seq_id: int, tokens: List[int]):
+		self.sequences[seq_id] = list(tokens)
+		self.answers.pop(seq_id, None)
+
+	def decode(self, batch: FakeBatch) -> int:
+		b = batch.batch
+		n_prompt = 0
+		self.outputs = {}
+		for i in range(b.n_tokens):
+			seq_id = b.seq_id[i][0]
+			tokens = self.sequences.setdefault(seq_id, [])
+			pos = b.pos[i]
+			if pos > len(tokens):
+				raise ValueError(f"Position {pos} after the end of sequence {seq_id} ({len(tokens)} tokens)")
+			if pos >= self.n_ctx():
+				raise ValueError("Context window of " + str(self.n_ctx()) + " exceeded")
+			del tokens[pos:]
+			tokens.append(b.token[i])
+			self._check(seq_id, pos, b.token[i])
+			if b.logits[i]:
+				self.outputs[i] = self._next(seq_id)
+				self.last_output = i
+			else:
+				n_prompt += 1
+		prefill = self.model.prefill_latency * n_prompt
+		token = self.model.token_latency if n_prompt < b.n_tokens else 0.0
+		if prefill + token > 0:
+			time.sleep(prefill + token)
+		# counted like llama.cpp does: a batch of several tokens is prompt eval
+		if b.n_tokens > 1:
+			self.t_p_eval_ms += (prefill + token) * 1000
+			self.n_p_eval += b.n_tokens
+		else:
+			self.t_eval_ms += (prefill + token) * 1000
+			self.n_eval += 1
+		return 0
+
+	def _check(self, seq_id: int, pos: int, token: int):
+		answer = self.answers.get(seq_id)
+		if answer is None:
+			return
+		if pos < answer[0]:
+			del self.answers[seq_id]
+		elif token != self.model.answer_token(answer[1], pos - answer[0]):
+			# a rejected draft or the next turn's prompt
+			answer[2] = False
+
+	def _next(self, seq_id: int) -> int:
+		tokens = self.sequences[seq_id]
+		answer = self.answers.get(seq_id)
+		if answer is None or not answer[2]:
+			start = answer[0] if answer is not None else 0
+			n_prompt = self.model.prompt_length(tokens, start)
+			if answer is None or n_prompt != answer[0]:
+				answer = [n_prompt, self.model.answer(tokens[:n_prompt]), True]
+				self.answers[seq_id] = answer
+			answer[2] = True
+		return self.model.answer_token(answer[1], len(tokens) - answer[0])
+
+	def close(self):
+		self.sequences = {}
+		self.answers = {}
+
+# Stand-in for llama_cpp._internals.LlamaSampler: the chain is accepted and
+# ignored, sample() takes the fake context's token of the row
+class FakeSampler:
+	def add_greedy(self):
+		pass
+
+	def add_top_k(self, k: int):
+		pass
+
+	def add_top_p(self, p: float, min_keep: int):
+		pass
+
+	def add_min_p(self, p: float, min_keep: int):
+		pass
+
+	def add_temp(self, temp: float):
+		pass
+
+	def add_dist(self, seed: int):
+		pass
+
+	def add_penalties(self, n_vocab: int, penalty_last_n: int, penalty_repeat: float, penalty_freq: float, penalty_present: float):
+		pass
+
+	def add_grammar_lazy_patterns(self, model, grammar, trigger_patterns: List[str], trigger_tokens: List[int]):
+		pass
+
+	def sample(self, ctx: FakeContext, idx: int = -1) -> int:
+		return ctx.outputs[ctx.last_output if idx < 0 else idx]
+
+	def close(self):
+		pass
+
+# In place of llama_cpp.llama_perf_context(), the fake context's counters
+def perf_context(ctx: FakeContext) -> llama_cpp.llama_perf_context_data:
+	data = llama_cpp.llama_perf_context_data()
+	data.t_p_eval_ms = ctx.t_p_eval_ms
+	data.n_p_eval = ctx.n_p_eval
+	data.t_eval_ms = ctx.t_eval_ms
+	data.n_eval = ctx.n_eval
+	return data
+
+# Installs the fakes under llama_cpp, so the servers' own decode loops
+# (speculative.Speculation, batching.BatchEngine, ChunkedPrefill) and perf
+# counters run unchanged on top of FakeLlama
+def patch_llama_cpp():
+	llama_cpp.Llama.from_pretrained = FakeLlama.from_pretrained
+	llama_cpp._internals.LlamaContext = FakeContext
+	llama_cpp._internals.LlamaBatch = FakeBatch
+	llama_cpp._internals.LlamaSampler = FakeSampler
+	llama_cpp.llama_perf_context = perf_context
+
+# Deterministic stand-in for llama_cpp.Llama with the surface the servers use.
+# Tokens are bytes (plus the template's special tokens), so prompts are about
+# four times longer in tokens than with a real vocabulary. Prefill and decode
+# only sleep for the configured latency, which leaves the Python side of the
+# server (tokenize, detokenize, sampling loops, framing, tool call parsing)
+# as the only CPU cost.
+#
+# The answer depends only on the prompt: with probability tool_rate (and if the
+# prompt mentions getRecentChannelMessages) it is a tool call in the family's
+# format, otherwise output_tokens of text. Past the answer (stopping criteria
+# ignoring the end token) the model keeps talking.
+class FakeLlama:
+	def __init__(
+		self,
+		family: str,
+		n_ctx: int = 8192,
+		n_batch: int = 512,
+		token_latency: float = 0.0,
+		prefill_latency: float = 0.0,
+		output_tokens: int = 200,
+		tool_rate: float = 0.5,
+		**kwargs,
+	):
+		self.family = family
+		self._n_ctx = n_ctx
+		self.n_batch = n_batch
+		self.token_latency = token_latency
+		self.prefill_latency = prefill_latency
+		self.output_tokens = output_tokens
+		self.tool_rate = tool_rate
+		self.specials = SPECIALS[family]
+		self.special_ids = {s.encode("utf-8"): 256 + i for i, s in enumerate(self.specials)}
+		self.prompt_ends = [self.tokenize(end.encode("utf-8"), add_bos=False, special=True) for end in PROMPT_ENDS[family]]
+		self.input_ids = numpy.zeros(n_ctx, dtype=numpy.intc)
+		self.n_tokens = 0
+		self._requires_eval = False
+		self._seed = 0
+		self.verbose = False
+		self.model_path = "fake-" + family + ".gguf"
+		self.context_params = llama_cpp.llama_context_default_params()
+		self.context_params.n_ctx = n_ctx
+		self.context_params.n_batch = n_batch
+		self._model = self
+		self._ctx = FakeContext(model=self, params=self.context_params)
+		self._batch = FakeBatch(n_tokens=n_batch, embd=0, n_seq_max=1)
+		self.metadata = {
+			"general.architecture": family,
+			family + ".block_count": "32",
+			family + ".embedding_length": "4096",
+			family + ".attention.head_count": "32",
+			family + ".attention.head_count_kv": "8",
+		}
+
+	# FAKE_TOKEN_MS, FAKE_PREFILL_MS (per prompt token), FAKE_OUTPUT_TOKENS,
+	# FAKE_TOOL_RATE; n_batch comes from the server's from_pretrained() call,
+	# n_ctx too but times 4 for the byte tokens (FAKE_N_CTX overrides it)
+	@classmethod
+	def from_pretrained(cls, repo_id: str = "", filename: str = "", **kwargs):
+		return cls(
+			_family(repo_id + "/" + filename),
+			n_ctx=int(os.environ.get("FAKE_N_CTX", str(kwargs.get("n_ctx", 2048) * 4))),
+			n_batch=kwargs.get("n_batch", 512),
+			token_latency=float(os.environ.get("FAKE_TOKEN_MS", "0")) / 1000,
+			prefill_latency=float(os.environ.get("FAKE_PREFILL_MS", "0")) / 1000,
+			output_tokens=int(os.environ.get("FAKE_OUTPUT_TOKENS", "200")),
+			tool_rate=float(os.environ.get("FAKE_TOOL_RATE", "0.5")),
+		)
+
+	def n_ctx(self) -> int:
+		return self._n_ctx
+
+	def n_vocab(self) -> int:
+		return 256 + len(self.specials)
+
+	def token_eos(self) -> int:
+		return self.special_ids[self.specials[1].encode("utf-8")]
+
+	def token_bos(self) -> int:
+		return self.special_ids[self.specials[0].encode("utf-8")]
+
+	def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+		tokens = [self.token_bos()] if add_bos else []
+		i = 0
+		while i < len(text):
+			if special and text[i:i + 1] in (b"<", b"["):
+				for piece, token in self.special_ids.items():
+					if text.startswith(piece, i):
+						tokens.append(token)
+						i += len(piece)
+						break
+				else:
+					tokens.append(text[i])
+					i += 1
+				continue
+			tokens.append(text[i])
+			i += 1
+		return tokens
+
+	def detokenize(self, tokens: Sequence[int], prev_tokens: Sequence[int] | None = None, special: bool = False) -> bytes:
+		out = bytearray()
+		for token in tokens:
+			if token < 256:
+				out.append(token)
+			elif special:
+				out.extend(self.specials[token - 256].encode("utf-8"))
+		return bytes(out)
+
+	@staticmethod
+	def longest_token_prefix(a: Sequence[int], b: Sequence[int]) -> int:
+		longest = 0
+		for x, y in zip(a, b):
+			if x != y:
+				break
+			longest += 1
+		return longest
+
+	# Same as Llama.eval(): decodes in n_batch chunks on sequence 0 after the
+	# tokens that are kept
+	def eval(self, tokens: Sequence[int]):
+		if self.n_tokens + len(tokens) > self._n_ctx:
+			raise ValueError(f"Requested tokens ({self.n_tokens + len(tokens)}) exceed context window of {self._n_ctx}")
+		self._ctx.kv_cache_seq_rm(-1, self.n_tokens, -1)
+		for i in range(0, len(tokens), self.n_batch):
+			batch = tokens[i:i + self.n_batch]
+			self._batch.set_batch(batch, n_past=self.n_tokens, logits_all=False)
+			self._ctx.decode(self._batch)
+			self.input_ids[self.n_tokens:self.n_tokens + len(batch)] = batch
+			self.n_tokens += len(batch)
+
+	def save_state(self) -> LlamaState:
+		return LlamaState(
+			input_ids=self.input_ids.copy(),
+			scores=numpy.zeros((1, 1), dtype=numpy.single),
+			n_tokens=self.n_tokens,
+			llama_state=b"",
+			llama_state_size=0,
+			seed=self._seed,
+		)
+
+	def load_state(self, state: LlamaState):
+		self.input_ids = state.input_ids.copy()
+		self.n_tokens = state.n_tokens
+		self._ctx.restore(0, self.input_ids[:self.n_tokens].tolist())
+
+	def reset(self):
+		self.n_tokens = 0
+
+	def close(self):
+		self._ctx.close()
+
+	# End of the last prompt end marker that ends at or after start; start if
+	# there is none, the whole sequence without any (a raw prompt)
+	def prompt_length(self, tokens: List[int], start: int = 0) -> int:
+		found = 0
+		for end in self.prompt_ends:
+			for i in range(len(tokens) - len(end), max(start - len(end) - 1, -1), -1):
+				if tokens[i:i + len(end)] == end:
+					found = max(found, i + len(end))
+					break
+		return found or start or len(tokens)
+
+	def answer_token(self, answer: List[int], i: int) -> int:
+		return answer[i] if i < len(answer) else WORDS[i % len(WORDS)].encode("utf-8")[0]
+
+	def answer(self, prompt: List[int]) -> List[int]:
+		digest = hashlib.sha256(numpy.asarray(prompt, dtype=numpy.intc).tobytes()).digest()
+		text = self.detokenize(prompt)
+		if b"getRecentChannelMessages" in text and digest[0] / 256 < self.tool_rate:
+			arguments = {"channelIndex": digest[1] % 4, "limit": 10 + digest[2] % 90}
+			call = json.dumps({"name": "getRecentChannelMessages", "arguments": arguments})
+			if self.family == "qwen":
+				return self.tokenize(b"<tool_call>\n" + call.encode("utf-8") + b"\n</tool_call><|im_end|>", add_bos=False, special=True)
+			if self.family == "mistral":
+				return self.tokenize(b"[TOOL_CALLS][" + call.encode("utf-8") + b"]</s>", add_bos=False, special=True)
+			python = f"getRecentChannelMessages(channelIndex={arguments['channelIndex']}, limit={arguments['limit']})"
+			return self.tokenize(b"```tool_code\n" + python.encode("utf-8") + b"\n```<end_of_turn>", add_bos=False, special=True)
+
+		words = []
+		length = 0
+		i = digest[3]
+		while length < self.output_tokens:
+			word = WORDS[i % len(WORDS)]
+			words.append(word)
+			length += len(word) + 1
+			i = (i * 31 + 7) % 1000003
+		end = {"qwen": b"<|im_end|>", "mistral": b"</s>", "gemma3": b"<end_of_turn>"}[self.family]
+		return self.tokenize(" ".join(words).encode("utf-8")[:self.output_tokens] + end, add_bos=False, special=True)
@@ -0,0 +1,47 @@
+import argparse
+import os
+import runpy
+import sys
+
+# Runs one of the servers in ../dist with FakeLlama in place of the GGUF
+# download, or with a local (tiny) GGUF on CPU:
+#   python3 fake_server.py qwen
+#   FAKE_TOKEN_MS=20 FAKE_PREFILL_MS=0.2 python3 fake_server.py gemma3
+#   python3 fake_server.py qwen --gguf qwen2.5-0.5b-instruct-q4_k_m.gguf
+# The server listens on port 8443 like in the image, AI_USERNAME/AI_PASSWORD
+# default to bench/bench.
+
+DIST = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dist")
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("server", choices=["qwen", "mistral", "gemma3"])
+	parser.add_argument("--gguf", help="local GGUF to load instead of the fake model")
+	parser.add_argument("--threads", type=int, default=os.cpu_count(), help="n_threads with --gguf")
+	args = parser.parse_args()
+
+	os.environ.setdefault("AI_USERNAME", "bench")
+	os.environ.setdefault("AI_PASSWORD", "bench")
+	# no snapshots of a previous run, no GPU
+	os.environ.setdefault("SNAPSHOT_DIR_BYTES", "0")
+	os.environ.pop("CUDA_ARCH", None)
+	sys.path.insert(0, DIST)
+
+	import llama_cpp
+	if args.gguf is not None:
+		def from_pretrained(cls, repo_id: str = "", filename: str = "", **kwargs):
+			kwargs.pop("device", None)
+			kwargs["n_threads"] = args.threads
+			kwargs["verbose"] = False
+			return cls(model_path=args.gguf, **kwargs)
+		llama_cpp.Llama.from_pretrained = classmethod(from_pretrained)
+	else:
+		# only the llama.cpp calls are faked, the servers' decode loops
+		# (speculative decoding, BATCH_SLOTS) run as in the image
+		from fake_llama import patch_llama_cpp
+		patch_llama_cpp()
+
+	runpy.run_path(os.path.join(DIST, args.server + ".py"), run_name="__main__")
+
+if __name__ == "__main__":
+	main()
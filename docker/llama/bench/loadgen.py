@@ -0,0 +1,271 @@
+import argparse
+import base64
+import http.client
+import json
+import math
+import random
+import threading
+import time
+import urllib.parse
+from typing import Any, Dict, List, Tuple
+
+# Load generator for the /generate endpoint of the servers in ../dist (real or
+# fake_server.py). Sends tool-call-heavy dialogs like the backend does: a system
+# prompt, user questions, assistant tool calls and long channel message dumps
+# as tool results, with prompt lengths drawn from a log-normal distribution.
+#   python3 loadgen.py --concurrency 4 --requests 100 --prompt-chars 6000
+#
+# Reports time to first frame, inter-token latency, token throughput (from the
+# perf trailer) and server CPU time per generated token (from /metrics).
+
+TOOLS = [
+	{"type": "function", "function": {
+		"name": "getRecentChannelMessages",
+		"description": "Get recent messages from a channel, starting from the most recent.",
+		"parameters": {"type": "object", "properties": {
+			"channelIndex": {"type": "integer", "description": "Index of the channel"},
+			"limit": {"type": "integer", "description": "Number of messages"},
+		}, "required": ["channelIndex", "limit"]},
+	}},
+	{"type": "function", "function": {
+		"name": "getChannelMessagesRange",
+		"description": "Get the messages of a channel between two dates.",
+		"parameters": {"type": "object", "properties": {
+			"channelIndex": {"type": "integer", "description": "Index of the channel"},
+			"startDate": {"type": "string", "description": "ISO date"},
+			"endDate": {"type": "string", "description": "ISO date"},
+		}, "required": ["channelIndex", "startDate", "endDate"]},
+	}},
+]
+
+SYSTEM = (
+	"You are the assistant of a community. You can read the messages of its channels with the tools "
+	"you are given. Channels: 0 general, 1 announcements, 2 events, 3 off-topic. Answer in the "
+	"language of the user and keep your answers short."
+)
+
+WORDS = (
+	"hey everyone the stream starts at eight tonight please check the schedule pinned in events "
+	"who is joining the call tomorrow i can bring the slides did anyone fix the voice issue yet "
+	"thanks for the update the new roles are live now ping me if something looks wrong"
+).split()
+
+QUESTIONS = [
+	"What happened in general today?",
+	"Summarize the announcements of this week.",
+	"Are there any events planned for the weekend?",
+	"Who asked about the voice issue?",
+]
+
+USERS = ["Alexandra Miller", "community-bot", "Bob", "jonas.k", "Mod Team", "0xC0ffee"]
+
+# The shape the backend's executeFunctionCall returns, oldest message first
+def channel_messages(rng: random.Random, chars: int) -> List[Dict[str, Any]]:
+	messages = []
+	size = 0
+	while size < chars:
+		text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 30)))
+		messages.append({"createdAt": f"2025-01-{rng.randint(1, 28):02d} {rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}", "userName": rng.choice(USERS), "text": text})
+		size += len(text) + 60
+	messages.sort(key=lambda m: m["createdAt"])
+	return messages
+
+# Dialog of about prompt_chars characters. With probability tool_rate it has
+# tool rounds (call + channel dump), ending on a tool result half of the time.
+def make_dialog(rng: random.Random, prompt_chars: int, tool_rate: float) -> List[Dict[str, Any]]:
+	messages = [{"role": "system", "content": SYSTEM}, {"role": "user", "content": rng.choice(QUESTIONS)}]
+	if rng.random() >= tool_rate:
+		messages[1]["content"] += " " + " ".join(rng.choice(WORDS) for _ in range(prompt_chars // 6))
+		return messages
+	rounds = rng.randint(1, 3)
+	for i in range(rounds):
+		channel = rng.randint(0, 3)
+		messages.append({"role": "assistant", "content": "", "tool_calls": [
+			{"name": "getRecentChannelMessages", "arguments": {"channelIndex": channel, "limit": 50}},
+		]})
+		messages.append({"role": "tool", "content": json.dumps(channel_messages(rng, prompt_chars // rounds))})
+		if i < rounds - 1 or rng.random() < 0.5:
+			messages.append({"role": "assistant", "content": "Channel " + str(channel) + " is mostly about the schedule."})
+			messages.append({"role": "user", "content": rng.choice(QUESTIONS)})
+	return messages
+
+def percentile(values: List[float], p: float) -> float:
+	if len(values) == 0:
+		return 0.0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(math.ceil(p / 100 * len(values))) - 1)]
+
+# Percentile of (value, weight) samples, a sample counts weight times
+def weighted_percentile(samples: List[Tuple[float, float]], p: float) -> float:
+	if len(samples) == 0:
+		return 0.0
+	samples = sorted(samples)
+	total = sum(weight for _, weight in samples)
+	seen = 0.0
+	for value, weight in samples:
+		seen += weight
+		if seen >= p / 100 * total:
+			return value
+	return samples[-1][0]
+
+# Inter-token latencies of one generation as (latency, tokens) samples. The
+# server coalesces text frames, so a frame carries several tokens: the tokens
+# after the first frame (from the perf trailer) are split between the frames
+# by their text length, and each token of a frame waited gap / tokens.
+def token_latencies(frames: List[Tuple[float, int]], tokens: int) -> List[Tuple[float, float]]:
+	chars = sum(n for _, n in frames[1:])
+	if chars == 0 or tokens <= 1:
+		return []
+	samples = []
+	for (previous, _), (now, n) in zip(frames, frames[1:]):
+		frame_tokens = (tokens - 1) * n / chars
+		if frame_tokens > 0:
+			samples.append(((now - previous) / frame_tokens, frame_tokens))
+	return samples
+
+class Client:
+	def __init__(self, url: str, user: str, password: str, timeout: float):
+		parsed = urllib.parse.urlparse(url)
+		self.https = parsed.scheme == "https"
+		self.host = parsed.hostname
+		self.port = parsed.port or (443 if self.https else 80)
+		self.timeout = timeout
+		self.auth = "Basic " + base64.b64encode(f"{user}:{password}".encode("utf-8")).decode("ascii")
+
+	def connect(self) -> http.client.HTTPConnection:
+		if self.https:
+			return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+		return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+	def metrics(self) -> Dict[str, float]:
+		conn = self.connect()
+		try:
+			conn.request("GET", "/metrics", headers={"Authorization": self.auth})
+			body = conn.getresponse().read().decode("utf-8")
+		finally:
+			conn.close()
+		values = {}
+		for line in body.splitlines():
+			if line.startswith("#") or " " not in line:
+				continue
+			name, value = line.rsplit(" ", 1)
+			values[name.split("{")[0]] = values.get(name.split("{")[0], 0.0) + float(value)
+		return values
+
+	# One streamed generation, returns its timings
+	def generate(self, messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+		body = json.dumps({"messages": messages, "tools": TOOLS}).encode("utf-8")
+		result = {"ttft": None, "frames": [], "tokens": 0, "tool_call": False, "error": None}
+		conn = self.connect()
+		started = time.perf_counter()
+		try:
+			conn.request("POST", "/generate", body=body, headers={"Authorization": self.auth, "Content-Type": "application/json"})
+			response = conn.getresponse()
+			if response.status != 200:
+				result["error"] = f"HTTP {response.status}: {response.read()[:200]!r}"
+				return result
+			for line in response:
+				now = time.perf_counter()
+				frame = json.loads(line)
+				if "perf" in frame:
+					result["tokens"] = frame["perf"].get("completion_tokens", 0)
+					continue
+				if "text" not in frame:
+					continue
+				if frame.get("is_error"):
+					result["error"] = frame["text"]
+					continue
+				if frame.get("is_tool"):
+					result["tool_call"] = True
+				if result["ttft"] is None:
+					result["ttft"] = now - started
+				# arrival time and text length, see token_latencies()
+				result["frames"].append((now, len(frame["text"])))
+		except Exception as e:
+			result["error"] = str(e)
+		finally:
+			result["elapsed"] = time.perf_counter() - started
+			conn.close()
+		return result
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--url", default="http://localhost:8443")
+	parser.add_argument("--user", default="bench")
+	parser.add_argument("--password", default="bench")
+	parser.add_argument("--concurrency", type=int, default=4)
+	parser.add_argument("--requests", type=int, default=50)
+	parser.add_argument("--prompt-chars", type=int, default=4000, help="median prompt length in characters")
+	parser.add_argument("--prompt-sigma", type=float, default=0.7, help="sigma of the log-normal prompt length")
+	parser.add_argument("--max-prompt-chars", type=int, default=60000)
+	parser.add_argument("--tool-rate", type=float, default=0.8, help="share of dialogs with tool rounds")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--timeout", type=float, default=600)
+	parser.add_argument("--json", help="also write the summary to this file")
+	args = parser.parse_args()
+
+	rng = random.Random(args.seed)
+	dialogs = []
+	for _ in range(args.requests):
+		chars = int(min(args.max_prompt_chars, max(200, rng.lognormvariate(math.log(args.prompt_chars), args.prompt_sigma))))
+		dialogs.append(make_dialog(rng, chars, args.tool_rate))
+
+	client = Client(args.url, args.user, args.password, args.timeout)
+	try:
+		before = client.metrics()
+	except Exception as e:
+		print("No /metrics, server CPU is not reported:", e)
+		before = None
+
+	results = []
+	lock = threading.Lock()
+	def worker():
+		while True:
+			with lock:
+				if len(dialogs) == 0:
+					return
+				messages = dialogs.pop()
+			result = client.generate(messages)
+			with lock:
+				results.append(result)
+
+	started = time.perf_counter()
+	threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	wall = time.perf_counter() - started
+
+	ok = [r for r in results if r["error"] is None]
+	ttft = [r["ttft"] for r in ok if r["ttft"] is not None]
+	itl = [sample for r in ok for sample in token_latencies(r["frames"], r["tokens"])]
+	tokens = sum(r["tokens"] for r in ok)
+	summary = {
+		"requests": len(results),
+		"errors": len(results) - len(ok),
+		"tool_calls": sum(1 for r in ok if r["tool_call"]),
+		"wall_s": round(wall, 3),
+		"requests_per_s": round(len(ok) / wall, 3),
+		"tokens": tokens,
+		"tokens_per_s": round(tokens / wall, 1),
+		"ttft_ms": {p: round(percentile(ttft, p) * 1000, 1) for p in (50, 90, 99)},
+		"itl_ms": {p: round(weighted_percentile(itl, p) * 1000, 2) for p in (50, 95, 99)},
+	}
+	if before is not None:
+		after = client.metrics()
+		cpu = after.get("llama_process_cpu_seconds", 0.0) - before.get("llama_process_cpu_seconds", 0.0)
+		generated = after.get("llama_completion_tokens_total", 0.0) - before.get("llama_completion_tokens_total", 0.0)
+		summary["server_cpu_s"] = round(cpu, 3)
+		summary["server_cpu_ms_per_token"] = round(cpu / generated * 1000, 3) if generated > 0 else None
+
+	for r in results:
+		if r["error"] is not None:
+			print("Error:", r["error"])
+	print(json.dumps(summary, indent=2))
+	if args.json is not None:
+		with open(args.json, "w") as f:
+			json.dump(summary, f, indent=2)
+
+if __name__ == "__main__":
+	main()
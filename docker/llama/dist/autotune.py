@@ -0,0 +1,166 @@
+import argparse
+import datetime
+import itertools
+import json
+import os
+import time
+from typing import Any, Dict, List, Tuple
+import llama_cpp
+from registry import TUNED_KEYS, host_key, open_model, read_manifest
+
+# Benchmarks prefill and decode of a model on this host over a grid of
+# n_threads/n_threads_batch, n_batch/n_ubatch and flash_attn and writes the
+# best settings to the tuning file (MODEL_TUNING, default /data/tuning.json)
+# under this host's key, where registry.load_model() picks them up:
+#   python3 /dist/autotune.py qwen/cpu
+#   python3 /dist/autotune.py gemma3/medium --gguf /models/google_gemma-3-27b-it-Q4_K_M.gguf
+# The model comes from the manifest entry of the profile (see registry.py),
+# --gguf sets or replaces its path.
+#
+# One context is created per (n_batch, n_ubatch, flash_attn), the thread
+# counts are switched on it with llama_set_n_threads(). Decode only depends on
+# n_threads and prefill only on n_threads_batch, so both are picked per
+# context; the context that wins is the one with the shortest time for a
+# request of --weight-prompt prompt and --weight-output generated tokens.
+
+SAMPLE = (
+	"The channel discussed the release plans, the new moderation rules and the schedule of the "
+	"community call. Several members shared links to the roadmap and asked about voice quality. "
+)
+
+def physical_cores() -> int:
+	cores = set()
+	for cpu in os.sched_getaffinity(0):
+		try:
+			with open(f"/sys/devices/system/cpu/cpu{cpu}/topology/core_id", "r") as f:
+				core = f.read().strip()
+			with open(f"/sys/devices/system/cpu/cpu{cpu}/topology/physical_package_id", "r") as f:
+				package = f.read().strip()
+			cores.add((package, core))
+		except OSError:
+			cores.add(("", str(cpu)))
+	return len(cores)
+
+def thread_candidates(gpu: bool) -> List[int]:
+	logical = len(os.sched_getaffinity(0))
+	if gpu:
+		return sorted({t for t in (1, 2, 4, 8) if t <= logical})
+	cores = physical_cores()
+	return sorted({max(1, cores // 4), max(1, cores // 2), max(1, cores * 3 // 4), cores, logical})
+
+def int_list(text: str) -> List[int]:
+	return [int(v) for v in text.split(",")]
+
+def bool_list(text: str) -> List[bool]:
+	return [v.strip() in ("on", "true", "1") for v in text.split(",")]
+
+# (prefill tokens/s, decode tokens/s), the best of repeat runs
+def measure(model, prompt: List[int], output_tokens: int, repeat: int) -> Tuple[float, float]:
+	best_prefill = 0.0
+	best_decode = 0.0
+	for _ in range(repeat):
+		model.reset()
+		started = time.perf_counter()
+		model.eval(prompt)
+		best_prefill = max(best_prefill, len(prompt) / (time.perf_counter() - started))
+		started = time.perf_counter()
+		for i in range(output_tokens):
+			model.eval([prompt[i % len(prompt)]])
+		best_decode = max(best_decode, output_tokens / (time.perf_counter() - started))
+	return best_prefill, best_decode
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument("profile", help="<family>/<profile>, e.g. qwen/cpu")
+	parser.add_argument("--gguf", help="GGUF file, default: the path of the manifest entry")
+	parser.add_argument("--threads", type=int_list, help="thread counts to try, default: derived from the cores")
+	parser.add_argument("--batch", type=int_list, default=[512, 1024, 2048], help="n_batch values")
+	parser.add_argument("--ubatch", type=int_list, default=[256, 512], help="n_ubatch values")
+	parser.add_argument("--flash-attn", type=bool_list, default=[False, True], help="e.g. on,off")
+	parser.add_argument("--prompt-tokens", type=int, default=1024)
+	parser.add_argument("--output-tokens", type=int, default=64)
+	parser.add_argument("--repeat", type=int, default=2)
+	parser.add_argument("--weight-prompt", type=int, default=4000, help="prompt tokens of the reference request")
+	parser.add_argument("--weight-output", type=int, default=200, help="generated tokens of the reference request")
+	parser.add_argument("--dry-run", action="store_true", help="print the result without writing it")
+	args = parser.parse_args()
+
+	if "/" not in args.profile:
+		raise SystemExit("Expected <family>/<profile>, e.g. qwen/cpu")
+	manifest_path = os.environ.get("MODEL_MANIFEST", "/data/models.json")
+	spec = dict(read_manifest(manifest_path).get(args.profile, {}))
+	if args.gguf is not None:
+		spec["path"] = args.gguf
+	if "path" not in spec and "repo_id" not in spec:
+		raise SystemExit(f"No manifest entry for {args.profile} in {manifest_path}, pass --gguf")
+	spec.pop("draft", None)
+	for key in TUNED_KEYS:
+		spec.pop(key, None)
+
+	gpu = spec.get("n_gpu_layers", 0) != 0 and os.environ.get("CUDA_ARCH") is not None
+	threads = args.threads or thread_candidates(gpu)
+	# a quantized KV cache needs flash attention
+	flash_attn = args.flash_attn
+	if spec.get("type_k", "f16") != "f16" or spec.get("type_v", "f16") != "f16":
+		flash_attn = [True]
+	n_ctx = args.prompt_tokens + args.output_tokens + 16
+	print("Host:", host_key())
+	print("Threads:", threads, "n_batch:", args.batch, "n_ubatch:", args.ubatch, "flash_attn:", flash_attn)
+
+	results = []
+	for n_batch, n_ubatch, fa in itertools.product(args.batch, args.ubatch, flash_attn):
+		if n_ubatch > n_batch:
+			continue
+		try:
+			model = open_model(spec, n_ctx=n_ctx, n_batch=n_batch, n_ubatch=n_ubatch, flash_attn=fa, n_threads=threads[-1], n_threads_batch=threads[-1], verbose=False)
+		except Exception as e:
+			print(f"n_batch={n_batch} n_ubatch={n_ubatch} flash_attn={fa}: failed to load:", e)
+			continue
+		try:
+			text = SAMPLE.encode("utf-8")
+			prompt = model.tokenize(text * (args.prompt_tokens // 20 + 1), add_bos=True)[:args.prompt_tokens]
+			# warm up, the first evaluation also faults in the weights
+			measure(model, prompt[:64], 4, 1)
+			prefill = {}
+			decode = {}
+			for t in threads:
+				llama_cpp.llama_set_n_threads(model._ctx.ctx, t, t)
+				prefill[t], decode[t] = measure(model, prompt, args.output_tokens, args.repeat)
+				print(f"n_batch={n_batch} n_ubatch={n_ubatch} flash_attn={fa} threads={t}: prefill {prefill[t]:.1f} t/s, decode {decode[t]:.2f} t/s")
+		finally:
+			model.close()
+		threads_batch = max(prefill, key=prefill.get)
+		n_threads = max(decode, key=decode.get)
+		seconds = args.weight_prompt / prefill[threads_batch] + args.weight_output / decode[n_threads]
+		results.append((seconds, {
+			"n_threads": n_threads,
+			"n_threads_batch": threads_batch,
+			"n_batch": n_batch,
+			"n_ubatch": n_ubatch,
+			"flash_attn": fa,
+			"prefill_tokens_per_second": round(prefill[threads_batch], 1),
+			"decode_tokens_per_second": round(decode[n_threads], 2),
+		}))
+
+	if len(results) == 0:
+		raise SystemExit("No configuration could be measured")
+	seconds, best = min(results, key=lambda r: r[0])
+	best["reference_request_seconds"] = round(seconds, 3)
+	best["tuned_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds")
+	print("Best:", json.dumps(best))
+	if args.dry_run:
+		return
+
+	path = os.environ.get("MODEL_TUNING", "/data/tuning.json")
+	tuning: Dict[str, Dict[str, Any]] = {}
+	if os.path.exists(path):
+		with open(path, "r") as f:
+			tuning = json.load(f)
+	tuning.setdefault(host_key(), {})[args.profile] = best
+	with open(path + ".tmp", "w") as f:
+		json.dump(tuning, f, indent=2)
+	os.replace(path + ".tmp", path)
+	print("Written to", path)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,325 @@
+import collections
+import os
+import queue
+import threading
+import time
+from typing import Callable, Iterator, List, Tuple
+import llama_cpp
+from llama_cpp import _internals as internals
+from prefill import prefill_chunk_from_env
+from speculative import PromptLookup, SpeculativeStats, make_sampler
+from tool_grammar import ToolGrammar
+
+# Marker put into a sequence's token queue once it is retired
+SEQUENCE_DONE = object()
+
+class BatchSequence:
+	def __init__(self, tokens: List[int], sampler, stopping_criteria: Callable | None, on_progress: Callable[[int, int], None] | None, drafter: PromptLookup | None, stats: SpeculativeStats | None):
+		# prompt followed by the generated tokens
+		self.tokens = list(tokens)
+		self.n_prompt = len(tokens)
+		# number of tokens already decoded into the sequence's KV cells
+		self.n_past = 0
+		self.slot = -1
+		self.sampler = sampler
+		self.stopping_criteria = stopping_criteria
+		self.on_progress = on_progress
+		self.drafter = drafter
+		self.stats = stats if drafter is not None else None
+		self.output = queue.SimpleQueue()
+		self.cancelled = False
+
+	@property
+	def prefilling(self) -> bool:
+		return self.n_past < self.n_prompt
+
+# Continuous batching: every request gets its own sequence id (slot) in one
+# multi-sequence llama context, and one llama_decode per step advances all
+# active sequences, one token each for the decoding ones plus prompt chunks
+# of the prefilling ones. Sequences are admitted and retired between steps, so
+# a finished request frees its slot for the next one without waiting for the
+# others.
+#
+# Prefill is capped at prefill_chunk tokens per step, a huge prompt is spread
+# over several steps and only adds that much to the step time of the decoding
+# sequences. Prompts longer than one chunk report their progress after every step.
+#
+# With speculative prompt lookup, a decoding sequence also gets the tokens
+# drafted from its own context into the step; they are verified against the
+# sampled tokens like on the single sequence path (see speculative.py).
+#
+# The context is recreated with n_seq_max = n_slots and a non-unified KV
+# cache, llama.cpp then splits n_ctx evenly between the slots. Only the batch
+# thread touches the context afterwards; callers get blocking token iterators
+# that behave like model.generate().
+class BatchEngine:
+	def __init__(self, model, n_slots: int, prefill_chunk: int, speculative: bool = False, name: str = "llama-batch"):
+		if n_slots > llama_cpp.llama_max_parallel_sequences():
+			raise ValueError("Too many slots: " + str(n_slots))
+		self.model = model
+		self.n_slots = n_slots
+
+		params = type(model.context_params).from_buffer_copy(model.context_params)
+		params.n_seq_max = n_slots
+		params.kv_unified = False
+		model._ctx.close()
+		model._ctx = internals.LlamaContext(model=model._model, params=params, verbose=model.verbose)
+		model.context_params = params
+		model.n_tokens = 0
+		self.ctx = model._ctx
+		self.n_batch = params.n_batch
+		self.prefill_chunk = prefill_chunk
+		self.speculative = speculative
+		self.slot_size = self.ctx.n_ctx() // n_slots
+		self.batch = internals.LlamaBatch(n_tokens=self.n_batch, embd=0, n_seq_max=1)
+
+		self.cond = threading.Condition()
+		self.pending = collections.deque()
+		self.active: List[BatchSequence] = []
+		self.free_slots = list(range(n_slots - 1, -1, -1))
+		self.closed = False
+		self.steps = 0
+		self.decoded_tokens = 0
+		self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+		self.thread.start()
+		print("Batch engine started, slots:", n_slots, "tokens per slot:", self.slot_size)
+
+	@classmethod
+	def from_env(cls, model):
+		n_slots = int(os.environ.get("BATCH_SLOTS", "1"))
+		if n_slots <= 1:
+			return None
+		# a draft model would need its own slots, only prompt lookup is batched
+		speculative = os.environ.get("SPECULATIVE", "lookup") != "off"
+		return cls(model, n_slots, prefill_chunk_from_env(), speculative)
+
+	# Same contract as model.generate(): yields sampled tokens until the
+	# stopping criteria returns True, the stopping token is not yielded.
+	# Closing the iterator retires the sequence.
+	def generate(
+		self,
+		tokens: List[int],
+		top_k: int = 40,
+		top_p: float = 0.95,
+		min_p: float = 0.05,
+		temp: float = 0.8,
+		repeat_penalty: float = 1.0,
+		stopping_criteria: Callable | None = None,
+		on_progress: Callable[[int, int], None] | None = None,
+		grammar: ToolGrammar | None = None,
+		stats: SpeculativeStats | None = None,
+	) -> Iterator[int]:
+		if len(tokens) == 0:
+			raise ValueError("No tokens to generate from")
+		if len(tokens) >= self.slot_size:
+			raise ValueError(f"Prompt too long: {len(tokens)} tokens, a slot holds {self.slot_size}")
+		if len(tokens) <= self.prefill_chunk:
+			on_progress = None
+		sampler = make_sampler(self.model, top_k, top_p, min_p, temp, grammar, repeat_penalty)
+		drafter = PromptLookup() if self.speculative else None
+		seq = BatchSequence(tokens, sampler, stopping_criteria, on_progress, drafter, stats if stats is not None else SpeculativeStats("lookup"))
+		with self.cond:
+			if self.closed:
+				raise RuntimeError("Batch engine is closed")
+			self.pending.append(seq)
+			self.cond.notify()
+		return self._tokens(seq)
+
+	def _tokens(self, seq: BatchSequence) -> Iterator[int]:
+		try:
+			while True:
+				item = seq.output.get()
+				if item is SEQUENCE_DONE:
+					return
+				if isinstance(item, BaseException):
+					raise item
+				yield item
+		finally:
+			seq.cancelled = True
+
+	def _finish(self, seq: BatchSequence, error: BaseException | None = None):
+		if seq.slot >= 0:
+			self.ctx.kv_cache_seq_rm(seq.slot, -1, -1)
+			self.free_slots.append(seq.slot)
+			seq.slot = -1
+		seq.sampler.close()
+		if seq.stats is not None:
+			seq.stats.finish()
+		if error is not None:
+			seq.output.put(error)
+		seq.output.put(SEQUENCE_DONE)
+
+	# Moves waiting sequences into free slots and drops cancelled ones. Blocks
+	# while there is nothing to do.
+	def _admit(self) -> bool:
+		with self.cond:
+			while len(self.active) == 0 and len(self.pending) == 0 and not self.closed:
+				self.cond.wait()
+			if self.closed:
+				return False
+			while len(self.pending) > 0 and len(self.free_slots) > 0:
+				seq = self.pending.popleft()
+				if seq.cancelled:
+					self._finish(seq)
+					continue
+				seq.slot = self.free_slots.pop()
+				self.active.append(seq)
+		for seq in [s for s in self.active if s.cancelled]:
+			self.active.remove(seq)
+			self._finish(seq)
+		return True
+
+	# Fills the batch for one step. Decoding sequences go first, each needs a
+	# single token plus its drafts; prefilling sequences get up to prefill_chunk
+	# tokens in admission order. Returns the sequences that get tokens sampled
+	# after this step with their first logit index and drafts, and the sequences
+	# that made prefill progress.
+	def _fill(self) -> Tuple[List[tuple], List[BatchSequence]]:
+		batch = self.batch.batch
+		n = 0
+		sampled = []
+		prefilling = []
+		progressed = []
+		decoding = [seq for seq in self.active if not seq.prefilling]
+		for i, seq in enumerate(decoding):
+			drafts = []
+			if seq.drafter is not None:
+				# leave room for one token of every other decoding sequence
+				room = min(self.n_batch - n - (len(decoding) - i), self.slot_size - len(seq.tokens) - 1)
+				if room > 0:
+					drafts = seq.drafter.propose(seq.tokens)[:room]
+			sampled.append((seq, n, drafts))
+			for token in [seq.tokens[-1]] + drafts:
+				batch.token[n] = token
+				batch.pos[n] = seq.n_past
+				batch.seq_id[n][0] = seq.slot
+				batch.n_seq_id[n] = 1
+				batch.logits[n] = True
+				seq.n_past += 1
+				n += 1
+		for seq in self.active:
+			if seq.prefilling:
+				prefilling.append(seq)
+		limit = min(self.n_batch, n + self.prefill_chunk)
+		for seq in prefilling:
+			if n >= limit:
+				break
+			chunk = min(limit - n, seq.n_prompt - seq.n_past)
+			for i in range(chunk):
+				batch.token[n] = seq.tokens[seq.n_past]
+				batch.pos[n] = seq.n_past
+				batch.seq_id[n][0] = seq.slot
+				batch.n_seq_id[n] = 1
+				batch.logits[n] = False
+				seq.n_past += 1
+				n += 1
+			if seq.on_progress is not None:
+				progressed.append(seq)
+			if not seq.prefilling:
+				batch.logits[n - 1] = True
+				sampled.append((seq, n - 1, []))
+		batch.n_tokens = n
+		return sampled, progressed
+
+	# Samples the sequence's tokens of this step, the drafts are kept for as long
+	# as they equal the sampled tokens. Returns False when the sequence is done.
+	def _sample(self, seq: BatchSequence, idx: int, drafts: List[int]) -> bool:
+		accepted = 0
+		for i in range(len(drafts) + 1):
+			token = seq.sampler.sample(self.ctx, idx + i)
+			seq.tokens.append(token)
+			stop = seq.stopping_criteria is not None and seq.stopping_criteria(seq.tokens, None)
+			if stop or seq.cancelled or len(seq.tokens) >= self.slot_size:
+				return False
+			seq.output.put(token)
+			if i < len(drafts) and drafts[i] == token:
+				accepted += 1
+				continue
+			break
+		if seq.stats is not None:
+			seq.stats.steps += 1
+			seq.stats.drafted += len(drafts)
+			seq.stats.accepted += accepted
+			seq.stats.generated += accepted + 1
+		if accepted < len(drafts):
+			# drop the rejected drafts from the KV cells
+			seq.n_past -= len(drafts) - accepted
+			self.ctx.kv_cache_seq_rm(seq.slot, seq.n_past, -1)
+		return True
+
+	def _run(self):
+		while self._admit():
+			sampled, progressed = self._fill()
+			if self.batch.batch.n_tokens == 0:
+				continue
+			try:
+				self.ctx.decode(self.batch)
+			except Exception as e:
+				print("Batch decode failed:", e)
+				for seq in self.active:
+					self._finish(seq, e)
+				self.active = []
+				continue
+			self.steps += 1
+			self.decoded_tokens += self.batch.batch.n_tokens
+
+			for seq in progressed:
+				try:
+					seq.on_progress(seq.n_past, seq.n_prompt)
+				except Exception as e:
+					print("Progress callback failed:", e)
+
+			for seq, idx, drafts in sampled:
+				if not self._sample(seq, idx, drafts):
+					self.active.remove(seq)
+					self._finish(seq)
+
+		with self.cond:
+			for seq in self.active + list(self.pending):
+				self._finish(seq)
+			self.active = []
+			self.pending.clear()
+
+	def close(self, timeout: float | None = None):
+		with self.cond:
+			self.closed = True
+			self.cond.notify_all()
+		if threading.current_thread() is not self.thread:
+			self.thread.join(timeout)
+
+	def stats(self):
+		return {
+			"slots": self.n_slots,
+			"active": len(self.active),
+			"pending": len(self.pending),
+			"steps": self.steps,
+			"decoded_tokens": self.decoded_tokens,
+		}
+
+# Smoke test on CPU with any small GGUF:
+#   python3 batching.py model.gguf [slots]
+if __name__ == "__main__":
+	import sys
+	from llama_cpp import Llama
+
+	model = Llama(model_path=sys.argv[1], n_ctx=2048, n_batch=256, verbose=False)
+	engine = BatchEngine(model, int(sys.argv[2]) if len(sys.argv) > 2 else 4, prefill_chunk=64)
+	prompts = ["Once upon a time", "The capital of France is", "def fibonacci(n):", "My favourite colour is"]
+
+	def run(prompt: str):
+		counter = [0]
+		def stop(tokens, scores):
+			counter[0] += 1
+			return counter[0] >= 32 or model.token_eos() == tokens[-1]
+		tokens = model.tokenize(prompt.encode("utf-8"), add_bos=True)
+		output = list(engine.generate(tokens, temp=0.0, stopping_criteria=stop))
+		print(repr(prompt), "->", repr(model.detokenize(output).decode("utf-8", errors="replace")))
+
+	started = time.monotonic()
+	threads = [threading.Thread(target=run, args=(p,)) for p in prompts * engine.n_slots]
+	for t in threads:
+		t.start()
+	for t in threads:
+		t.join()
+	print("steps:", engine.steps, "decoded tokens:", engine.decoded_tokens, "in", round(time.monotonic() - started, 2), "s")
+	engine.close()
@@ -0,0 +1,79 @@
+import hashlib
+import json
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List
+
+# Tools sorted by function name with sorted keys, so the same tool set always
+# renders to the same text (and therefore to the same tokens and prefix cache
+# entries) no matter in which order the backend sends it.
+def canonical_tools(tools: List[Dict[str, Any]] | None) -> List[Dict[str, Any]]:
+	if tools is None:
+		return []
+	tools = [json.loads(json.dumps(tool, sort_keys=True)) for tool in tools]
+	return sorted(tools, key=lambda tool: tool.get("function", {}).get("name", tool.get("name", "")))
+
+# Token cache for the chat templates. Constant control strings are tokenized
+# once and kept forever, content (messages, tool schemas, tool results) is
+# cached by content hash with LRU eviction once max_tokens are held. The
+# templates run on every engine thread, the LRU is shared between them.
+class TokenCache:
+	def __init__(self, model, max_tokens: int = 4 * 1024 * 1024):
+		self.model = model
+		self.max_tokens = max_tokens
+		self.constants: dict = {}
+		self.entries: OrderedDict = OrderedDict()
+		self.lock = threading.Lock()
+		self.total_tokens = 0
+		self.hits = 0
+		self.misses = 0
+
+	def precompile(self, constants: List[bytes]):
+		for text in constants:
+			self.constant(text)
+
+	# Control strings, tokenized with special=True
+	def constant(self, text: bytes, add_bos: bool = False) -> array:
+		key = (text, add_bos)
+		tokens = self.constants.get(key)
+		if tokens is None:
+			tokens = array("i", self.model.tokenize(text, add_bos=add_bos, special=True))
+			self.constants[key] = tokens
+		return tokens
+
+	def text(self, text: str | bytes, special: bool = False) -> array:
+		if isinstance(text, str):
+			text = text.encode("utf-8")
+		key = (hashlib.blake2b(text, digest_size=16).digest(), special)
+		with self.lock:
+			tokens = self.entries.get(key)
+			if tokens is not None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return tokens
+			self.misses += 1
+
+		# tokenized without the lock, two threads that miss the same text both
+		# tokenize it and the second one finds it cached below
+		tokens = array("i", self.model.tokenize(text, add_bos=False, special=special))
+		if len(tokens) <= self.max_tokens:
+			with self.lock:
+				if key in self.entries:
+					self.entries.move_to_end(key)
+					return self.entries[key]
+				self.entries[key] = tokens
+				self.total_tokens += len(tokens)
+				while self.total_tokens > self.max_tokens:
+					_, evicted = self.entries.popitem(last=False)
+					self.total_tokens -= len(evicted)
+		return tokens
+
+	def stats(self):
+		with self.lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"entries": len(self.entries),
+				"tokens": self.total_tokens,
+			}
@@ -0,0 +1,123 @@
+import json
+import os
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+
+# Content of a tool message whose output was removed, a list like the tool
+# results of the backend so every chat template accepts it
+ELIDED_TOOL_OUTPUT = json.dumps([{"elided": "Older tool output removed to fit the context window"}])
+
+POLICIES = {
+	# replace old tool outputs by a placeholder, then drop the oldest turns
+	"elide_tools": ("elide", "drop"),
+	# drop the oldest turns, then elide tool outputs of the remaining ones
+	"drop_oldest": ("drop", "elide"),
+	# keep the system prompt and the last keep_turns turns, then as elide_tools
+	"last_turns": ("keep_last", "elide", "drop"),
+}
+
+class ContextOverflow(ValueError):
+	pass
+
+class ContextPlan(NamedTuple):
+	messages: List[Dict[str, Any]]
+	tokens: List[int]
+	boundaries: List[int]
+	# generated tokens that fit after the prompt
+	max_length: int
+	# what was removed, e.g. {"action": "drop_turns", "messages": 4, "tokens": 2300}
+	actions: List[Dict[str, Any]]
+
+# Turns as (start, end) message indices, a turn starts at a user message.
+# Messages before the first user message belong to the first turn.
+def _turns(messages: List[Dict[str, Any]]) -> List[Tuple[int, int]]:
+	starts = [i for i in range(1, len(messages)) if messages[i].get("role") == "user"]
+	if len(starts) == 0 or starts[0] != 1:
+		starts = [1] + starts
+	return [(s, e) for s, e in zip(starts, starts[1:] + [len(messages)]) if s < e]
+
+# Makes the prompt fit the context before anything is evaluated. The messages
+# are tokenized as they are; if the prompt plus min_output generated tokens
+# does not fit n_ctx, the policy's steps remove history (the system prompt and
+# the last turn are always kept) until it does, and max_length is capped to
+# the room that is left. A prompt that cannot be made to fit fails here
+# instead of after its prefill.
+class ContextPlanner:
+	def __init__(self, n_ctx: int, policy: str, keep_turns: int, min_output: int):
+		if policy not in POLICIES and policy != "none":
+			raise ValueError("Unknown context policy: " + policy)
+		self.n_ctx = n_ctx
+		self.policy = policy
+		self.keep_turns = keep_turns
+		self.min_output = min_output
+
+	# CONTEXT_POLICY (elide_tools, drop_oldest, last_turns or none),
+	# CONTEXT_KEEP_TURNS, CONTEXT_MIN_OUTPUT
+	@classmethod
+	def from_env(cls, n_ctx: int):
+		return cls(
+			n_ctx,
+			policy=os.environ.get("CONTEXT_POLICY", "elide_tools"),
+			keep_turns=int(os.environ.get("CONTEXT_KEEP_TURNS", "4")),
+			min_output=int(os.environ.get("CONTEXT_MIN_OUTPUT", "256")),
+		)
+
+	def plan(self, messages: List[Dict[str, Any]], tools, tokenize: Callable, max_length: int) -> ContextPlan:
+		tokens, boundaries = tokenize(messages, tools)
+		actions = []
+		steps = list(POLICIES.get(self.policy, ()))
+		while len(tokens) + self.min_output > self.n_ctx:
+			excess = len(tokens) + self.min_output - self.n_ctx
+			sizes = [boundaries[i + 1] - boundaries[i] for i in range(len(boundaries) - 1)]
+			result = None
+			while result is None and len(steps) > 0:
+				result = getattr(self, "_" + steps[0])(messages, sizes, excess)
+				if result is None:
+					steps.pop(0)
+			if result is None:
+				raise ContextOverflow(f"Prompt of {len(tokens)} tokens does not fit the context of {self.n_ctx} tokens")
+			messages, action = result
+			before = len(tokens)
+			tokens, boundaries = tokenize(messages, tools)
+			action["tokens"] = before - len(tokens)
+			actions.append(action)
+		return ContextPlan(messages, tokens, boundaries, min(max_length, self.n_ctx - len(tokens)), actions)
+
+	# sizes[i] is the token count of messages[i + 1]
+	def _drop(self, messages, sizes, excess):
+		turns = _turns(messages)
+		dropped = 0
+		removed = 0
+		while dropped < len(turns) - 1 and removed < excess:
+			start, end = turns[dropped]
+			removed += sum(sizes[start - 1:end - 1])
+			dropped += 1
+		if dropped == 0:
+			return None
+		cut = turns[dropped][0]
+		return [messages[0]] + messages[cut:], {"action": "drop_turns", "turns": dropped, "messages": cut - 1}
+
+	def _keep_last(self, messages, sizes, excess):
+		turns = _turns(messages)
+		if len(turns) <= self.keep_turns:
+			return None
+		cut = turns[-max(1, self.keep_turns)][0]
+		return [messages[0]] + messages[cut:], {"action": "keep_last_turns", "turns": len(turns) - max(1, self.keep_turns), "messages": cut - 1}
+
+	# Every tool output but the last one, oldest first
+	def _elide(self, messages, sizes, excess):
+		tools = [i for i in range(1, len(messages)) if messages[i].get("role") == "tool"]
+		messages = list(messages)
+		elided = 0
+		removed = 0
+		for i in tools[:-1]:
+			if removed >= excess:
+				break
+			if messages[i].get("content") == ELIDED_TOOL_OUTPUT:
+				continue
+			messages[i] = dict(messages[i], content=ELIDED_TOOL_OUTPUT)
+			elided += 1
+			# the placeholder itself costs a few tokens
+			removed += sizes[i - 1] - 24
+		if elided == 0:
+			return None
+		return messages, {"action": "elide_tool_outputs", "messages": elided}
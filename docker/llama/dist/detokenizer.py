@@ -0,0 +1,35 @@
+import codecs
+from typing import List, Tuple
+
+# The byte piece of every token, built once at load. llama.cpp detokenizes
+# token by token anyway, so concatenating pieces gives the same bytes as
+# model.detokenize() without a ctypes round trip per generated token.
+class PieceTable:
+	def __init__(self, model):
+		n_vocab = model.n_vocab()
+		self.pieces: List[bytes] = []
+		special = set()
+		for token_id in range(n_vocab):
+			piece = model.detokenize([token_id], special=False)
+			piece_special = model.detokenize([token_id], special=True)
+			if piece != piece_special:
+				special.add(token_id)
+			self.pieces.append(piece_special)
+		self.special = frozenset(special)
+
+# Turns a stream of token ids into text. Multi-byte characters split across
+# tokens (emojis, CJK) are held back by an incremental UTF-8 decoder until they
+# are complete, so every token costs a table lookup and a decoder call.
+class StreamDetokenizer:
+	def __init__(self, table: PieceTable):
+		self.table = table
+		self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+	# Returns the text that became complete with this token ("" while a
+	# character is still incomplete) and whether the token is a special token
+	def push(self, token_id: int) -> Tuple[str, bool]:
+		return self.decoder.decode(self.table.pieces[token_id]), token_id in self.table.special
+
+	# Whatever is left of an incomplete character at the end of the stream
+	def flush(self) -> str:
+		return self.decoder.decode(b"", final=True)
@@ -0,0 +1,223 @@
+import asyncio
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Iterator
+from scheduler import AdmissionScheduler, MAX_PRIORITY
+
+# Marker pushed to a job's output queue once the engine thread is done with it
+JOB_DONE = object()
+
+class EngineJob:
+	def __init__(self, run: Callable[["EngineJob"], Iterator[Any]], loop: asyncio.AbstractEventLoop, request_id: str):
+		self.run = run
+		self.loop = loop
+		self.request_id = request_id
+		self.output: asyncio.Queue = asyncio.Queue()
+		# Set by the consumer when nobody is reading the output anymore
+		self.cancelled = threading.Event()
+		# filled in by the scheduler on admission
+		self.priority = MAX_PRIORITY
+		self.cost = 0
+		self.enqueued_at = 0.0
+		# items handed to the event loop but not read by the client yet
+		self.unread = 0
+		self.read_cond = threading.Condition()
+		# seconds the engine thread was blocked on a slow client
+		self.reader_wait = 0.0
+
+	# Called from the engine thread, hands an item over to the event loop
+	def emit(self, item: Any):
+		with self.read_cond:
+			self.unread += 1
+		try:
+			self.loop.call_soon_threadsafe(self.output.put_nowait, item)
+		except RuntimeError:
+			# the event loop is gone, nobody will ever read this job's output
+			self.cancelled.set()
+
+	# Sets cancelled and wakes the engine thread if it waits for the reader
+	def cancel(self):
+		self.cancelled.set()
+		with self.read_cond:
+			self.read_cond.notify_all()
+
+	def consumed(self, count: int):
+		with self.read_cond:
+			self.unread -= count
+			self.read_cond.notify()
+
+	# Backpressure: blocks the engine thread while the client is more than
+	# max_unread items behind. Returns False if it stays behind for timeout seconds.
+	def wait_for_reader(self, max_unread: int, timeout: float) -> bool:
+		with self.read_cond:
+			if self.unread < max_unread or self.cancelled.is_set():
+				return True
+			started = time.monotonic()
+			caught_up = self.read_cond.wait_for(lambda: self.unread < max_unread or self.cancelled.is_set(), timeout)
+			self.reader_wait += time.monotonic() - started
+			return caught_up
+
+# The engine owns the model: a single thread runs one job at a time against it,
+# so the event loop never blocks on prefill/decode and two requests can never
+# interleave on the same llama context. Waiting jobs are ordered by the
+# admission scheduler.
+#
+# With a batch engine, jobs only feed tokens to the batch thread, so up to one
+# job per slot runs at the same time, each on its own worker thread.
+class Engine:
+	def __init__(self, model, scheduler: AdmissionScheduler | None = None, name: str = "llama-engine", workers: int = 1):
+		self.model = model
+		self.scheduler = scheduler if scheduler is not None else AdmissionScheduler.from_env()
+		self.running: set = set()
+		# jobs by request id, from submit() until they are done
+		self.jobs: dict[str, EngineJob] = {}
+		self.closed = False
+		self.max_unread = int(os.environ.get("STREAM_MAX_UNREAD", "64"))
+		self.stall_timeout = float(os.environ.get("STREAM_STALL_TIMEOUT", "30"))
+		self.disconnect_poll = float(os.environ.get("DISCONNECT_POLL_SECONDS", "1"))
+		self.threads = [
+			threading.Thread(target=self._run, name=f"{name}-{i}" if workers > 1 else name, daemon=True)
+			for i in range(workers)
+		]
+		for thread in self.threads:
+			thread.start()
+
+	# Raises QueueFullError when the backlog is over its limit
+	def submit(self, run: Callable[[EngineJob], Iterator[Any]], request_id: str, priority: int = MAX_PRIORITY, cost: int = 0) -> EngineJob:
+		if self.closed:
+			raise RuntimeError("Engine is closed")
+		if request_id in self.jobs:
+			raise ValueError("Duplicate request id: " + request_id)
+		job = EngineJob(run, asyncio.get_running_loop(), request_id)
+		self.scheduler.push(job, priority, cost)
+		self.jobs[request_id] = job
+		return job
+
+	def _forget(self, job: EngineJob):
+		if self.jobs.get(job.request_id) is job:
+			del self.jobs[job.request_id]
+
+	# Stops a job: a running generation sees the flag at its next token, a
+	# waiting one is taken out of the queue right away
+	def cancel(self, job: EngineJob):
+		job.cancel()
+		if self.scheduler.remove(job):
+			self._forget(job)
+			job.emit(JOB_DONE)
+
+	# Returns False if there is no such request (anymore)
+	def interrupt(self, request_id: str) -> bool:
+		job = self.jobs.get(request_id)
+		if job is None:
+			return False
+		print("Interrupting request", request_id)
+		self.cancel(job)
+		return True
+
+	async def _watch_disconnect(self, job: EngineJob, is_disconnected: Callable[[], Awaitable[bool]]):
+		while not job.cancelled.is_set():
+			if await is_disconnected():
+				print("Client disconnected, cancelling request", job.request_id)
+				self.cancel(job)
+				return
+			await asyncio.sleep(self.disconnect_poll)
+
+	# Async iterator over the items produced by a job. String items that queued
+	# up while the client was busy are joined into one chunk. Leaving the
+	# iteration early (client disconnect, exception) cancels the job, and so
+	# does is_disconnected (e.g. Request.is_disconnected) returning True, which
+	# is polled also while the job is still waiting and nothing is sent.
+	async def stream(self, job: EngineJob, is_disconnected: Callable[[], Awaitable[bool]] | None = None):
+		watcher = None
+		if is_disconnected is not None:
+			watcher = asyncio.create_task(self._watch_disconnect(job, is_disconnected))
+		try:
+			while True:
+				items = [await job.output.get()]
+				while not job.output.empty():
+					items.append(job.output.get_nowait())
+				job.consumed(len(items))
+				chunk = []
+				for item in items:
+					if item is JOB_DONE or isinstance(item, BaseException) or not isinstance(item, str):
+						if len(chunk) > 0:
+							yield "".join(chunk)
+							chunk = []
+						if item is JOB_DONE:
+							return
+						if isinstance(item, BaseException):
+							raise item
+						yield item
+					else:
+						chunk.append(item)
+				if len(chunk) > 0:
+					yield "".join(chunk)
+		finally:
+			if watcher is not None:
+				watcher.cancel()
+			self.cancel(job)
+
+	@property
+	def busy(self) -> bool:
+		return len(self.running) > 0
+
+	# Stop accepting jobs, cancel the waiting and the running ones and wait up
+	# to timeout seconds (for all threads together) until the running ones have
+	# stopped. Returns False if some are still running. Called from the SIGTERM
+	# handler on the event loop thread, which is the only one draining the
+	# jobs' output, so a running job must not wait for its reader.
+	def close(self, timeout: float | None = None) -> bool:
+		self.closed = True
+		for job in self.scheduler.close():
+			self._forget(job)
+			job.emit(JOB_DONE)
+		for job in list(self.running):
+			job.cancel()
+		deadline = time.monotonic() + timeout if timeout is not None else None
+		for thread in self.threads:
+			if threading.current_thread() is not thread:
+				thread.join(max(0.0, deadline - time.monotonic()) if deadline is not None else None)
+		stopped = not any(thread.is_alive() for thread in self.threads if threading.current_thread() is not thread)
+		if not stopped and timeout:
+			print("Engine threads still running after", timeout, "s")
+		return stopped
+
+	def _run(self):
+		while True:
+			job = self.scheduler.pop()
+			if job is None:
+				break
+			if job.cancelled.is_set():
+				self.scheduler.done(job, 0, False)
+				self._forget(job)
+				job.emit(JOB_DONE)
+				continue
+			self.running.add(job)
+			started = time.monotonic()
+			completed = False
+			try:
+				items = job.run(job)
+				try:
+					for item in items:
+						if job.cancelled.is_set():
+							break
+						if not job.wait_for_reader(self.max_unread, self.stall_timeout):
+							print("Client stopped reading, cancelling generation")
+							job.cancelled.set()
+							break
+						job.emit(item)
+					else:
+						completed = True
+				finally:
+					close = getattr(items, "close", None)
+					if close is not None:
+						close()
+			except Exception as e:
+				print("Engine job failed:", e)
+				job.emit(e)
+			finally:
+				self.running.discard(job)
+				self.scheduler.done(job, time.monotonic() - started, completed)
+				self._forget(job)
+				job.emit(JOB_DONE)
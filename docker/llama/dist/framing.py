@@ -0,0 +1,108 @@
+import json
+import os
+import time
+from json.encoder import encode_basestring_ascii
+from typing import Iterator, NamedTuple
+
+class Frame(NamedTuple):
+	text: str
+	is_special: bool = False
+	is_tool: bool = False
+	is_error: bool = False
+
+def _suffix(is_special: bool, is_tool: bool, is_error: bool) -> str:
+	flag = lambda value: "true" if value else "false"
+	return f", \"is_special\": {flag(is_special)}, \"is_tool\": {flag(is_tool)}, \"is_error\": {flag(is_error)}}}\n"
+
+# Everything after the text is one of 8 constant strings, so a frame costs a
+# single string escape instead of a json.dumps() of a dict. The output is
+# byte-identical to json.dumps({"text": ..., "is_special": ..., ...}) + "\n".
+FRAME_SUFFIXES = {
+	(s, t, e): _suffix(s, t, e)
+	for s in (False, True) for t in (False, True) for e in (False, True)
+}
+
+def encode_frame(text: str, is_special: bool = False, is_tool: bool = False, is_error: bool = False) -> str:
+	return "{\"text\": " + encode_basestring_ascii(text) + FRAME_SUFFIXES[(is_special, is_tool, is_error)]
+
+def error_frame(text: str) -> str:
+	return encode_frame(text, is_error=True)
+
+# Merges consecutive plain text frames until window seconds have passed since
+# the first buffered one or max_bytes are buffered. Special, tool and error
+# frames are never delayed, they flush the buffered text and go out right away.
+# The first text frame is also sent right away to keep time-to-first-token.
+#
+# The window is checked when the next frame arrives, so text is held back for
+# at most one token interval beyond the window.
+def coalesce_frames(frames: Iterator[Frame], window: float, max_bytes: int) -> Iterator[str]:
+	pending = []
+	pending_bytes = 0
+	pending_since = 0.0
+	first = True
+	try:
+		for frame in frames:
+			if isinstance(frame, str):
+				# already encoded (e.g. the perf trailer), keeps its place in the stream
+				if len(pending) > 0:
+					yield encode_frame("".join(pending))
+					pending = []
+					pending_bytes = 0
+				yield frame
+				continue
+
+			if frame.is_special or frame.is_tool or frame.is_error:
+				if len(pending) > 0:
+					yield encode_frame("".join(pending))
+					pending = []
+					pending_bytes = 0
+				yield encode_frame(frame.text, frame.is_special, frame.is_tool, frame.is_error)
+				continue
+
+			if first:
+				first = False
+				yield encode_frame(frame.text)
+				continue
+
+			now = time.monotonic()
+			if len(pending) == 0:
+				pending_since = now
+			pending.append(frame.text)
+			pending_bytes += len(frame.text)
+			if pending_bytes >= max_bytes or now - pending_since >= window:
+				yield encode_frame("".join(pending))
+				pending = []
+				pending_bytes = 0
+
+		if len(pending) > 0:
+			yield encode_frame("".join(pending))
+	finally:
+		# stop the generation right away when the consumer goes away
+		close = getattr(frames, "close", None)
+		if close is not None:
+			close()
+
+def coalesce_from_env(frames: Iterator[Frame]) -> Iterator[str]:
+	window = float(os.environ.get("STREAM_COALESCE_MS", "20")) / 1000
+	max_bytes = int(os.environ.get("STREAM_COALESCE_BYTES", "64"))
+	if window <= 0 or max_bytes <= 1:
+		return (frame if isinstance(frame, str) else encode_frame(*frame) for frame in frames)
+	return coalesce_frames(frames, window, max_bytes)
+
+# Prefill progress of a long prompt, sent before the first text frame
+def progress_frame(done: int, total: int) -> str:
+	return "{\"progress\": {\"tokens\": " + str(done) + ", \"total\": " + str(total) + "}}\n"
+
+# Summarization of a tool output that does not fit the context, per finished
+# chunk, sent before the first text frame
+def summary_frame(done: int, total: int) -> str:
+	return "{\"summary\": {\"chunks\": " + str(done) + ", \"total\": " + str(total) + "}}\n"
+
+# What the context planner removed from the conversation and how many tokens
+# can still be generated, sent before the first token
+def context_frame(prompt_tokens: int, n_ctx: int, max_length: int, actions: list) -> str:
+	return "{\"context\": " + json.dumps({"prompt_tokens": prompt_tokens, "n_ctx": n_ctx, "max_length": max_length, "actions": actions}) + "}\n"
+
+# Timings of a finished generation, the last frame of the stream
+def perf_frame(perf: dict) -> str:
+	return "{\"perf\": " + json.dumps(perf) + "}\n"
@@ -1,69 +1,49 @@
 import json
-from typing import Dict, List
-from llama_cpp import Llama
-from fastapi import FastAPI, Request, Security, HTTPException
-from fastapi.responses import Response, StreamingResponse
-import numpy
-import signal
-import sys
+from typing import Dict, Iterator, List, Tuple
 import torch
 import os
-from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from threading import Event
+from registry import load_model
+from chat_template import TokenCache, canonical_tools
+from framing import Frame
+from pipeline import RequestPipeline
+from stop_matcher import StopMatcher
+from tool_results import ToolResultEncoder
+from tool_grammar import ToolGrammarCache, python_tool_call_grammar, trigger_pattern
 import re
 
-# Global stop event for graceful interruption of generation
-shutting_down = Event()
-
 device = "cuda" if torch.cuda.is_available() and os.environ.get("CUDA_ARCH", None) is not None else "cpu"
 
-model = None
-if device == "cuda":
-	model_size = os.environ.get("MODEL_SIZE", "medium")
-	if model_size == "medium":
-		model = Llama.from_pretrained(
-			repo_id="bartowski/google_gemma-3-27b-it-GGUF",
-			filename="google_gemma-3-27b-it-Q4_K_M.gguf",
-			flash_attn=True,
-			n_gpu_layers=-1, n_ctx=6000, n_batch=512, n_threads=8, device=device, verbose=True
-		)
-	elif model_size == "large":
-		model = Llama.from_pretrained(
-			repo_id="bartowski/google_gemma-3-27b-it-GGUF",
-			filename="google_gemma-3-27b-it-Q6_K.gguf",
-			flash_attn=True,
-			n_gpu_layers=-1, n_threads=6, n_ctx=42000, n_batch=512, device=device, verbose=True
-		)
-else:
-	model = Llama.from_pretrained(
-		repo_id="bartowski/google_gemma-3-12b-it-GGUF",
-		filename="google_gemma-3-12b-it-Q4_K_M.gguf",
-		flash_attn=True,
-		n_threads=8, n_ctx=4096, n_batch=512, device=device, verbose=True
-	)
-
-app = FastAPI()
-security = HTTPBasic()
-generating = False
+# Built-in profiles, downloaded from Hugging Face. A model manifest can map
+# the same profile names to local GGUF files instead (see registry.py). draft is
+# a small model with the same vocabulary for speculative decoding (SPECULATIVE=draft).
+profiles = {
+	"medium": {
+		"repo_id": "bartowski/google_gemma-3-27b-it-GGUF",
+		"filename": "google_gemma-3-27b-it-Q4_K_M.gguf",
+		"flash_attn": True,
+		"n_gpu_layers": -1, "n_ctx": 6000, "n_batch": 512, "n_threads": 8, "device": device, "verbose": True,
+		"draft": {"repo_id": "bartowski/google_gemma-3-1b-it-GGUF", "filename": "google_gemma-3-1b-it-Q4_K_M.gguf", "flash_attn": True, "n_gpu_layers": -1},
+	},
+	"large": {
+		"repo_id": "bartowski/google_gemma-3-27b-it-GGUF",
+		"filename": "google_gemma-3-27b-it-Q6_K.gguf",
+		"flash_attn": True,
+		"n_gpu_layers": -1, "n_threads": 6, "n_ctx": 42000, "n_batch": 512, "device": device, "verbose": True,
+		"draft": {"repo_id": "bartowski/google_gemma-3-1b-it-GGUF", "filename": "google_gemma-3-1b-it-Q4_K_M.gguf", "flash_attn": True, "n_gpu_layers": -1},
+	},
+	"cpu": {
+		"repo_id": "bartowski/google_gemma-3-12b-it-GGUF",
+		"filename": "google_gemma-3-12b-it-Q4_K_M.gguf",
+		"flash_attn": True,
+		"n_threads": 8, "n_ctx": 4096, "n_batch": 512, "device": device, "verbose": True,
+	},
+}
+loaded = load_model("gemma3", profiles, device)
+model = loaded.model
 
 eot_token_id = model.tokenize(b"<end_of_turn>", add_bos=False, special=True)[0]
 print("eot_token_id", eot_token_id)
 
-# Custom stopping criteria to stop generation after a certain number of tokens
-# or when the eos token is generated
-class CustomStoppingCriteria:
-	def __init__(self, max_length: int):
-		self.counter = 0
-		self.max_length = max_length
-
-	def __call__(self, input_ids: numpy.ndarray, score: numpy.ndarray, **kwargs) -> bool:
-		self.counter += 1
-		if input_ids[-1] == eot_token_id:
-			return True
-		if self.counter >= self.max_length:
-			return True
-		return shutting_down.is_set()
-
 tools_start = """
 At each turn, if you decide to invoke any of the function(s), it should be wrapped with ```tool_code```. The python methods described below are available. The generated code should be readable and efficient. The response to a method will be wrapped in ```tool_output``` use it to call more tools or generate a helpful, friendly response. When using a ```tool_call``` think step by step why and how it should be used.
 
@@ -119,6 +99,25 @@ model_agreement = """<start_of_turn>model
 I understand.
 <end_of_turn>\n"""
 
+tool_token_open = "```tool_code\n"
+tool_token_close = "\n```"
+
+# Tool call arguments are constrained to the request's tool schemas once the
+# model opens a tool call
+tool_grammars = ToolGrammarCache(
+	lambda tools: python_tool_call_grammar(tool_token_open, tool_token_close, tools),
+	trigger_patterns=[trigger_pattern(tool_token_open)],
+	trigger_tokens=[],
+)
+
+token_cache = TokenCache(model)
+tool_results = ToolResultEncoder.from_env("gemma3", lambda text: len(model.tokenize(text.encode('utf-8'), add_bos=False)))
+token_cache.precompile([
+	b"<start_of_turn>user\n", b"<start_of_turn>model\n", b"<end_of_turn>\n", b"\n<end_of_turn>\n",
+	b"<end_of_turn>\n" + model_agreement.encode('utf-8'),
+])
+token_cache.constant(b"<start_of_turn>user\n", add_bos=True)
+
 def get_tool_instructions(tools: List[Dict[str, str]]):
 	tool_strings = []
 	for tool in tools:
@@ -215,7 +214,8 @@ def format_tool_call(tool_call: Dict[str, str]):
 	argstr = ", ".join(args)
 	return "```tool_code\n" + function_name + "(" + argstr + ")\n```\n"
 
-# Tokenize the messages and tools
+# Tokenize the messages and tools, also returns the token offsets at which the
+# system block and each message end
 def tokenize(messages: List[Dict[str, str]], tools: List[Dict[str, str]] | None):
 	if len(messages) == 0:
 		raise ValueError("No messages provided")
@@ -224,228 +224,122 @@ def tokenize(messages: List[Dict[str, str]], tools: List[Dict[str, str]] | None)
 	if messages[1].get("role") != "user":
 		raise ValueError("Second message must be a user message")
 	
-	token_ids = model.tokenize(b"<start_of_turn>user\n", add_bos=True, special=True)
-	token_ids.extend(model.tokenize(messages[0].get("content").encode('utf-8') + b"\n", add_bos=False, special=False))
+	token_ids = list(token_cache.constant(b"<start_of_turn>user\n", add_bos=True))
+	token_ids.extend(token_cache.text(messages[0].get("content").encode('utf-8') + b"\n"))
 
-	tool_instructions = get_tool_instructions(tools)
+	tool_instructions = get_tool_instructions(canonical_tools(tools))
 	if len(tool_instructions) > 0:
-		token_ids.extend(model.tokenize(tool_instructions.encode('utf-8'), add_bos=False, special=False))
+		token_ids.extend(token_cache.text(tool_instructions))
 
-	token_ids.extend(model.tokenize(b"<end_of_turn>\n" + model_agreement.encode('utf-8'), add_bos=False, special=True))
+	token_ids.extend(token_cache.constant(b"<end_of_turn>\n" + model_agreement.encode('utf-8')))
+	boundaries = [len(token_ids)]
 
 	for message in messages[1:]:
 		if message.get("role") == "user":
-			token_ids.extend(model.tokenize(b"<start_of_turn>user\n", add_bos=False, special=True))
-			token_ids.extend(model.tokenize(message.get("content").encode('utf-8'), add_bos=False, special=False))
-			token_ids.extend(model.tokenize(b"<end_of_turn>\n", add_bos=False, special=True))
+			token_ids.extend(token_cache.constant(b"<start_of_turn>user\n"))
+			token_ids.extend(token_cache.text(message.get("content")))
+			token_ids.extend(token_cache.constant(b"<end_of_turn>\n"))
 		elif message.get("role") == "assistant":
-			token_ids.extend(model.tokenize(b"<start_of_turn>model\n", add_bos=False, special=True))
+			token_ids.extend(token_cache.constant(b"<start_of_turn>model\n"))
 			assistant_content = message.get("content", "")
 			assistant_tool_calls = message.get("tool_calls")
 			if assistant_tool_calls is not None:
 				if assistant_content != "" and not assistant_content.endswith("\n"):
 					assistant_content += "\n"
 				assistant_content += "".join([format_tool_call(tool_call) for tool_call in assistant_tool_calls])
-			token_ids.extend(model.tokenize(assistant_content.encode('utf-8'), add_bos=False, special=False))
-			token_ids.extend(model.tokenize(b"<end_of_turn>\n" if assistant_content.endswith("\n") else b"\n<end_of_turn>\n", add_bos=False, special=True))
+			token_ids.extend(token_cache.text(assistant_content))
+			token_ids.extend(token_cache.constant(b"<end_of_turn>\n" if assistant_content.endswith("\n") else b"\n<end_of_turn>\n"))
 		elif message.get("role") == "tool":
 			# tool results are a JSON stringified list of tool results
-			tool_results = json.loads(message.get("content"))
-			if isinstance(tool_results, list):
-				token_ids.extend(model.tokenize(b"<start_of_turn>user\n", add_bos=False, special=True))
-				for tool_result in tool_results:
-					tool_result_str = json.dumps(tool_result)
-					token_ids.extend(model.tokenize(
+			compact = tool_results.encode(message.get("content"))
+			results = [compact] if compact is not None else json.loads(message.get("content"))
+			if isinstance(results, list):
+				token_ids.extend(token_cache.constant(b"<start_of_turn>user\n"))
+				for tool_result in results:
+					tool_result_str = tool_result if compact is not None else json.dumps(tool_result)
+					token_ids.extend(token_cache.text(
 						b"```tool_output\n" +
 						tool_result_str.encode('utf-8') +
-						(b"```\n" if tool_result_str.endswith("\n") else b"\n```\n"),
-						add_bos=False, special=False)
-					)
-				token_ids.extend(model.tokenize(b"\n<end_of_turn>\n", add_bos=False, special=True))
+						(b"```\n" if tool_result_str.endswith("\n") else b"\n```\n")
+					))
+				token_ids.extend(token_cache.constant(b"\n<end_of_turn>\n"))
 			else:
 				raise ValueError("Invalid tool results: " + message.get("content"))
 		else:
 			raise ValueError("Invalid message role: " + message.get("role"))
+		boundaries.append(len(token_ids))
 
-	token_ids.extend(model.tokenize(b"<start_of_turn>model\n", add_bos=False, special=True))		
+	token_ids.extend(token_cache.constant(b"<start_of_turn>model\n"))
 	# print(model.detokenize(token_ids, special=True).decode('utf-8'))
 
-	return token_ids
-
-correct_username = os.getenv("AI_USERNAME")
-correct_password = os.getenv("AI_PASSWORD")
-
-# Dummy function to check credentials
-def authenticate(credentials: HTTPBasicCredentials):
-    if not (credentials.username == correct_username and 
-            credentials.password == correct_password):
-        raise HTTPException(
-            status_code=401,
-            detail="Incorrect username or password",
-            headers={"WWW-Authenticate": "Basic"},
-        )
-    return credentials
-
-@app.post("/generate")
-async def generate_text(request: Request, credentials: HTTPBasicCredentials = Security(security)):
-	authenticate(credentials)
-	request = await request.json()
-	# print(pprint.pformat(request))
-	messages = request.get("messages")
-	tools = request.get("tools")
-	if len(tools) == 0:
-		tools = None
+	return token_ids, boundaries
 
-	if len(messages) == 0:
-		return Response(status_code=400, content="No messages provided")
-	
-	async def stream_tokens():
-		global shutting_down
-		global generating
-		if shutting_down.is_set():
-			error_result = json.dumps({"text": "Error: Server is shutting down", "is_special": False, "is_tool": False, "is_error": True})
-			yield f"{error_result}\n"
+
+# Turns the generated pieces into frames: text until the ```tool_code opener,
+# which can end in the middle of a token, the calls until the closing ```
+def parse(pieces: Iterator[Tuple[int | None, str, bool]], stop: List[str]) -> Iterator[Frame]:
+	is_tool = False
+	tool_string = ""
+	text_matcher = StopMatcher([tool_token_open] + stop)
+	tool_matcher = StopMatcher([tool_token_close])
+	for token_id, text, is_special in pieces:
+		if is_special:
+			if token_id != eot_token_id:
+				yield Frame(text, is_special=True)
+			continue
+
+		if text == "":
+			continue
+
+		if not is_tool:
+			text, matched = text_matcher.push(text)
+			if text != "":
+				yield Frame(text)
+			if matched is None:
+				continue
+			if matched != tool_token_open:
+				# stop sequence
+				return
+			is_tool = True
+			text = text_matcher.remainder
+
+		code, matched = tool_matcher.push(text)
+		tool_string += code
+		if matched is not None:
+			# the call is complete, whatever the model would say next is
+			# thrown away by the backend anyway
+			tool_call = tool_string
+			try:
+				tool_call = parse_tool_call(tool_call)
+			except Exception as e:
+				print("Error parsing tool call: " + tool_call)
+				print(e)
+				pass
+			yield Frame(tool_call, is_tool=True)
 			return
 
-		try:
-			tokens = tokenize(messages, tools)
-			all_token_ids = [t for t in tokens]
-			generating = True
-
-			print("Generation started, num tokens:", len(all_token_ids))
-
-			generate_result = model.generate(
-				tokens,
-				top_k=64,
-				top_p=0.95,
-				min_p=0.01,
-				temp=1.0,
-				repeat_penalty=1.0,
-				stopping_criteria=CustomStoppingCriteria(max_length=2048)
-			)
-			is_tool = False
-			tool_token_partial = ""
-			tool_token_open = "```tool_code\n"
-			tool_token_close = "\n```"
-			tool_string = ""
-
-			gathering = False
-			gathering_tokens = []
-			for token_id in generate_result:
-				try:
-					if gathering:
-						try:
-							gathered_tokens.append(token_id)
-							result_text = model.detokenize(gathered_tokens, prev_tokens=all_token_ids, special=False).decode('utf-8')
-							all_token_ids.extend(gathered_tokens)
-							gathered_tokens = []
-							gathering = False
-							if is_tool:
-								tool_token_partial = tool_token_partial + result_text
-							else:
-								result = json.dumps({"text": result_text, "is_special": False, "is_tool": False, "is_error": False})
-								yield f"{result}\n"
-						except Exception as e:
-							print(e)
-							pass
-
-					else:
-						text = model.detokenize([token_id], prev_tokens=all_token_ids, special=False) #  prev_tokens=all_token_ids ?
-						text_special = model.detokenize([token_id], prev_tokens=all_token_ids, special=True)
-						all_token_ids.append(token_id)
-						is_special = text != text_special
-
-						new_partial = tool_token_partial + text.decode('utf-8')
-
-						if is_special:
-							if token_id != eot_token_id:
-								result = json.dumps({"text": text_special.decode('utf-8'), "is_special": True, "is_tool": False, "is_error": False})
-								yield f"{result}\n"
-
-						elif is_tool:
-							if new_partial.startswith(tool_token_close):
-								tool_call = tool_string
-								try:
-									tool_call = parse_tool_call(tool_call)
-								except Exception as e:
-									print("Error parsing tool call: " + tool_call)
-									print(e)
-									pass
-
-								is_tool = False
-								tool_string = ""
-								tool_token_partial = ""
-								result = json.dumps({"text": tool_call, "is_special": False, "is_tool": True, "is_error": False})
-								yield f"{result}\n"
-
-							elif tool_token_close.startswith(new_partial):
-								tool_token_partial = new_partial
-
-							else:
-								tool_string += new_partial
-								tool_token_partial = ""
-
-						else:
-							if new_partial.startswith(tool_token_open):
-								tool_token_partial = ""
-								is_tool = True
-
-							elif tool_token_open.startswith(new_partial):
-								tool_token_partial = new_partial
-
-							else:
-								tool_token_partial = ""
-								result = json.dumps({"text": new_partial, "is_special": False, "is_tool": False, "is_error": False})
-								yield f"{result}\n"
-
-				except Exception as e:
-					print(e)
-					if isinstance(e, UnicodeDecodeError):
-						gathering = True
-						gathering_tokens.append(token_id)
-					else:
-						raise e
-
-			print("Generation finished, num tokens:", len(all_token_ids))
+	if is_tool:
+		# cut off by max_length, the backend gets what there is
+		tool_string += tool_matcher.flush()
+		if tool_string != "":
+			yield Frame(tool_string, is_tool=True)
+	else:
+		held = text_matcher.flush()
+		if held != "":
+			yield Frame(held)
+
+pipeline = RequestPipeline(
+	"gemma3",
+	loaded,
+	tokenize,
+	parse,
+	eos_token_id=eot_token_id,
+	sampling={"top_k": 64, "top_p": 0.95, "min_p": 0.01, "temp": 1.0},
+	token_cache=token_cache,
+	tool_results=tool_results,
+	tool_grammars=tool_grammars,
+)
+app = pipeline.app
 
-		except Exception as e:
-			print(e)
-			if not shutting_down.is_set():
-				error_result = json.dumps({"text": "Error: " + str(e), "is_special": False, "is_tool": False, "is_error": True})
-				yield f"{error_result}\n"
-		finally:
-			generating = False
-			if shutting_down.is_set():
-				cleanup_handler()
-
-	return StreamingResponse(stream_tokens(), media_type="text/event-stream")
-
-# @app.post("/interrupt")
-# async def interrupt_stream(request: Request):
-#     request_id = await request.json().get("request_id")
-#     if request_id in active_streams:
-#         del active_streams[request_id]
-#         return {"message": "Stream interrupted"}
-#     else:
-#         return {"error": "Request not found"}
-
-def shutdown_handler(signum, frame):
-	global shutting_down
-	shutting_down.set()
-	print("Shutting down...")
-	if not generating:
-		cleanup_handler()
-
-def cleanup_handler():
-	model.reset()
-	model.close()
-	print("Model closed")
-	sys.exit(0)
-
-signal.signal(signal.SIGTERM, shutdown_handler)
-signal.signal(signal.SIGINT, shutdown_handler)
-
-# Run the server
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8443)
+    pipeline.run()
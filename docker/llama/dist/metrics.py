@@ -0,0 +1,284 @@
+import contextlib
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Tuple
+import llama_cpp
+
+# Prometheus text exposition without the client library. Every sample carries
+# the model_profile (see registry.profile_name()) and model_family labels.
+
+def _labels(pairs: List[Tuple[str, str]]) -> str:
+	if len(pairs) == 0:
+		return ""
+	return "{" + ",".join(k + "=\"" + str(v).replace("\\", "\\\\").replace("\"", "\\\"") + "\"" for k, v in pairs) + "}"
+
+def _number(value: float) -> str:
+	if value == float("inf"):
+		return "+Inf"
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return repr(value)
+
+class Counter:
+	def __init__(self, name: str, help: str, label: str | None = None):
+		self.name = name
+		self.help = help
+		self.label = label
+		# an unlabelled counter is exported as 0 before its first increment
+		self.values: Dict[str, float] = {} if label is not None else {"": 0}
+
+	def inc(self, value: float = 1, label: str = ""):
+		self.values[label] = self.values.get(label, 0) + value
+
+	def render(self, const: List[Tuple[str, str]]) -> List[str]:
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+		for label, value in sorted(self.values.items()):
+			pairs = const + ([(self.label, label)] if self.label is not None else [])
+			lines.append(self.name + _labels(pairs) + " " + _number(value))
+		return lines
+
+class Histogram:
+	def __init__(self, name: str, help: str, buckets: List[float]):
+		self.name = name
+		self.help = help
+		self.buckets = buckets + [float("inf")]
+		self.counts = [0] * len(self.buckets)
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value: float):
+		for i, bound in enumerate(self.buckets):
+			if value <= bound:
+				self.counts[i] += 1
+				break
+		self.sum += value
+		self.count += 1
+
+	def render(self, const: List[Tuple[str, str]]) -> List[str]:
+		lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+		cumulative = 0
+		for bound, count in zip(self.buckets, self.counts):
+			cumulative += count
+			lines.append(self.name + "_bucket" + _labels(const + [("le", _number(bound))]) + " " + str(cumulative))
+		lines.append(self.name + "_sum" + _labels(const) + " " + _number(self.sum))
+		lines.append(self.name + "_count" + _labels(const) + " " + str(self.count))
+		return lines
+
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+RATE_BUCKETS = [1, 2, 5, 10, 20, 35, 50, 75, 100, 200, 500, 1000, 2000, 5000, 10000]
+RATIO_BUCKETS = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 1]
+
+# stats() keys that only ever grow
+STATS_COUNTERS = {"hits", "misses", "evictions", "saved_tokens", "steps", "decoded_tokens", "encoded", "tokens_before", "tokens_after", "summarized", "chunks"}
+
+# Size of the KV cache llama.cpp allocates for the context, from the GGUF
+# metadata (f16 cells, the default cache type)
+def kv_cache_bytes(model) -> int:
+	try:
+		metadata = model.metadata
+		arch = metadata["general.architecture"]
+		n_layer = int(metadata[arch + ".block_count"])
+		n_embd = int(metadata[arch + ".embedding_length"])
+		n_head = int(metadata[arch + ".attention.head_count"])
+		n_head_kv = int(metadata.get(arch + ".attention.head_count_kv", n_head))
+		k_length = int(metadata.get(arch + ".attention.key_length", n_embd // n_head))
+		v_length = int(metadata.get(arch + ".attention.value_length", n_embd // n_head))
+		return model.n_ctx() * n_layer * n_head_kv * (k_length + v_length) * 2
+	except Exception as e:
+		print("Error estimating KV cache size:", e)
+		return 0
+
+# llama.cpp's own counters of the context, they add up over all requests
+def llama_perf(model) -> Dict[str, float]:
+	data = llama_cpp.llama_perf_context(model._ctx.ctx)
+	return {
+		"prompt_eval_ms": data.t_p_eval_ms,
+		"prompt_eval_tokens": data.n_p_eval,
+		"eval_ms": data.t_eval_ms,
+		"eval_tokens": data.n_eval,
+	}
+
+def resident_bytes() -> int:
+	try:
+		with open("/proc/self/statm") as f:
+			return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except Exception:
+		return 0
+
+# One request's measurements. The generating thread only sets attributes on
+# its own instance while it decodes; the shared histograms are updated once
+# per request in finish(), so the per-token path never takes a lock.
+class RequestMetrics:
+	def __init__(self, metrics: "ServerMetrics", enqueued_at: float):
+		self.metrics = metrics
+		self.enqueued_at = enqueued_at
+		self.started = time.monotonic()
+		self.first_token_at = 0.0
+		self.prompt_tokens = 0
+		self.prefill_tokens = 0
+		self.completion_tokens = 0
+		self.tool_call = False
+		# seconds per phase (tokenize, prefill)
+		self.phases: Dict[str, float] = {}
+		# seconds spent in the token iterator after the first token
+		self.decode_time = 0.0
+		# seconds between getting a token and asking for the next one
+		self.loop_time = 0.0
+		self.llama_model = None
+		self.llama_before: Dict[str, float] | None = None
+		# speculative.SpeculativeStats of the decode loop, if it drafts
+		self.speculative = None
+
+	@contextlib.contextmanager
+	def phase(self, name: str):
+		started = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - started
+
+	# Snapshot of llama.cpp's counters, only meaningful while the request has
+	# the context to itself (not with the batch engine)
+	def llama_begin(self, model):
+		self.llama_model = model
+		self.llama_before = llama_perf(model)
+
+	# Yields the generated tokens, timing the token iterator (decode and
+	# sampling) apart from the caller's handling of each token (detokenizing,
+	# stop sequences, framing, handing it to the client). The first token
+	# counts as prefill, it waits for the last prompt token's evaluation, on
+	# the batch path for the whole prompt.
+	def timed(self, tokens: Iterator[int]) -> Iterator[int]:
+		tokens = iter(tokens)
+		while True:
+			started = time.perf_counter()
+			try:
+				token = next(tokens)
+			except StopIteration:
+				self.decode_time += time.perf_counter() - started
+				return
+			got = time.perf_counter()
+			if self.completion_tokens == 0:
+				self.first_token_at = time.monotonic()
+				self.phases["prefill"] = self.phases.get("prefill", 0.0) + got - started
+			else:
+				self.decode_time += got - started
+			self.completion_tokens += 1
+			yield token
+			self.loop_time += time.perf_counter() - got
+
+	# Timings for the perf trailer. client_wait is the time the engine thread
+	# was blocked on the client, it is part of loop_time.
+	def perf(self, client_wait: float) -> dict:
+		ms = lambda seconds: round(seconds * 1000, 2)
+		perf = {"queue_ms": ms(self.started - self.enqueued_at)}
+		for name, seconds in self.phases.items():
+			perf[name + "_ms"] = ms(seconds)
+		perf["decode_ms"] = ms(self.decode_time)
+		perf["handling_ms"] = ms(max(0.0, self.loop_time - client_wait))
+		perf["client_wait_ms"] = ms(client_wait)
+		perf["total_ms"] = ms(time.monotonic() - self.enqueued_at)
+		perf["prompt_tokens"] = self.prompt_tokens
+		perf["prefill_tokens"] = self.prefill_tokens
+		perf["completion_tokens"] = self.completion_tokens
+		if self.speculative is not None:
+			perf["speculative"] = self.speculative.perf()
+		if self.llama_before is not None:
+			after = llama_perf(self.llama_model)
+			perf["llama"] = {k: round(after[k] - self.llama_before[k], 2) for k in after}
+		return perf
+
+	# outcome: completed, cancelled or error
+	def finish(self, outcome: str):
+		self.metrics.record(self, outcome, time.monotonic())
+
+class ServerMetrics:
+	def __init__(self, family: str, profile: str, n_ctx: int):
+		self.const = [("model_profile", profile), ("model_family", family)]
+		self.n_ctx = n_ctx
+		self.lock = threading.Lock()
+		self.requests = Counter("llama_requests_total", "Finished generations by outcome (completed, cancelled, error).", "outcome")
+		self.tool_calls = Counter("llama_tool_calls_total", "Generations that ended with a tool call.")
+		self.prompt_tokens = Counter("llama_prompt_tokens_total", "Prompt tokens of finished generations.")
+		self.prefill_tokens = Counter("llama_prefill_tokens_total", "Prompt tokens that had to be evaluated (not reused from a cache).")
+		self.completion_tokens = Counter("llama_completion_tokens_total", "Generated tokens.")
+		self.queue_wait = Histogram("llama_queue_wait_seconds", "Time from submission until an engine thread picked the request up.", LATENCY_BUCKETS)
+		self.ttft = Histogram("llama_time_to_first_token_seconds", "Time from submission to the first generated token.", LATENCY_BUCKETS)
+		self.prefill_rate = Histogram("llama_prefill_tokens_per_second", "Evaluated prompt tokens per second until the first token.", RATE_BUCKETS)
+		self.decode_rate = Histogram("llama_decode_tokens_per_second", "Generated tokens per second after the first token.", RATE_BUCKETS)
+		self.utilization = Histogram("llama_context_utilization_ratio", "Prompt plus generated tokens relative to n_ctx.", RATIO_BUCKETS)
+		self.drafted = Counter("llama_speculative_drafted_tokens_total", "Tokens proposed by speculative decoding.")
+		self.accepted = Counter("llama_speculative_accepted_tokens_total", "Proposed tokens that matched the model's own sample.")
+		self.acceptance = Histogram("llama_speculative_acceptance_ratio", "Accepted relative to drafted tokens, per request that drafted.", RATIO_BUCKETS)
+		self.gauges: List[Tuple[str, str, Callable[[], float]]] = []
+		self.stats: List[Tuple[str, Callable[[], dict]]] = []
+		self.gauge("llama_context_size_tokens", "n_ctx of the model context.", lambda: self.n_ctx)
+		self.gauge("llama_process_resident_bytes", "Resident set size of the server process.", resident_bytes)
+		self.gauge("llama_process_cpu_seconds", "CPU time used by the server process.", time.process_time)
+
+	@classmethod
+	def for_model(cls, family: str, loaded):
+		metrics = cls(family, loaded.profile, loaded.model.n_ctx())
+		kv_bytes = kv_cache_bytes(loaded.model)
+		metrics.gauge("llama_kv_cache_bytes", "Bytes allocated for the KV cache.", lambda: kv_bytes)
+		metrics.gauge("llama_model_load_seconds", "Time it took to load the model at startup.", lambda: loaded.load_seconds)
+		return metrics
+
+	# value() is called on every scrape
+	def gauge(self, name: str, help: str, value: Callable[[], float]):
+		self.gauges.append((name, help, value))
+
+	# Exposes the numbers of a stats() dict as <prefix>_<key>
+	def add_stats(self, prefix: str, stats: Callable[[], dict]):
+		self.stats.append((prefix, stats))
+
+	def start(self, enqueued_at: float) -> RequestMetrics:
+		return RequestMetrics(self, enqueued_at)
+
+	def record(self, request: RequestMetrics, outcome: str, now: float):
+		with self.lock:
+			self.requests.inc(label=outcome)
+			if request.tool_call:
+				self.tool_calls.inc()
+			self.prompt_tokens.inc(request.prompt_tokens)
+			self.prefill_tokens.inc(request.prefill_tokens)
+			self.completion_tokens.inc(request.completion_tokens)
+			self.queue_wait.observe(request.started - request.enqueued_at)
+			if request.completion_tokens > 0:
+				self.ttft.observe(request.first_token_at - request.enqueued_at)
+				prefill_time = request.first_token_at - request.started
+				if prefill_time > 0 and request.prefill_tokens > 0:
+					self.prefill_rate.observe(request.prefill_tokens / prefill_time)
+				decode_time = now - request.first_token_at
+				if decode_time > 0 and request.completion_tokens > 1:
+					self.decode_rate.observe((request.completion_tokens - 1) / decode_time)
+			if self.n_ctx > 0:
+				self.utilization.observe((request.prompt_tokens + request.completion_tokens) / self.n_ctx)
+			if request.speculative is not None and request.speculative.drafted > 0:
+				self.drafted.inc(request.speculative.drafted)
+				self.accepted.inc(request.speculative.accepted)
+				self.acceptance.observe(request.speculative.acceptance_rate)
+
+	def render(self) -> str:
+		lines = []
+		with self.lock:
+			for metric in (
+				self.requests, self.tool_calls, self.prompt_tokens, self.prefill_tokens, self.completion_tokens,
+				self.queue_wait, self.ttft, self.prefill_rate, self.decode_rate, self.utilization,
+				self.drafted, self.accepted, self.acceptance,
+			):
+				lines.extend(metric.render(self.const))
+		for name, help, value in self.gauges:
+			lines.append(f"# HELP {name} {help}")
+			lines.append(f"# TYPE {name} gauge")
+			lines.append(name + _labels(self.const) + " " + _number(value()))
+		for prefix, stats in self.stats:
+			for key, value in stats().items():
+				if not isinstance(value, (int, float)):
+					continue
+				counter = key in STATS_COUNTERS
+				name = prefix + "_" + key + ("_total" if counter else "")
+				lines.append(f"# TYPE {name} {'counter' if counter else 'gauge'}")
+				lines.append(name + _labels(self.const) + " " + _number(value))
+		return "\n".join(lines) + "\n"
@@ -0,0 +1,397 @@
+import functools
+import os
+import signal
+import sys
+import uuid
+from typing import Callable, Dict, Iterator, List, Tuple
+import numpy
+from fastapi import FastAPI, Request, Security, HTTPException
+from fastapi.responses import Response, StreamingResponse
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from threading import Event
+from engine import Engine, EngineJob
+from metrics import ServerMetrics
+from profiling import SamplingProfiler
+from resumable import ResumableStreams, StreamGone
+from batching import BatchEngine
+from scheduler import QueueFullError, MAX_PRIORITY, estimate_tokens
+from prefix_cache import PrefixCache
+from sessions import SessionStore
+from snapshot_store import SnapshotStore, warmup
+from detokenizer import PieceTable, StreamDetokenizer
+from context_planner import ContextPlanner
+from framing import Frame, coalesce_from_env, context_frame, error_frame, perf_frame, progress_frame, summary_frame
+from prefill import ChunkedPrefill, prefill_chunk_from_env
+from speculative import Speculation, SpeculativeStats
+from tool_summarizer import ToolSummarizer
+
+# Sampling of the tool output summaries, the same for every model family
+SUMMARY_SAMPLING = {"top_k": 40, "top_p": 0.95, "temp": 0.15}
+
+correct_username = os.getenv("AI_USERNAME")
+correct_password = os.getenv("AI_PASSWORD")
+
+# Dummy function to check credentials
+def authenticate(credentials: HTTPBasicCredentials):
+    if not (credentials.username == correct_username and
+            credentials.password == correct_password):
+        raise HTTPException(
+            status_code=401,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Basic"},
+        )
+    return credentials
+
+# Custom stopping criteria to stop generation after a certain number of tokens
+# or when the eos token is generated
+class CustomStoppingCriteria:
+	def __init__(self, eos_token_id: int, max_length: int, cancelled: Event, shutting_down: Event):
+		self.counter = 0
+		self.eos_token_id = eos_token_id
+		self.max_length = max_length
+		self.cancelled = cancelled
+		self.shutting_down = shutting_down
+
+	def __call__(self, input_ids: numpy.ndarray, score: numpy.ndarray, **kwargs) -> bool:
+		self.counter += 1
+		if input_ids[-1] == self.eos_token_id:
+			return True
+		if self.counter >= self.max_length:
+			return True
+		return self.shutting_down.is_set() or self.cancelled.is_set()
+
+# The request pipeline shared by qwen.py, mistral.py and gemma3.py: the
+# engines and caches, /generate and the other endpoints, metrics and shutdown.
+# A server only brings what depends on its model family:
+#   tokenize(messages, tools) -> (tokens, boundaries), its chat template, also
+#     returns the token offsets at which the system block and each message end
+#   parse(pieces, stop) -> frames, turns the generated (token_id, text,
+#     is_special) pieces into text and tool call frames; it returns after a
+#     complete tool call or a stop sequence and the generation ends there
+#   eos_token_id, the sampling parameters and the token cache, tool result
+#     encoder and tool grammars used by its template (for /metrics)
+class RequestPipeline:
+	def __init__(
+		self,
+		family: str,
+		loaded,
+		tokenize: Callable[[List[Dict[str, str]], List[Dict[str, str]] | None], Tuple[List[int], List[int]]],
+		parse: Callable[[Iterator[Tuple[int | None, str, bool]], List[str]], Iterator[Frame]],
+		eos_token_id: int,
+		sampling: Dict[str, float],
+		token_cache,
+		tool_results,
+		tool_grammars,
+	):
+		self.loaded = loaded
+		self.model = model = loaded.model
+		self.tokenize = tokenize
+		self.parse = parse
+		self.eos_token_id = eos_token_id
+		self.sampling = sampling
+		self.tool_results = tool_results
+		self.tool_grammars = tool_grammars
+		# Global stop event for graceful interruption of generation
+		self.shutting_down = Event()
+
+		self.batch_engine = batch_engine = BatchEngine.from_env(model)
+		self.engine = Engine(model, workers=batch_engine.n_slots if batch_engine is not None else 1)
+		self.streams = ResumableStreams.from_env(self.engine)
+		self.prefix_cache = PrefixCache.from_env()
+		self.session_store = SessionStore.from_env()
+		self.prefill_chunk = prefill_chunk_from_env()
+		# a batch slot only holds its share of the context
+		self.context_planner = ContextPlanner.from_env(batch_engine.slot_size if batch_engine is not None else model.n_ctx())
+		self.tool_summarizer = ToolSummarizer.from_env(self.context_planner.n_ctx, batched=batch_engine is not None)
+		self.speculation = Speculation.from_env(model, loaded.draft) if batch_engine is None else None
+		self.piece_table = PieceTable(model)
+
+		# Bring back the prefix snapshots of the previous run and prefill the known
+		# templates. This runs before the server accepts requests, so the engine
+		# thread is still idle. Snapshots hold a single sequence context, they are not
+		# used with the batch engine.
+		if batch_engine is None:
+			self.prefix_cache.store = SnapshotStore.from_env(model)
+			warmup(model, self.prefix_cache, self.prefix_cache.store, tokenize, os.environ.get("WARMUP_MANIFEST", "/data/warmup.json"))
+
+		self.metrics = ServerMetrics.for_model(family, loaded)
+		self.metrics.gauge("llama_queue_length", "Requests waiting for an engine thread.", lambda: len(self.engine.scheduler.heap))
+		self.metrics.add_stats("llama_prefix_cache", self.prefix_cache.stats)
+		self.metrics.add_stats("llama_session_cache", self.session_store.stats)
+		self.metrics.add_stats("llama_token_cache", token_cache.stats)
+		self.metrics.add_stats("llama_tool_results", tool_results.stats)
+		self.metrics.add_stats("llama_tool_summaries", self.tool_summarizer.stats)
+		self.metrics.add_stats("llama_tool_grammar_cache", tool_grammars.stats)
+		if batch_engine is not None:
+			self.metrics.add_stats("llama_batch", batch_engine.stats)
+		self.profiler = SamplingProfiler.from_env([batch_engine.thread] if batch_engine is not None else [])
+
+		self.app = FastAPI()
+		self._add_routes(self.app, HTTPBasic())
+
+		signal.signal(signal.SIGTERM, self.shutdown_handler)
+		signal.signal(signal.SIGINT, self.shutdown_handler)
+
+	def stopping_criteria(self, max_length: int, cancelled: Event) -> CustomStoppingCriteria:
+		return CustomStoppingCriteria(self.eos_token_id, max_length, cancelled, self.shutting_down)
+
+	# Starts the summary of one chunk of an oversized tool output (see
+	# tool_summarizer.py) and returns its tokens. Without the batch engine the
+	# prompt is evaluated right away; the summarization system prompt stays in
+	# the context from one chunk to the next. It is shorter than
+	# PREFIX_CACHE_MIN_TOKENS, so it is not snapshotted: evaluating ~100 tokens
+	# again after another request costs less than keeping a state for them.
+	def start_summary(self, summary_messages: List[Dict[str, str]], cancelled: Event):
+		tokens, boundaries = self.tokenize(summary_messages, None)
+		stopping_criteria = self.stopping_criteria(self.tool_summarizer.summary_tokens, cancelled)
+		if self.batch_engine is not None:
+			return self.batch_engine.generate(tokens, **SUMMARY_SAMPLING, stopping_criteria=stopping_criteria)
+		prefill = ChunkedPrefill(self.model, len(tokens), self.prefill_chunk, lambda done, total: None, lambda: self.shutting_down.is_set() or cancelled.is_set())
+		self.prefix_cache.prepare(self.model, tokens, boundaries[:1], prefill.eval)
+		prefill.run(tokens)
+		return self.speculation.generate(self.model, tokens, **SUMMARY_SAMPLING, repeat_penalty=1.0, stopping_criteria=stopping_criteria)
+
+	def detokenize_summary(self, token_ids: List[int]) -> str:
+		return self.model.detokenize(token_ids).decode('utf-8', errors='ignore')
+
+	# multi-byte characters (e.g. emojis) can span several tokens, the
+	# detokenizer returns "" until they are complete. When the generation ends
+	# on an incomplete character, its replacement comes last as a text piece
+	# without token (None), so it goes through the stop matcher or the tool
+	# call like any other text.
+	def pieces(self, token_ids: Iterator[int], all_token_ids: List[int]) -> Iterator[Tuple[int | None, str, bool]]:
+		detokenizer = StreamDetokenizer(self.piece_table)
+		for token_id in token_ids:
+			all_token_ids.append(token_id)
+			text, is_special = detokenizer.push(token_id)
+			yield token_id, text, is_special
+		text = detokenizer.flush()
+		if text != "":
+			yield None, text, False
+
+	# Runs on an engine thread, which owns the model for the whole generation
+	# (or feeds one slot of the batch engine). Yields frames, which are
+	# coalesced and encoded before they are streamed.
+	def generate_frames(self, job: EngineJob, messages, tools, stop: List[str], session_id: str | None, max_length: int):
+		model = self.model
+		batch_engine = self.batch_engine
+		cancelled = lambda: self.shutting_down.is_set() or job.cancelled.is_set()
+		all_token_ids = []
+		request_metrics = self.metrics.start(job.enqueued_at)
+		outcome = "completed"
+		tool_called = False
+		sampler = self.profiler.start(job.request_id)
+		try:
+			# tool outputs of this turn that are too large are replaced by summaries
+			with request_metrics.phase("summarize"):
+				summarized, actions = self.tool_summarizer.apply(
+					messages,
+					tools,
+					self.tokenize,
+					self.tool_results.count_tokens,
+					lambda summary_messages: self.start_summary(summary_messages, job.cancelled),
+					self.detokenize_summary,
+					lambda done, total: job.emit(summary_frame(done, total)),
+					cancelled,
+				)
+			with request_metrics.phase("tokenize"):
+				plan = self.context_planner.plan(summarized, tools, self.tokenize, max_length)
+			tokens, boundaries = plan.tokens, plan.boundaries
+			actions = actions + plan.actions
+			if len(actions) > 0 or plan.max_length < max_length:
+				print("Context compacted:", actions, "max_length:", plan.max_length)
+				yield context_frame(len(tokens), self.context_planner.n_ctx, plan.max_length, actions)
+			progress = lambda done, total: job.emit(progress_frame(done, total))
+			if batch_engine is None:
+				prefill = ChunkedPrefill(model, len(tokens), self.prefill_chunk, progress, cancelled)
+				request_metrics.llama_begin(model)
+				with request_metrics.phase("prefill"):
+					self.session_store.restore(model, session_id, tokens)
+					self.prefix_cache.prepare(model, tokens, boundaries, prefill.eval)
+					prefill.run(tokens)
+				# plus the last prompt token, evaluated by generate()
+				request_metrics.prefill_tokens = prefill.evaluated + 1
+				if self.speculation.mode != "off":
+					request_metrics.speculative = SpeculativeStats(self.speculation.mode)
+				generate = functools.partial(self.speculation.generate, model, stats=request_metrics.speculative)
+			else:
+				if batch_engine.speculative:
+					request_metrics.speculative = SpeculativeStats("lookup")
+				generate = functools.partial(batch_engine.generate, on_progress=progress, stats=request_metrics.speculative)
+				request_metrics.prefill_tokens = len(tokens)
+			request_metrics.prompt_tokens = len(tokens)
+			all_token_ids = [t for t in tokens]
+			print("Generation started, num tokens:", len(all_token_ids))
+
+			generate_result = generate(
+				tokens,
+				**self.sampling,
+				repeat_penalty=1.0,
+				stopping_criteria=self.stopping_criteria(plan.max_length, job.cancelled),
+				grammar=self.tool_grammars.get(tools),
+			)
+			for frame in self.parse(self.pieces(request_metrics.timed(generate_result), all_token_ids), stop):
+				if frame.is_tool:
+					tool_called = True
+				yield frame
+			generate_result.close()
+
+			# keep the context around while the backend executes the tool call
+			if tool_called and session_id is not None and batch_engine is None and not job.cancelled.is_set():
+				self.session_store.pin(model, session_id)
+
+		except Exception as e:
+			outcome = "error"
+			print(e)
+			if not self.shutting_down.is_set():
+				yield Frame("Error: " + str(e), is_error=True)
+		finally:
+			request_metrics.tool_call = tool_called
+			request_metrics.finish("cancelled" if job.cancelled.is_set() or self.shutting_down.is_set() else outcome)
+			if sampler is not None:
+				sampler.stop()
+
+		if not job.cancelled.is_set():
+			yield perf_frame(request_metrics.perf(job.reader_wait))
+
+		print("Generation finished, num tokens:", len(all_token_ids))
+
+	def _add_routes(self, app: FastAPI, security: HTTPBasic):
+		engine = self.engine
+		streams = self.streams
+
+		@app.post("/generate")
+		async def generate_text(http_request: Request, credentials: HTTPBasicCredentials = Security(security)):
+			authenticate(credentials)
+			request = await http_request.json()
+			# print(pprint.pformat(request))
+			messages = request.get("messages")
+			tools = request.get("tools")
+			if len(tools) == 0:
+				tools = None
+
+			if len(messages) == 0:
+				return Response(status_code=400, content="No messages provided")
+
+			priority = request.get("priority", MAX_PRIORITY)
+			if not isinstance(priority, int) or priority < 0 or priority > MAX_PRIORITY:
+				return Response(status_code=400, content="Invalid priority")
+			max_length = 2048
+
+			session_id = request.get("session_id")
+			if session_id is not None and not isinstance(session_id, str):
+				return Response(status_code=400, content="Invalid session_id")
+
+			stop = request.get("stop") or []
+			if not isinstance(stop, list) or not all(isinstance(s, str) for s in stop):
+				return Response(status_code=400, content="Invalid stop")
+
+			# lets the backend interrupt the generation, generated if not provided
+			request_id = request.get("request_id") or uuid.uuid4().hex
+			if not isinstance(request_id, str):
+				return Response(status_code=400, content="Invalid request_id")
+
+			# reconnect after a dropped connection: the same request again, with the
+			# number of frames received so far
+			last_event_id = http_request.headers.get("Last-Event-ID")
+			if last_event_id is not None:
+				try:
+					frames = streams.resume(request_id, int(last_event_id), http_request.is_disconnected)
+				except KeyError:
+					return Response(status_code=404, content="Request not found")
+				except ValueError:
+					return Response(status_code=400, content="Invalid Last-Event-ID")
+				except StreamGone:
+					return Response(status_code=410, content="Stream is not buffered anymore")
+				return StreamingResponse(frames, media_type="text/event-stream", headers={"X-Request-Id": request_id})
+
+			if request_id in engine.jobs or request_id in streams:
+				return Response(status_code=409, content="Request id in use")
+
+			job = None
+			if not self.shutting_down.is_set():
+				try:
+					job = engine.submit(
+						lambda job: coalesce_from_env(self.generate_frames(job, messages, tools, stop, session_id, max_length)),
+						request_id,
+						priority=priority,
+						cost=estimate_tokens(messages, tools, max_length),
+					)
+				except QueueFullError as e:
+					return Response(status_code=503, content="Queue is full", headers={"Retry-After": str(e.retry_after)})
+
+			async def stream_tokens():
+				if job is None:
+					yield error_frame("Error: Server is shutting down")
+					return
+
+				async for frame in streams.stream(job, http_request.is_disconnected):
+					yield frame
+
+			return StreamingResponse(stream_tokens(), media_type="text/event-stream", headers={"X-Request-Id": request_id})
+
+		@app.delete("/sessions/{session_id}")
+		async def release_session(session_id: str, credentials: HTTPBasicCredentials = Security(security)):
+			authenticate(credentials)
+			if not self.session_store.release(session_id):
+				return Response(status_code=404, content="Session not found")
+			return Response(status_code=204)
+
+		# Stops a running or waiting generation, the stream ends after the current token
+		@app.post("/interrupt/{request_id}")
+		async def interrupt_stream(request_id: str, credentials: HTTPBasicCredentials = Security(security)):
+			authenticate(credentials)
+			if not engine.interrupt(request_id):
+				return Response(status_code=404, content="Request not found")
+			return Response(status_code=204)
+
+		# Readiness probe, no credentials needed: 200 while serving, 503 while
+		# shutting down. The model is loaded and warmed up before uvicorn starts,
+		# so the port only accepts connections once the server is ready; until
+		# then the probe gets connection refused.
+		@app.get("/ready")
+		async def readiness():
+			if self.shutting_down.is_set():
+				return Response(status_code=503, content="Not ready")
+			return {"ready": True, "profile": self.loaded.profile}
+
+		# Prometheus text format
+		@app.get("/metrics")
+		async def get_metrics(credentials: HTTPBasicCredentials = Security(security)):
+			authenticate(credentials)
+			return Response(content=self.metrics.render(), media_type="text/plain; version=0.0.4")
+
+	def shutdown_handler(self, signum, frame):
+		self.shutting_down.set()
+		print("Shutting down...")
+		# the running generations are cancelled and stop at their next token,
+		# after that the engine threads no longer touch the model. All of this has
+		# to fit into the container's stop grace period (10 s by default).
+		stopped = self.engine.close(timeout=5)
+		if self.batch_engine is not None:
+			self.batch_engine.close(timeout=2)
+		self.cleanup_handler(stopped)
+
+	def cleanup_handler(self, stopped: bool = True):
+		# snapshots still queued for the disk
+		if self.prefix_cache.store is not None:
+			self.prefix_cache.store.close(timeout=2)
+		if stopped:
+			self.model.reset()
+			self.model.close()
+			print("Model closed")
+		sys.exit(0)
+
+	# Run the server
+	def run(self):
+		import uvicorn
+		server = uvicorn.Server(uvicorn.Config(self.app, host=os.environ.get("HOST", "0.0.0.0"), port=int(os.environ.get("PORT", "8443"))))
+		# uvicorn takes over SIGTERM while it serves and waits for the open streams
+		# to end before shutdown_handler runs, so the generations are cancelled first
+		uvicorn_exit = server.handle_exit
+		def handle_exit(signum, frame):
+			self.shutting_down.set()
+			self.engine.close(timeout=0)
+			uvicorn_exit(signum, frame)
+		server.handle_exit = handle_exit
+		server.run()
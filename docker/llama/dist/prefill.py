@@ -0,0 +1,44 @@
+import os
+from typing import Callable, List
+
+def prefill_chunk_from_env() -> int:
+	return max(1, int(os.environ.get("PREFILL_CHUNK", "512")))
+
+class PrefillCancelled(Exception):
+	pass
+
+# Evaluates a prompt on the single sequence context in chunks of chunk tokens,
+# calling on_progress(done, total) after each chunk and checking should_stop
+# in between, so a huge prompt reports progress and can be abandoned halfway.
+# Small prompts (a single chunk) report nothing.
+class ChunkedPrefill:
+	def __init__(self, model, total: int, chunk: int, on_progress: Callable[[int, int], None], should_stop: Callable[[], bool]):
+		self.model = model
+		self.total = total
+		self.chunk = chunk
+		self.on_progress = on_progress
+		self.should_stop = should_stop
+		self.report = None
+		# tokens evaluated so far
+		self.evaluated = 0
+
+	# Same signature as model.eval(), tokens continue at model.n_tokens
+	def eval(self, tokens: List[int]):
+		if self.report is None:
+			self.report = self.total - self.model.n_tokens > self.chunk
+		for start in range(0, len(tokens), self.chunk):
+			if self.should_stop():
+				raise PrefillCancelled("Prefill cancelled")
+			self.model.eval(tokens[start:start + self.chunk])
+			self.evaluated += len(tokens[start:start + self.chunk])
+			if self.report:
+				self.on_progress(self.model.n_tokens, self.total)
+
+	# Everything except the last prompt token, which generate() evaluates to
+	# get the logits for the first sample. Whatever prefix is already in the
+	# context is kept.
+	def run(self, tokens: List[int]):
+		in_context = self.model.longest_token_prefix(self.model.input_ids[:self.model.n_tokens].tolist(), tokens)
+		self.model.n_tokens = min(in_context, len(tokens) - 1)
+		if self.model.n_tokens < len(tokens) - 1:
+			self.eval(tokens[self.model.n_tokens:len(tokens) - 1])
@@ -0,0 +1,194 @@
+import os
+from collections import OrderedDict
+from typing import Callable, List, Sequence, Tuple
+
+class RadixNode:
+	__slots__ = ("edge", "parent", "children", "state", "size")
+
+	def __init__(self, edge: Tuple[int, ...], parent: "RadixNode | None"):
+		self.edge = edge
+		self.parent = parent
+		self.children: dict = {}
+		self.state = None
+		self.size = 0
+
+# save_state() copies the whole logits buffer, but the logits are refreshed by
+# the next eval anyway (generate always evaluates at least one prompt token
+# after a restore). Keep a single row, load_state() broadcasts it.
+def compact_state(state):
+	if state.scores.shape[0] > 1:
+		state.scores = state.scores[-1:].copy()
+	return state
+
+# RAM held by a saved llama state, the KV data plus the logits/token copies
+def state_nbytes(state) -> int:
+	return state.llama_state_size + state.scores.nbytes + state.input_ids.nbytes
+
+def common_length(a: Sequence[int], b: Sequence[int]) -> int:
+	n = min(len(a), len(b))
+	i = 0
+	while i < n and a[i] == b[i]:
+		i += 1
+	return i
+
+# Radix tree of token prefixes -> saved llama states. Entries are evicted least
+# recently used first once their total size exceeds max_bytes. An optional
+# snapshot store is used as a second tier: new snapshots are written through
+# to it and boundaries that missed in RAM are looked up there.
+class PrefixCache:
+	def __init__(self, max_bytes: int, min_tokens: int = 256, snapshot_boundaries: int = 1):
+		self.max_bytes = max_bytes
+		self.min_tokens = min_tokens
+		self.snapshot_boundaries = snapshot_boundaries
+		self.root = RadixNode((), None)
+		self.lru: OrderedDict = OrderedDict()
+		self.total_bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.saved_tokens = 0
+		self.store = None
+
+	@classmethod
+	def from_env(cls):
+		return cls(
+			max_bytes=int(os.environ.get("PREFIX_CACHE_BYTES", str(4 * 1024 * 1024 * 1024))),
+			min_tokens=int(os.environ.get("PREFIX_CACHE_MIN_TOKENS", "256")),
+			snapshot_boundaries=int(os.environ.get("PREFIX_CACHE_BOUNDARIES", "1")),
+		)
+
+	@property
+	def enabled(self) -> bool:
+		return self.max_bytes > 0
+
+	# Returns (length, state) of the longest cached prefix of tokens, (0, None) if none
+	def lookup(self, tokens: Sequence[int]):
+		node = self.root
+		pos = 0
+		best = (0, None)
+		while pos < len(tokens):
+			child = node.children.get(tokens[pos])
+			if child is None:
+				break
+			n = common_length(child.edge, tokens[pos:pos + len(child.edge)])
+			if n < len(child.edge):
+				break
+			pos += n
+			node = child
+			if node.state is not None:
+				best = (pos, node)
+		length, node = best
+		if node is None:
+			return 0, None
+		self.lru.move_to_end(node)
+		return length, node.state
+
+	def insert(self, tokens: Sequence[int], state, size: int):
+		if size > self.max_bytes:
+			return
+		node = self.root
+		pos = 0
+		tokens = tuple(tokens)
+		while pos < len(tokens):
+			child = node.children.get(tokens[pos])
+			if child is None:
+				leaf = RadixNode(tokens[pos:], node)
+				node.children[tokens[pos]] = leaf
+				node = leaf
+				pos = len(tokens)
+				break
+			n = common_length(child.edge, tokens[pos:pos + len(child.edge)])
+			if n < len(child.edge):
+				# split the edge at the point where the prefixes diverge
+				middle = RadixNode(child.edge[:n], node)
+				node.children[tokens[pos]] = middle
+				child.edge = child.edge[n:]
+				child.parent = middle
+				middle.children[child.edge[0]] = child
+				child = middle
+			pos += n
+			node = child
+
+		if node.state is not None:
+			self.total_bytes -= node.size
+		node.state = state
+		node.size = size
+		self.total_bytes += size
+		self.lru[node] = True
+		self.lru.move_to_end(node)
+		self.evict()
+
+	def evict(self):
+		while self.total_bytes > self.max_bytes and len(self.lru) > 0:
+			node, _ = self.lru.popitem(last=False)
+			self.remove(node)
+
+	def remove(self, node: RadixNode):
+		self.total_bytes -= node.size
+		node.state = None
+		node.size = 0
+		self.lru.pop(node, None)
+		# prune empty leaves and merge single-child pass-through nodes
+		while node is not self.root and node.state is None and len(node.children) <= 1:
+			parent = node.parent
+			if len(node.children) == 0:
+				del parent.children[node.edge[0]]
+			else:
+				(child,) = node.children.values()
+				child.edge = node.edge + child.edge
+				child.parent = parent
+				parent.children[child.edge[0]] = child
+			node = parent
+
+	# Restores the longest cached prefix into the model and snapshots the leading
+	# template boundaries that are not cached yet. Returns the number of prompt
+	# tokens that do not have to be prefilled again.
+	# evaluate defaults to model.eval, chunked prefill passes its own to report progress
+	def prepare(self, model, tokens: List[int], boundaries: List[int], evaluate: Callable[[List[int]], None] | None = None) -> int:
+		if not self.enabled:
+			return 0
+		in_context = model.longest_token_prefix(model.input_ids[:model.n_tokens].tolist(), tokens)
+		length, state = self.lookup(tokens)
+		if self.store is not None:
+			for boundary in reversed(boundaries[:self.snapshot_boundaries]):
+				if boundary <= max(length, in_context) or boundary >= len(tokens):
+					continue
+				disk_state = self.store.load(tokens[:boundary])
+				if disk_state is not None:
+					self.insert(tokens[:boundary], disk_state, state_nbytes(disk_state))
+					length, state = boundary, disk_state
+					break
+		if state is not None and length > in_context:
+			model.load_state(state)
+			reused = length
+		else:
+			reused = in_context
+		model.n_tokens = min(reused, len(tokens) - 1)
+
+		if length > 0:
+			self.hits += 1
+		else:
+			self.misses += 1
+		self.saved_tokens += reused
+
+		for boundary in boundaries[:self.snapshot_boundaries]:
+			# the last prompt token is always evaluated by generate(), and a prefix
+			# that is already in the context is left alone
+			if boundary <= model.n_tokens or boundary < self.min_tokens or boundary >= len(tokens):
+				continue
+			(evaluate or model.eval)(tokens[model.n_tokens:boundary])
+			state = compact_state(model.save_state())
+			self.insert(tokens[:boundary], state, state_nbytes(state))
+			if self.store is not None:
+				self.store.save(tokens[:boundary], state)
+
+		print("Prefix cache:", "hit" if length > 0 else "miss", "reused tokens:", reused, "cached bytes:", self.total_bytes)
+		return reused
+
+	def stats(self):
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"saved_tokens": self.saved_tokens,
+			"entries": len(self.lru),
+			"bytes": self.total_bytes,
+		}
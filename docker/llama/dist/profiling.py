@@ -0,0 +1,77 @@
+import collections
+import itertools
+import os
+import sys
+import threading
+import time
+from typing import List
+
+# Samples the Python stacks of a few threads every interval seconds until
+# stopped, then writes them in the folded format (one "outer;...;inner count"
+# line per distinct stack) that flamegraph.pl and speedscope read.
+class StackSampler:
+	def __init__(self, thread_ids: List[int], interval: float, path: str):
+		self.thread_ids = thread_ids
+		self.interval = interval
+		self.path = path
+		self.stacks: collections.Counter = collections.Counter()
+		self.samples = 0
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+		self.thread.start()
+
+	def _run(self):
+		while not self.stopped.wait(self.interval):
+			frames = sys._current_frames()
+			for thread_id in self.thread_ids:
+				frame = frames.get(thread_id)
+				stack = []
+				while frame is not None:
+					code = frame.f_code
+					stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+					frame = frame.f_back
+				if len(stack) > 0:
+					self.stacks[";".join(reversed(stack))] += 1
+			self.samples += 1
+
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+		try:
+			os.makedirs(os.path.dirname(self.path), exist_ok=True)
+			with open(self.path, "w") as f:
+				for stack, count in self.stacks.most_common():
+					f.write(f"{stack} {count}\n")
+			print("Profile written:", self.path, "samples:", self.samples)
+		except Exception as e:
+			print("Error writing profile:", e)
+
+# Opt-in profiling of every Nth generation (PROFILE_EVERY, 0 = off). Samples the
+# thread running the request and the given extra threads (the batch thread,
+# which does the decoding on the batch path) every PROFILE_INTERVAL_MS.
+class SamplingProfiler:
+	def __init__(self, every: int, interval: float, directory: str, threads: List[threading.Thread]):
+		self.every = every
+		self.interval = interval
+		self.directory = directory
+		self.threads = threads
+		self.counter = itertools.count(1)
+
+	@classmethod
+	def from_env(cls, threads: List[threading.Thread] | None = None):
+		return cls(
+			every=int(os.environ.get("PROFILE_EVERY", "0")),
+			interval=float(os.environ.get("PROFILE_INTERVAL_MS", "5")) / 1000,
+			directory=os.environ.get("PROFILE_DIR", "/data/profiles"),
+			threads=threads or [],
+		)
+
+	# Returns a running sampler if this request is one to profile, called on
+	# the thread that runs the request
+	def start(self, request_id: str) -> StackSampler | None:
+		if self.every <= 0 or next(self.counter) % self.every != 0:
+			return None
+		thread_ids = [threading.get_ident()] + [t.ident for t in self.threads if t.ident is not None]
+		name = "".join(c if c.isalnum() or c in "-_" else "_" for c in request_id)
+		path = os.path.join(self.directory, f"{int(time.time())}-{name}.folded")
+		return StackSampler(thread_ids, self.interval, path)
@@ -0,0 +1,190 @@
+import glob
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, NamedTuple
+import llama_cpp
+from llama_cpp import Llama
+
+# Manifest keys that describe the file, everything else goes to Llama()
+MANIFEST_KEYS = {"path", "sha256", "family", "prefetch", "draft"}
+
+HASH_CHUNK = 64 * 1024 * 1024
+
+# Llama() settings that autotune.py measures
+TUNED_KEYS = ("n_threads", "n_threads_batch", "n_batch", "n_ubatch", "flash_attn")
+
+class LoadedModel(NamedTuple):
+	model: Llama
+	# from_pretrained()/manifest spec of the draft model, None if the profile has none
+	draft: Dict[str, Any] | None
+	profile: str
+	load_seconds: float
+
+# Profile name: MODEL_PROFILE, else MODEL_SIZE (medium/large) on GPU, cpu on CPU
+def profile_name(device: str) -> str:
+	profile = os.environ.get("MODEL_PROFILE")
+	if profile:
+		return profile
+	return os.environ.get("MODEL_SIZE", "medium") if device == "cuda" else "cpu"
+
+# Profile name -> GGUF file and Llama() settings, e.g.
+# {
+#   "gemma3/medium": {
+#     "path": "/models/google_gemma-3-27b-it-Q4_K_M.gguf", "sha256": "...",
+#     "n_gpu_layers": -1, "n_ctx": 6000, "n_batch": 512, "n_threads": 8, "flash_attn": true,
+#     "use_mlock": true, "type_k": "q8_0", "type_v": "q8_0",
+#     "draft": {"path": "/models/google_gemma-3-1b-it-Q4_K_M.gguf", "n_gpu_layers": -1}
+#   }
+# }
+def read_manifest(path: str | None) -> Dict[str, Dict[str, Any]]:
+	if path is None or not os.path.exists(path):
+		return {}
+	with open(path, "r") as f:
+		return json.load(f)
+
+# Full SHA-256 of the GGUF. The result is remembered per (path, size, mtime) in
+# a stamp file next to the manifest, so only the first boot after a new file
+# pays for reading it; that read also leaves the weights in the page cache.
+def verify(path: str, expected: str, stamps_path: str):
+	stat = os.stat(path)
+	key = f"{os.path.realpath(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+	stamps = {}
+	if os.path.exists(stamps_path):
+		try:
+			with open(stamps_path, "r") as f:
+				stamps = json.load(f)
+		except Exception as e:
+			print("Error reading verification stamps:", e)
+	if stamps.get(key) == expected.lower():
+		return
+
+	started = time.monotonic()
+	h = hashlib.sha256()
+	with open(path, "rb") as f:
+		while True:
+			chunk = f.read(HASH_CHUNK)
+			if len(chunk) == 0:
+				break
+			h.update(chunk)
+	digest = h.hexdigest()
+	if digest != expected.lower():
+		raise ValueError(f"Checksum mismatch for {path}: expected {expected}, got {digest}")
+	print("Verified", path, "in", round(time.monotonic() - started, 1), "s")
+	stamps[key] = digest
+	try:
+		with open(stamps_path, "w") as f:
+			json.dump(stamps, f)
+	except Exception as e:
+		print("Error writing verification stamps:", e)
+
+# Asks the kernel to start reading the file into the page cache, mmap then
+# finds the weights there instead of faulting them in page by page
+def prefetch(path: str):
+	try:
+		fd = os.open(path, os.O_RDONLY)
+		try:
+			os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+		finally:
+			os.close(fd)
+	except Exception as e:
+		print("Error prefetching", path, e)
+
+def _llama_kwargs(spec: Dict[str, Any]) -> Dict[str, Any]:
+	kwargs = {k: v for k, v in spec.items() if k not in MANIFEST_KEYS}
+	# KV cache types can be given by name, e.g. "q8_0"
+	for key in ("type_k", "type_v"):
+		if isinstance(kwargs.get(key), str):
+			kwargs[key] = getattr(llama_cpp, "GGML_TYPE_" + kwargs[key].upper())
+	return kwargs
+
+# Identifies the hardware a tuning was measured on: CPU model, logical CPU
+# count and GPU models, or MODEL_TUNING_HOST. Hosts of the same type share
+# their tuning through a common tuning file.
+def host_key() -> str:
+	key = os.environ.get("MODEL_TUNING_HOST")
+	if key:
+		return key
+	cpu = "unknown cpu"
+	try:
+		with open("/proc/cpuinfo", "r") as f:
+			for line in f:
+				if line.startswith("model name"):
+					cpu = line.split(":", 1)[1].strip()
+					break
+	except OSError:
+		pass
+	gpus = []
+	for path in sorted(glob.glob("/proc/driver/nvidia/gpus/*/information")):
+		with open(path, "r") as f:
+			for line in f:
+				if line.startswith("Model:"):
+					gpus.append(line.split(":", 1)[1].strip())
+	return " + ".join([f"{cpu} x{os.cpu_count()}"] + gpus)
+
+# Settings written by autotune.py for this host and profile
+# (MODEL_TUNING, default /data/tuning.json)
+def read_tuning(family: str, profile: str) -> Dict[str, Any]:
+	path = os.environ.get("MODEL_TUNING", "/data/tuning.json")
+	if not os.path.exists(path):
+		return {}
+	try:
+		with open(path, "r") as f:
+			tuning = json.load(f)
+	except Exception as e:
+		print("Error reading tuning:", e)
+		return {}
+	entry = tuning.get(host_key(), {}).get(f"{family}/{profile}", {})
+	return {k: v for k, v in entry.items() if k in TUNED_KEYS}
+
+# A model from a manifest entry (local file, mmap'd, optional mlock through
+# use_mlock) or from a built-in profile (Hugging Face download). overrides win
+# over both.
+def open_model(spec: Dict[str, Any], stamps_path: str | None = None, **overrides) -> Llama:
+	kwargs = _llama_kwargs(spec)
+	kwargs.update(overrides)
+	if "path" not in spec:
+		return Llama.from_pretrained(**kwargs)
+
+	path = spec["path"]
+	if spec.get("sha256") and os.environ.get("MODEL_VERIFY", "on") != "off":
+		verify(path, spec["sha256"], stamps_path or path + ".verified.json")
+	elif spec.get("prefetch", True):
+		prefetch(path)
+	kwargs.pop("repo_id", None)
+	kwargs.pop("filename", None)
+	return Llama(model_path=path, **kwargs)
+
+# Loads the model of this server's family for the current profile. A manifest
+# entry (MODEL_MANIFEST, default /data/models.json) for "<family>/<profile>"
+# takes precedence over the built-in profile and needs no network at all.
+def load_model(family: str, profiles: Dict[str, Dict[str, Any]], device: str) -> LoadedModel:
+	profile = profile_name(device)
+	manifest_path = os.environ.get("MODEL_MANIFEST", "/data/models.json")
+	manifest = read_manifest(manifest_path)
+	spec = manifest.get(f"{family}/{profile}")
+	source = "manifest"
+	if spec is None:
+		spec = profiles.get(profile)
+		source = "hub"
+	if spec is None:
+		raise ValueError(f"Unknown model profile: {family}/{profile}")
+	if spec.get("family", family) != family:
+		raise ValueError(f"Profile {family}/{profile} is a {spec['family']} model")
+
+	overrides = read_tuning(family, profile)
+	if len(overrides) > 0:
+		print("Tuning for this host:", overrides)
+	# thread counts set by the worker supervisor (workers.py) for the CPUs the
+	# process is pinned to
+	if os.environ.get("N_THREADS"):
+		overrides["n_threads"] = int(os.environ["N_THREADS"])
+	if os.environ.get("N_THREADS_BATCH"):
+		overrides["n_threads_batch"] = int(os.environ["N_THREADS_BATCH"])
+
+	started = time.monotonic()
+	model = open_model(spec, os.path.join(os.path.dirname(manifest_path), "models.verified.json"), **overrides)
+	load_seconds = time.monotonic() - started
+	print("Model loaded:", f"{family}/{profile}", "from", source, "in", round(load_seconds, 1), "s")
+	return LoadedModel(model, spec.get("draft"), profile, load_seconds)
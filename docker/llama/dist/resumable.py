@@ -0,0 +1,144 @@
+import asyncio
+import collections
+import itertools
+import os
+from typing import AsyncIterator, Awaitable, Callable
+from engine import Engine, EngineJob
+from framing import error_frame
+
+class StreamGone(Exception):
+	pass
+
+# The frames of one generation. Every frame is one line, its event id is its
+# position in the stream (the first frame has id 1), so a client that counts
+# the lines it received knows its Last-Event-ID without any change to the
+# frame format. The last max_frames frames are kept for replay.
+class StreamBuffer:
+	def __init__(self, job: EngineJob, max_frames: int):
+		self.job = job
+		self.frames = collections.deque(maxlen=max_frames)
+		# id of the next frame
+		self.next_id = 1
+		self.done = False
+		self.readers = 0
+		self.changed = asyncio.Event()
+		self.timer: asyncio.TimerHandle | None = None
+		self.task: asyncio.Task | None = None
+
+	@property
+	def first_id(self) -> int:
+		return self.next_id - len(self.frames)
+
+	def _notify(self):
+		self.changed.set()
+		self.changed = asyncio.Event()
+
+	def append(self, chunk: str):
+		frames = chunk.splitlines(keepends=True)
+		self.frames.extend(frames)
+		self.next_id += len(frames)
+		self._notify()
+
+	def finish(self):
+		self.done = True
+		self._notify()
+
+# Keeps the output of every generation in a StreamBuffer while it runs and for
+# ttl seconds after it finished. The generation does not depend on the
+# connection: when the last reader goes away it keeps going for ttl seconds,
+# a reconnect with Last-Event-ID within that time replays the missed frames
+# and follows the rest, otherwise the job is cancelled. A redeploy of the
+# backend then costs neither a second prefill nor a second decode.
+#
+# With STREAM_RESUME_TTL=0 streams are tied to their connection like before.
+class ResumableStreams:
+	def __init__(self, engine: Engine, ttl: float, max_frames: int):
+		self.engine = engine
+		self.ttl = ttl
+		self.max_frames = max_frames
+		self.buffers: dict[str, StreamBuffer] = {}
+
+	@classmethod
+	def from_env(cls, engine: Engine):
+		ttl = float(os.environ.get("STREAM_RESUME_TTL", "30"))
+		max_frames = int(os.environ.get("STREAM_RESUME_FRAMES", "8192"))
+		return cls(engine, ttl, max_frames)
+
+	def __contains__(self, request_id: str) -> bool:
+		return request_id in self.buffers
+
+	# Frames of a newly submitted job
+	def stream(self, job: EngineJob, is_disconnected: Callable[[], Awaitable[bool]] | None = None) -> AsyncIterator[str]:
+		if self.ttl <= 0:
+			return self.engine.stream(job, is_disconnected)
+		buffer = StreamBuffer(job, self.max_frames)
+		buffer.task = asyncio.create_task(self._pump(job.request_id, buffer))
+		self.buffers[job.request_id] = buffer
+		return self._follow(buffer, 0, is_disconnected)
+
+	# Frames after last_event_id of a stream that is still around. Raises
+	# KeyError for an unknown (or expired) request and StreamGone if the
+	# frames to replay are not buffered anymore.
+	def resume(self, request_id: str, last_event_id: int, is_disconnected: Callable[[], Awaitable[bool]] | None = None) -> AsyncIterator[str]:
+		buffer = self.buffers[request_id]
+		if last_event_id < 0 or last_event_id >= buffer.next_id:
+			raise ValueError("Invalid Last-Event-ID: " + str(last_event_id))
+		if last_event_id + 1 < buffer.first_id:
+			raise StreamGone("Frames after " + str(last_event_id) + " are not buffered anymore")
+		print("Resuming request", request_id, "after frame", last_event_id)
+		return self._follow(buffer, last_event_id, is_disconnected)
+
+	async def _pump(self, request_id: str, buffer: StreamBuffer):
+		try:
+			async for chunk in self.engine.stream(buffer.job):
+				buffer.append(chunk)
+		except Exception as e:
+			print("Stream failed:", e)
+			buffer.append(error_frame("Error: " + str(e)))
+		finally:
+			buffer.finish()
+			if buffer.timer is not None:
+				buffer.timer.cancel()
+			asyncio.get_running_loop().call_later(self.ttl, self._expire, request_id, buffer)
+
+	def _expire(self, request_id: str, buffer: StreamBuffer):
+		if self.buffers.get(request_id) is buffer:
+			del self.buffers[request_id]
+
+	def _abandon(self, buffer: StreamBuffer):
+		buffer.timer = None
+		if buffer.readers == 0 and not buffer.done:
+			print("Nobody reconnected, cancelling request", buffer.job.request_id)
+			self.engine.cancel(buffer.job)
+
+	async def _follow(self, buffer: StreamBuffer, after: int, is_disconnected: Callable[[], Awaitable[bool]] | None) -> AsyncIterator[str]:
+		buffer.readers += 1
+		if buffer.timer is not None:
+			buffer.timer.cancel()
+			buffer.timer = None
+		try:
+			while True:
+				changed = buffer.changed
+				if after + 1 < buffer.first_id:
+					# a reader this far behind would miss frames
+					yield error_frame("Error: Client fell too far behind the stream")
+					return
+				if after + 1 < buffer.next_id:
+					frames = list(itertools.islice(buffer.frames, after + 1 - buffer.first_id, None))
+					after = buffer.next_id - 1
+					yield "".join(frames)
+					continue
+				if buffer.done:
+					return
+				try:
+					await asyncio.wait_for(changed.wait(), self.engine.disconnect_poll)
+				except asyncio.TimeoutError:
+					# nothing is sent while the job waits or prefills, which is
+					# when a dropped connection would go unnoticed
+					if is_disconnected is not None and await is_disconnected():
+						print("Client disconnected from request", buffer.job.request_id)
+						return
+		finally:
+			buffer.readers -= 1
+			if buffer.readers == 0 and not buffer.done:
+				buffer.timer = asyncio.get_running_loop().call_later(self.ttl, self._abandon, buffer)
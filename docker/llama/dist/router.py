@@ -0,0 +1,447 @@
+import asyncio
+import collections
+import itertools
+import json
+import os
+import sys
+import time
+from typing import Any, Dict, List
+import httpx
+from fastapi import FastAPI, Request, Security, HTTPException
+from fastapi.responses import Response
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from registry import read_manifest
+from upstream import ServerProcess, forwarded, merge_metrics, proxy_generate
+
+# One endpoint for several models. Every model runs in its own server process
+# (qwen.py, mistral.py or gemma3.py with MODEL_PROFILE set) on a local port, the
+# router starts them on demand, forwards /generate by the request's "model"
+# field and streams the answer back. Residency is bounded by a memory budget:
+# starting a model first stops the least recently used idle ones until it
+# fits, and models without traffic for idle_seconds are stopped as well.
+#
+#   python3 /dist/router.py
+#
+# Configuration (ROUTER_CONFIG, default /data/router.json):
+# {
+#   "budget_bytes": 80000000000, "idle_seconds": 1800, "default": "qwen2_5-32b-instruct",
+#   "models": {
+#     "gemma3_1-27b-it": {"server": "gemma3", "profile": "medium", "memory_bytes": 24000000000},
+#     "qwen3_14b-instruct": {"server": "qwen", "profile": "qwen3-14b", "env": {"BATCH_SLOTS": "2"}}
+#   }
+# }
+# memory_bytes is the RAM/VRAM a model needs (weights, KV cache, caches); if it
+# is missing the GGUF sizes of the model's manifest entry (see registry.py)
+# are used. ROUTER_BUDGET_BYTES and ROUTER_IDLE_SECONDS override the file.
+
+DIST = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_MODELS = {
+	"gemma3_1-27b-it": {"server": "gemma3", "profile": "medium"},
+	"mistral-small-3.1-24b-instruct": {"server": "mistral", "profile": "medium"},
+	"qwen2_5-32b-instruct": {"server": "qwen", "profile": "large"},
+	# needs a "qwen/qwen3-14b" manifest entry
+	"qwen3_14b-instruct": {"server": "qwen", "profile": "qwen3-14b"},
+}
+
+class MemoryBudgetError(Exception):
+	def __init__(self, message: str, retry_after: int):
+		super().__init__(message)
+		self.retry_after = retry_after
+
+# Sum of the GGUF files of the model's manifest entry and its draft model
+def estimate_memory(spec: Dict[str, Any], manifest: Dict[str, Dict[str, Any]]) -> int:
+	if spec.get("memory_bytes") is not None:
+		return int(spec["memory_bytes"])
+	entry = manifest.get(f"{spec['server']}/{spec['profile']}")
+	if entry is None or "path" not in entry:
+		raise ValueError(f"No memory_bytes and no manifest file for {spec['server']}/{spec['profile']}")
+	size = os.path.getsize(entry["path"])
+	if isinstance(entry.get("draft"), dict) and "path" in entry["draft"]:
+		size += os.path.getsize(entry["draft"]["path"])
+	return size
+
+class ModelRouter:
+	def __init__(
+		self,
+		models: Dict[str, Dict[str, Any]],
+		budget_bytes: int,
+		idle_seconds: float,
+		default: str | None,
+		base_port: int,
+		load_timeout: float,
+		drain_grace: float,
+	):
+		self.models = models
+		self.budget_bytes = budget_bytes
+		self.idle_seconds = idle_seconds
+		self.default = default
+		self.load_timeout = load_timeout
+		# a replaced or unloaded process stays up this long after its last
+		# stream, so clients can still resume (see resumable.py)
+		self.drain_grace = drain_grace
+		self.ports = itertools.count(base_port)
+		# the process serving each model
+		self.resident: Dict[str, ServerProcess] = {}
+		# every running process, including the ones being replaced
+		self.processes: List[ServerProcess] = []
+		# request id -> process, for interrupts and resumes
+		self.requests: collections.OrderedDict = collections.OrderedDict()
+		self.reloading: set = set()
+		self.lock = asyncio.Lock()
+		self.client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=10))
+		self.loads = 0
+		self.evictions = 0
+
+	@classmethod
+	def from_env(cls):
+		path = os.environ.get("ROUTER_CONFIG", "/data/router.json")
+		config = {}
+		if os.path.exists(path):
+			with open(path, "r") as f:
+				config = json.load(f)
+		budget_bytes = int(os.environ.get("ROUTER_BUDGET_BYTES", config.get("budget_bytes", 0)))
+		manifest = read_manifest(os.environ.get("MODEL_MANIFEST", "/data/models.json"))
+		models = {}
+		for name, spec in config.get("models", DEFAULT_MODELS).items():
+			spec = dict(spec)
+			try:
+				spec["memory_bytes"] = estimate_memory(spec, manifest)
+			except Exception as e:
+				# without a budget the size does not matter
+				if budget_bytes > 0:
+					print("Skipping model", name + ":", e)
+					continue
+				spec["memory_bytes"] = 0
+			models[name] = spec
+		return cls(
+			models,
+			budget_bytes=budget_bytes,
+			idle_seconds=float(os.environ.get("ROUTER_IDLE_SECONDS", config.get("idle_seconds", 1800))),
+			default=config.get("default"),
+			base_port=int(os.environ.get("ROUTER_BASE_PORT", "9000")),
+			load_timeout=float(os.environ.get("ROUTER_LOAD_TIMEOUT", "1800")),
+			drain_grace=float(os.environ.get("STREAM_RESUME_TTL", "30")),
+		)
+
+	def used_bytes(self) -> int:
+		return sum(p.memory_bytes for p in self.processes)
+
+	# Stops least recently used idle models until needed bytes fit, called
+	# with the lock held. Budget 0 means no limit.
+	async def _make_room(self, needed: int, keep: str):
+		if self.budget_bytes <= 0:
+			return
+		if needed > self.budget_bytes:
+			raise MemoryBudgetError(f"Model needs {needed} bytes, the budget is {self.budget_bytes}", 3600)
+		while self.used_bytes() + needed > self.budget_bytes:
+			idle = [
+				p for name, p in self.resident.items()
+				if name != keep and p.ready and p.active == 0
+			]
+			if len(idle) == 0:
+				raise MemoryBudgetError("All resident models are busy", 10)
+			victim = min(idle, key=lambda p: p.last_used)
+			print("Evicting", victim.name, "idle for", round(time.monotonic() - victim.last_used), "s")
+			self.evictions += 1
+			del self.resident[victim.name]
+			await self._stop(victim)
+
+	async def _stop(self, process: ServerProcess):
+		await process.stop()
+		if process in self.processes:
+			self.processes.remove(process)
+		for request_id in [r for r, p in self.requests.items() if p is process]:
+			del self.requests[request_id]
+
+	def _launch(self, name: str, spec: Dict[str, Any]) -> ServerProcess:
+		env = dict(os.environ)
+		env.update({k: str(v) for k, v in spec.get("env", {}).items()})
+		env["MODEL_PROFILE"] = spec["profile"]
+		command = [sys.executable, os.path.join(DIST, spec["server"] + ".py")]
+		process = ServerProcess(name, command, env, next(self.ports), spec["memory_bytes"])
+		process.launch()
+		process.loading = asyncio.ensure_future(process.wait_ready(self.client, self.load_timeout))
+		self.processes.append(process)
+		self.loads += 1
+		return process
+
+	# The process for a request, started if the model is not resident. The
+	# caller owns one stream on it until release(). A resumed request goes to
+	# the process that ran it, even if that one is being replaced.
+	async def acquire(self, name: str, request_id: str | None = None) -> ServerProcess:
+		async with self.lock:
+			process = self.requests.get(request_id) if request_id is not None else None
+			if process is None or not process.alive():
+				if name not in self.models:
+					raise KeyError(name)
+				process = self.resident.get(name)
+				if process is not None and process.ready and not process.alive():
+					print(name, "exited with code", process.process.returncode)
+					del self.resident[name]
+					await self._stop(process)
+					process = None
+				if process is None:
+					spec = self.models[name]
+					await self._make_room(spec["memory_bytes"], name)
+					process = self._launch(name, spec)
+					self.resident[name] = process
+			process.active += 1
+			process.last_used = time.monotonic()
+
+		try:
+			await asyncio.shield(process.loading)
+		except Exception:
+			process.active -= 1
+			async with self.lock:
+				if self.resident.get(process.name) is process:
+					del self.resident[process.name]
+				await self._stop(process)
+			raise
+		return process
+
+	def release(self, process: ServerProcess):
+		process.active -= 1
+		process.last_used = time.monotonic()
+
+	# Takes a process out of rotation, it is stopped once its streams ended
+	def _drain(self, process: ServerProcess):
+		process.draining = True
+		async def wait():
+			while process.active > 0 or time.monotonic() - process.last_used < self.drain_grace:
+				await asyncio.sleep(1)
+			async with self.lock:
+				await self._stop(process)
+		asyncio.ensure_future(wait())
+
+	# Starts the model with the changed settings next to the running one and
+	# switches to it once it is ready. Streams on the old process keep going
+	# until they finish, new requests go to the new one.
+	async def reload(self, name: str, changes: Dict[str, Any]) -> bool:
+		if name not in self.models:
+			raise KeyError(name)
+		if name in self.reloading:
+			raise ValueError(f"{name} is already being reloaded")
+		self.reloading.add(name)
+		try:
+			spec = dict(self.models[name])
+			spec.update(changes)
+			if "memory_bytes" not in changes and ("profile" in changes or "server" in changes):
+				spec.pop("memory_bytes", None)
+			try:
+				spec["memory_bytes"] = estimate_memory(spec, read_manifest(os.environ.get("MODEL_MANIFEST", "/data/models.json")))
+			except ValueError:
+				if self.budget_bytes > 0:
+					raise
+				spec["memory_bytes"] = 0
+			async with self.lock:
+				if name not in self.resident:
+					# loaded with the new settings on the next request
+					self.models[name] = spec
+					return False
+				await self._make_room(spec["memory_bytes"], name)
+				process = self._launch(name, spec)
+			try:
+				await process.loading
+			except Exception:
+				async with self.lock:
+					await self._stop(process)
+				raise
+			async with self.lock:
+				self.models[name] = spec
+				old = self.resident.get(name)
+				self.resident[name] = process
+				if old is not None:
+					self._drain(old)
+			return True
+		finally:
+			self.reloading.discard(name)
+
+	async def unload(self, name: str) -> bool:
+		async with self.lock:
+			process = self.resident.pop(name, None)
+			if process is None:
+				return False
+			self._drain(process)
+			return True
+
+	async def reap_idle(self):
+		interval = max(1.0, min(30.0, self.idle_seconds / 4))
+		while True:
+			await asyncio.sleep(interval)
+			now = time.monotonic()
+			async with self.lock:
+				for name, process in list(self.resident.items()):
+					if not process.alive() and process.ready:
+						print(name, "exited with code", process.process.returncode)
+						del self.resident[name]
+						await self._stop(process)
+					elif self.idle_seconds > 0 and process.ready and process.active == 0 and now - process.last_used > self.idle_seconds:
+						print("Unloading", name, "idle for", round(now - process.last_used), "s")
+						del self.resident[name]
+						await self._stop(process)
+
+	def status(self) -> List[Dict[str, Any]]:
+		now = time.monotonic()
+		result = []
+		for name, spec in self.models.items():
+			process = self.resident.get(name)
+			result.append({
+				"model": name,
+				"server": spec["server"],
+				"profile": spec["profile"],
+				"memory_bytes": spec["memory_bytes"],
+				"state": "unloaded" if process is None else "ready" if process.ready else "loading",
+				"active": process.active if process is not None else 0,
+				"idle_seconds": round(now - process.last_used, 1) if process is not None else None,
+			})
+		return result
+
+	# The metrics of every ready process (the model_profile and model_family
+	# labels tell them apart) with the router's own
+	async def render_metrics(self, headers: Dict[str, str]) -> str:
+		families: Dict[str, List[str]] = {
+			"llama_router_memory_budget_bytes": ["# TYPE llama_router_memory_budget_bytes gauge", f"llama_router_memory_budget_bytes {self.budget_bytes}"],
+			"llama_router_memory_used_bytes": ["# TYPE llama_router_memory_used_bytes gauge", f"llama_router_memory_used_bytes {self.used_bytes()}"],
+			"llama_router_model_loads_total": ["# TYPE llama_router_model_loads_total counter", f"llama_router_model_loads_total {self.loads}"],
+			"llama_router_model_evictions_total": ["# TYPE llama_router_model_evictions_total counter", f"llama_router_model_evictions_total {self.evictions}"],
+		}
+		processes = [p for p in self.processes if p.ready and p.alive()]
+		return await merge_metrics(self.client, processes, headers, families)
+
+	async def close(self):
+		async with self.lock:
+			await asyncio.gather(*(self._stop(p) for p in list(self.processes)))
+		await self.client.aclose()
+
+app = FastAPI()
+security = HTTPBasic()
+router = ModelRouter.from_env()
+
+correct_username = os.environ.get("AI_USERNAME", None)
+correct_password = os.environ.get("AI_PASSWORD", None)
+if not correct_username or not correct_password:
+	raise ValueError("AI_USERNAME and AI_PASSWORD must be set")
+
+def authenticate(credentials: HTTPBasicCredentials):
+	if not (credentials.username == correct_username and
+			credentials.password == correct_password):
+		raise HTTPException(
+			status_code=401,
+			detail="Incorrect username or password",
+			headers={"WWW-Authenticate": "Basic"},
+		)
+	return credentials
+
+@app.on_event("startup")
+async def start_reaper():
+	asyncio.ensure_future(router.reap_idle())
+
+@app.post("/generate")
+async def generate_text(http_request: Request, credentials: HTTPBasicCredentials = Security(security)):
+	authenticate(credentials)
+	body = await http_request.body()
+	try:
+		request = json.loads(body)
+	except ValueError:
+		return Response(status_code=400, content="Invalid JSON")
+	name = request.get("model") or router.default
+	if name is None:
+		return Response(status_code=400, content="No model given")
+	request_id = request.get("request_id")
+	resume_id = request_id if "last-event-id" in http_request.headers else None
+	try:
+		process = await router.acquire(name, resume_id)
+	except KeyError:
+		return Response(status_code=404, content="Unknown model")
+	except MemoryBudgetError as e:
+		return Response(status_code=503, content=str(e), headers={"Retry-After": str(e.retry_after)})
+	except Exception as e:
+		print("Error loading", name, e)
+		return Response(status_code=503, content="Model failed to load", headers={"Retry-After": "30"})
+
+	return await proxy_generate(router.client, process, http_request, body, lambda: router.release(process), router.requests)
+
+@app.delete("/sessions/{session_id}")
+async def release_session(session_id: str, http_request: Request, credentials: HTTPBasicCredentials = Security(security)):
+	authenticate(credentials)
+	released = False
+	for process in [p for p in router.processes if p.ready and p.alive()]:
+		try:
+			response = await router.client.delete(process.url + "/sessions/" + session_id, headers=forwarded(http_request))
+			released = released or response.status_code == 204
+		except httpx.TransportError as e:
+			print("Error releasing session on", process.name, e)
+	if not released:
+		return Response(status_code=404, content="Session not found")
+	return Response(status_code=204)
+
+@app.post("/interrupt/{request_id}")
+async def interrupt_stream(request_id: str, http_request: Request, credentials: HTTPBasicCredentials = Security(security)):
+	authenticate(credentials)
+	process = router.requests.get(request_id)
+	if process is None or not process.alive():
+		return Response(status_code=404, content="Request not found")
+	response = await router.client.post(process.url + "/interrupt/" + request_id, headers=forwarded(http_request))
+	return Response(status_code=response.status_code, content=response.content)
+
+@app.get("/ready")
+async def readiness():
+	return {"ready": True, "models": [name for name, p in router.resident.items() if p.ready]}
+
+@app.get("/metrics")
+async def get_metrics(http_request: Request, credentials: HTTPBasicCredentials = Security(security)):
+	authenticate(credentials)
+	return Response(content=await router.render_metrics(forwarded(http_request)), media_type="text/plain; version=0.0.4")
+
+@app.get("/admin/models")
+async def list_models(credentials: HTTPBasicCredentials = Security(security)):
+	authenticate(credentials)
+	return {
+		"budget_bytes": router.budget_bytes,
+		"used_bytes": router.used_bytes(),
+		"models": router.status(),
+	}
+
+# Replaces the weights or settings of a model without dropping its streams.
+# The body changes the model's configuration, e.g. {"profile": "large"} or
+# {"env": {"MODEL_MANIFEST": "/data/models-v2.json"}}; an empty body reloads it
+# as it is (after the GGUF behind its manifest entry was updated).
+@app.post("/admin/models/{name}/reload")
+async def reload_model(name: str, http_request: Request, credentials: HTTPBasicCredentials = Security(security)):
+	authenticate(credentials)
+	body = await http_request.body()
+	try:
+		changes = json.loads(body) if len(body) > 0 else {}
+	except ValueError:
+		return Response(status_code=400, content="Invalid JSON")
+	if not isinstance(changes, dict):
+		return Response(status_code=400, content="Expected a JSON object")
+	try:
+		reloaded = await router.reload(name, changes)
+	except KeyError:
+		return Response(status_code=404, content="Unknown model")
+	except ValueError as e:
+		return Response(status_code=409, content=str(e))
+	except MemoryBudgetError as e:
+		return Response(status_code=503, content=str(e), headers={"Retry-After": str(e.retry_after)})
+	except Exception as e:
+		print("Error reloading", name, e)
+		return Response(status_code=500, content="Reload failed: " + str(e))
+	return {"model": name, "reloaded": reloaded}
+
+@app.post("/admin/models/{name}/unload")
+async def unload_model(name: str, credentials: HTTPBasicCredentials = Security(security)):
+	authenticate(credentials)
+	if not await router.unload(name):
+		return Response(status_code=404, content="Model not loaded")
+	return Response(status_code=204)
+
+@app.on_event("shutdown")
+async def stop_models():
+	await router.close()
+
+# Run the server
+if __name__ == "__main__":
+	import uvicorn
+	uvicorn.run(app, host=os.environ.get("HOST", "0.0.0.0"), port=int(os.environ.get("PORT", "8443")))
@@ -0,0 +1,114 @@
+import heapq
+import itertools
+import json
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List
+
+# Same priority levels as srv/assistant/queue.ts, 0 is served first
+MAX_PRIORITY = 3
+
+# Rough characters per token, only used to estimate the cost of waiting requests
+CHARS_PER_TOKEN = 4
+
+class QueueFullError(Exception):
+	def __init__(self, retry_after: int):
+		super().__init__("Queue is full")
+		self.retry_after = retry_after
+
+def estimate_tokens(messages: List[Dict[str, Any]], tools: List[Dict[str, Any]] | None, max_length: int) -> int:
+	chars = 0
+	for message in messages:
+		content = message.get("content")
+		if isinstance(content, str):
+			chars += len(content)
+		tool_calls = message.get("tool_calls")
+		if tool_calls is not None:
+			chars += len(json.dumps(tool_calls))
+	if tools is not None:
+		chars += len(json.dumps(tools))
+	return chars // CHARS_PER_TOKEN + max_length
+
+# Bounded priority queue of engine jobs. The backlog is measured in estimated
+# tokens, new requests are rejected once it would exceed max_backlog_tokens.
+class AdmissionScheduler:
+	def __init__(self, max_backlog_tokens: int, max_waiting: int):
+		self.max_backlog_tokens = max_backlog_tokens
+		self.max_waiting = max_waiting
+		self.cond = threading.Condition()
+		self.heap = []
+		self.counter = itertools.count()
+		self.closed = False
+		self.backlog_tokens = 0
+		# throughput estimate in tokens/s, updated after every finished job
+		self.tokens_per_second = 100.0
+
+	@classmethod
+	def from_env(cls):
+		return cls(
+			max_backlog_tokens=int(os.environ.get("MAX_BACKLOG_TOKENS", "400000")),
+			max_waiting=int(os.environ.get("MAX_QUEUE_LENGTH", "100")),
+		)
+
+	def retry_after(self, extra_tokens: int = 0) -> int:
+		return max(1, math.ceil((self.backlog_tokens + extra_tokens) / self.tokens_per_second))
+
+	def push(self, job, priority: int, cost: int):
+		with self.cond:
+			if self.closed:
+				raise RuntimeError("Scheduler is closed")
+			# an empty queue always admits, so one huge request can't be locked out forever
+			if len(self.heap) > 0 and (len(self.heap) >= self.max_waiting or self.backlog_tokens + cost > self.max_backlog_tokens):
+				raise QueueFullError(self.retry_after(cost))
+			job.priority = priority
+			job.cost = cost
+			job.enqueued_at = time.monotonic()
+			heapq.heappush(self.heap, (priority, next(self.counter), job))
+			self.backlog_tokens += cost
+			self.cond.notify()
+
+	# Blocks until a job is available, returns None once the scheduler is closed
+	def pop(self):
+		with self.cond:
+			while True:
+				if self.closed:
+					return None
+				if len(self.heap) > 0:
+					_, _, job = heapq.heappop(self.heap)
+					return job
+				self.cond.wait()
+
+	# Takes a job out of the queue before it started, returns False if it is
+	# not waiting (anymore)
+	def remove(self, job) -> bool:
+		with self.cond:
+			for i, (_, _, waiting) in enumerate(self.heap):
+				if waiting is job:
+					self.heap.pop(i)
+					heapq.heapify(self.heap)
+					self.backlog_tokens = max(0, self.backlog_tokens - job.cost)
+					return True
+			return False
+
+	# Releases the job's share of the backlog. Only jobs that ran to completion
+	# update the throughput estimate, cancelled ones did less work than estimated.
+	def done(self, job, elapsed: float, completed: bool):
+		with self.cond:
+			self.backlog_tokens = max(0, self.backlog_tokens - job.cost)
+			if completed and elapsed > 0:
+				self.tokens_per_second = 0.8 * self.tokens_per_second + 0.2 * (job.cost / elapsed)
+
+	# Closes the scheduler and returns the jobs that never started
+	def close(self) -> list:
+		with self.cond:
+			self.closed = True
+			waiting = [job for _, _, job in self.heap]
+			self.heap = []
+			self.backlog_tokens = 0
+			self.cond.notify_all()
+			return waiting
+
+	def __len__(self):
+		return len(self.heap)
@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+from typing import List
+from prefix_cache import compact_state, state_nbytes
+
+class PinnedSession:
+	__slots__ = ("state", "size", "expires_at")
+
+	def __init__(self, state, size: int, expires_at: float):
+		self.state = state
+		self.size = size
+		self.expires_at = expires_at
+
+# Llama states pinned per dialog while the backend executes a tool call. The
+# requeued request then only has to prefill what was appended to the dialog.
+# Pins expire after ttl seconds; when max_bytes is exceeded the pins closest
+# to expiring are evicted first.
+class SessionStore:
+	def __init__(self, max_bytes: int, ttl: float):
+		self.max_bytes = max_bytes
+		self.ttl = ttl
+		self.sessions: dict[str, PinnedSession] = {}
+		self.total_bytes = 0
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	@classmethod
+	def from_env(cls):
+		return cls(
+			max_bytes=int(os.environ.get("SESSION_CACHE_BYTES", str(2 * 1024 * 1024 * 1024))),
+			ttl=float(os.environ.get("SESSION_TTL", "300")),
+		)
+
+	@property
+	def enabled(self) -> bool:
+		return self.max_bytes > 0
+
+	def _drop(self, session_id: str):
+		session = self.sessions.pop(session_id, None)
+		if session is not None:
+			self.total_bytes -= session.size
+
+	def _sweep(self, now: float):
+		for session_id in [k for k, v in self.sessions.items() if v.expires_at <= now]:
+			self._drop(session_id)
+
+	# Saves the current model state for the session, called after a generation
+	# that ended with a tool call
+	def pin(self, model, session_id: str):
+		if not self.enabled:
+			return
+		state = compact_state(model.save_state())
+		size = state_nbytes(state)
+		with self.lock:
+			now = time.monotonic()
+			self._sweep(now)
+			self._drop(session_id)
+			if size > self.max_bytes:
+				print("Session state too large to pin:", session_id, size)
+				return
+			while self.total_bytes + size > self.max_bytes and len(self.sessions) > 0:
+				oldest = min(self.sessions, key=lambda k: self.sessions[k].expires_at)
+				self._drop(oldest)
+				self.evictions += 1
+			self.sessions[session_id] = PinnedSession(state, size, now + self.ttl)
+			self.total_bytes += size
+
+	def release(self, session_id: str) -> bool:
+		with self.lock:
+			found = session_id in self.sessions
+			self._drop(session_id)
+			return found
+
+	# Loads the pinned state of the session if it shares a longer prefix with
+	# tokens than what is already in the context. The pin is consumed. Returns the
+	# number of prompt tokens that do not have to be prefilled again.
+	def restore(self, model, session_id: str | None, tokens: List[int]) -> int:
+		in_context = model.longest_token_prefix(model.input_ids[:model.n_tokens].tolist(), tokens)
+		if session_id is None or not self.enabled:
+			return in_context
+		with self.lock:
+			self._sweep(time.monotonic())
+			session = self.sessions.get(session_id)
+			self._drop(session_id)
+		if session is None:
+			self.misses += 1
+			return in_context
+		self.hits += 1
+		common = model.longest_token_prefix(session.state.input_ids[:session.state.n_tokens].tolist(), tokens)
+		if common <= in_context:
+			return in_context
+		model.load_state(session.state)
+		model.n_tokens = min(common, len(tokens) - 1)
+		print("Session restored:", session_id, "reused tokens:", model.n_tokens, "new tokens:", len(tokens) - model.n_tokens)
+		return model.n_tokens
+
+	def stats(self):
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"sessions": len(self.sessions),
+			"bytes": self.total_bytes,
+		}
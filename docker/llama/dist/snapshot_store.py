@@ -0,0 +1,244 @@
+import hashlib
+import json
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+from typing import List, Sequence
+import numpy
+from llama_cpp.llama import LlamaState
+from prefix_cache import state_nbytes
+
+MAGIC = b"CGKV1\n"
+
+# Only the head and tail of the GGUF are hashed, hashing tens of GB at every
+# boot would defeat the purpose. Size + head + tail is unique enough to tell
+# quantizations and revisions apart.
+FINGERPRINT_CHUNK = 16 * 1024 * 1024
+
+STALE_TMP_SECONDS = 3600
+
+def model_fingerprint(model_path: str) -> str:
+	h = hashlib.sha256()
+	size = os.path.getsize(model_path)
+	h.update(str(size).encode("utf-8"))
+	with open(model_path, "rb") as f:
+		h.update(f.read(FINGERPRINT_CHUNK))
+		if size > FINGERPRINT_CHUNK:
+			f.seek(max(FINGERPRINT_CHUNK, size - FINGERPRINT_CHUNK))
+			h.update(f.read(FINGERPRINT_CHUNK))
+	return h.hexdigest()[:16]
+
+def model_key(model) -> str:
+	params = model.context_params
+	key = f"{model_fingerprint(model.model_path)}-{model.n_ctx()}-k{params.type_k}-v{params.type_v}"
+	return key
+
+def prefix_hash(tokens: Sequence[int]) -> str:
+	return hashlib.sha256(numpy.asarray(tokens, dtype=numpy.int32).tobytes()).hexdigest()
+
+# Llama states on disk, one file per (model, token prefix), read back through
+# mmap so a cached state lives in the page cache instead of the heap. The
+# directory is kept under max_bytes by deleting the least recently used files;
+# a file's mtime is bumped whenever it is loaded.
+#
+# Writes happen on a background thread: save() only queues the state (which
+# the prefix cache holds anyway), so the request that created it does not
+# wait for hundreds of MB to reach the disk. The writer keeps a running total
+# of the directory size and only walks the tree to evict when it is over
+# max_bytes. At most max_pending states wait for the writer, more are dropped.
+#
+# File layout: MAGIC, u32 header length, JSON header, int32 prefix tokens,
+# raw llama state bytes.
+class SnapshotStore:
+	def __init__(self, root: str, key: str, max_bytes: int, max_pending: int = 8):
+		self.root = root
+		self.key = key
+		self.max_bytes = max_bytes
+		self.dir = os.path.join(root, key)
+		os.makedirs(self.dir, exist_ok=True)
+		for name in os.listdir(self.dir):
+			# left over from a write that was cut off, the workers of a model
+			# share the directory so only old ones are removed
+			path = os.path.join(self.dir, name)
+			if name.endswith(".tmp") and time.time() - os.path.getmtime(path) > STALE_TMP_SECONDS:
+				os.remove(path)
+		self.total_bytes = self._scan()[1]
+		self.pending: queue.Queue = queue.Queue(maxsize=max_pending)
+		self.queued = set()
+		self.lock = threading.Lock()
+		self.writer = threading.Thread(target=self._write_loop, name="snapshot-writer", daemon=True)
+		self.writer.start()
+
+	@classmethod
+	def from_env(cls, model):
+		max_bytes = int(os.environ.get("SNAPSHOT_DIR_BYTES", str(32 * 1024 * 1024 * 1024)))
+		if max_bytes <= 0:
+			return None
+		return cls(os.environ.get("SNAPSHOT_DIR", "/data/snapshots"), model_key(model), max_bytes)
+
+	def path(self, tokens: Sequence[int]) -> str:
+		return os.path.join(self.dir, prefix_hash(tokens) + ".kv")
+
+	# Queues the state for the writer, the state must not change afterwards
+	def save(self, tokens: Sequence[int], state):
+		path = self.path(tokens)
+		with self.lock:
+			if path in self.queued or os.path.exists(path):
+				return
+			try:
+				self.pending.put_nowait((path, list(tokens), state))
+			except queue.Full:
+				print("Snapshot writer busy, not saving", path)
+				return
+			self.queued.add(path)
+
+	# Writes what is queued, then stops the writer
+	def close(self, timeout: float = 10):
+		self.pending.put((None, None, None))
+		self.writer.join(timeout)
+
+	def _write_loop(self):
+		while True:
+			path, tokens, state = self.pending.get()
+			if path is None:
+				return
+			try:
+				self.total_bytes += self._write(path, tokens, state)
+				if self.total_bytes > self.max_bytes:
+					self.cleanup()
+			except Exception as e:
+				print("Error writing snapshot", path, e)
+			finally:
+				with self.lock:
+					self.queued.discard(path)
+
+	def _write(self, path: str, tokens: List[int], state) -> int:
+		header = json.dumps({
+			"n_tokens": state.n_tokens,
+			"n_ctx": len(state.input_ids),
+			"n_vocab": state.scores.shape[1],
+			"llama_state_size": state.llama_state_size,
+			"seed": state.seed,
+			"created_at": time.time(),
+		}).encode("utf-8")
+		tmp_path = f"{path}.{os.getpid()}.tmp"
+		with open(tmp_path, "wb") as f:
+			f.write(MAGIC)
+			f.write(struct.pack("<I", len(header)))
+			f.write(header)
+			f.write(numpy.asarray(tokens, dtype=numpy.int32).tobytes())
+			f.write(memoryview(state.llama_state)[:state.llama_state_size])
+			size = f.tell()
+		os.replace(tmp_path, path)
+		return size
+
+	def _read(self, path: str):
+		with open(path, "rb") as f:
+			mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if mm[:len(MAGIC)] != MAGIC:
+			mm.close()
+			raise ValueError("Not a snapshot file: " + path)
+		offset = len(MAGIC)
+		(header_len,) = struct.unpack_from("<I", mm, offset)
+		offset += 4
+		header = json.loads(mm[offset:offset + header_len])
+		offset += header_len
+		n_tokens = header["n_tokens"]
+		tokens = numpy.frombuffer(mm, dtype=numpy.int32, count=n_tokens, offset=offset)
+		offset += n_tokens * 4
+		return mm, header, tokens, offset
+
+	# Returns the state stored for exactly this prefix, or None
+	def load(self, tokens: Sequence[int]):
+		path = self.path(tokens)
+		if not os.path.exists(path):
+			return None
+		return self.load_file(path)
+
+	def load_file(self, path: str):
+		try:
+			mm, header, tokens, offset = self._read(path)
+		except Exception as e:
+			print("Error reading snapshot", path, e)
+			return None
+		input_ids = numpy.zeros((header["n_ctx"],), dtype=numpy.intc)
+		input_ids[:header["n_tokens"]] = tokens
+		size = header["llama_state_size"]
+		state = LlamaState(
+			input_ids=input_ids,
+			# see compact_state(), one row of logits is enough
+			scores=numpy.zeros((1, header["n_vocab"]), dtype=numpy.single),
+			n_tokens=header["n_tokens"],
+			llama_state=memoryview(mm)[offset:offset + size],
+			llama_state_size=size,
+			seed=header["seed"],
+		)
+		# the memoryview keeps the mapping open for as long as the state is alive
+		os.utime(path)
+		return state
+
+	# Paths of this model's snapshots, most recently used first
+	def files(self) -> List[str]:
+		paths = [os.path.join(self.dir, name) for name in os.listdir(self.dir) if name.endswith(".kv")]
+		return sorted(paths, key=lambda p: os.path.getmtime(p), reverse=True)
+
+	# (mtime, size, path) of the snapshots of all models and their total size
+	def _scan(self):
+		entries = []
+		for dirpath, _, names in os.walk(self.root):
+			for name in names:
+				if name.endswith(".kv"):
+					path = os.path.join(dirpath, name)
+					try:
+						stat = os.stat(path)
+					except FileNotFoundError:
+						# evicted by the server of another model
+						continue
+					entries.append((stat.st_mtime, stat.st_size, path))
+		return entries, sum(size for _, size, _ in entries)
+
+	# Deletes the least recently used snapshots (of all models) until the
+	# directory fits into max_bytes. The directory is shared with the servers
+	# of other models, so the running total is corrected by the walk.
+	def cleanup(self):
+		entries, total = self._scan()
+		for _, size, path in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			total -= size
+			print("Snapshot evicted:", path)
+		self.total_bytes = total
+
+# Loads the snapshots on disk into the prefix cache, most recently used first,
+# then prefills the dialogs of the warmup manifest. The manifest is a JSON list
+# of {"messages": [...], "tools": [...]} requests; their template boundaries are
+# snapshotted the same way as for real requests.
+def warmup(model, prefix_cache, store: SnapshotStore | None, tokenize, manifest_path: str | None):
+	started = time.monotonic()
+	if store is not None:
+		for path in store.files():
+			state = store.load_file(path)
+			if state is None:
+				continue
+			if prefix_cache.total_bytes + state_nbytes(state) > prefix_cache.max_bytes:
+				break
+			prefix_cache.insert(state.input_ids[:state.n_tokens].tolist(), state, state_nbytes(state))
+
+	if manifest_path is not None and os.path.exists(manifest_path):
+		with open(manifest_path, "r") as f:
+			manifest = json.load(f)
+		for entry in manifest:
+			try:
+				tokens, boundaries = tokenize(entry.get("messages"), entry.get("tools"))
+				prefix_cache.prepare(model, tokens, boundaries)
+			except Exception as e:
+				print("Error warming up prompt", e)
+
+	print("Warmup finished in", round(time.monotonic() - started, 2), "s, cached prefixes:", len(prefix_cache.lru))
@@ -0,0 +1,221 @@
+import os
+import time
+from typing import Any, Callable, Dict, Iterator, List
+from llama_cpp import Llama
+from llama_cpp import _internals as internals
+from llama_cpp.llama_grammar import LlamaGrammar
+from registry import open_model
+from tool_grammar import ToolGrammar
+
+# Drafts the continuation of the last n-gram from its most recent earlier
+# occurrence in the context. Summaries of channel history quote names and
+# phrases from the prompt, those come out several tokens per decode step. The
+# n-gram index is built incrementally, every token is indexed once.
+class PromptLookup:
+	def __init__(self, max_ngram: int = 3, num_pred: int = 8):
+		self.max_ngram = max_ngram
+		self.num_pred = num_pred
+		# one dict per n-gram size, n-gram -> position right after its latest occurrence
+		self.index: List[dict] = [{} for _ in range(max_ngram + 1)]
+		self.indexed = 0
+
+	def propose(self, tokens: List[int]) -> List[int]:
+		# index the n-grams that end before the last token, the last one is
+		# what we are looking up
+		for end in range(max(self.indexed, 1), len(tokens)):
+			for n in range(1, min(self.max_ngram, end) + 1):
+				self.index[n][tuple(tokens[end - n:end])] = end
+		self.indexed = max(self.indexed, len(tokens))
+		for n in range(min(self.max_ngram, len(tokens)), 0, -1):
+			start = self.index[n].get(tuple(tokens[-n:]))
+			if start is not None:
+				return tokens[start:start + self.num_pred]
+		return []
+
+# Drafts greedily with a small model that shares the vocabulary (e.g. Gemma 3
+# 1B for 27B). The draft context keeps the longest common prefix between
+# calls, so it only evaluates what changed since the last proposal.
+class DraftModel:
+	def __init__(self, draft: Llama, num_pred: int = 6):
+		self.draft = draft
+		self.num_pred = num_pred
+		self.sampler = internals.LlamaSampler()
+		self.sampler.add_greedy()
+
+	def propose(self, tokens: List[int]) -> List[int]:
+		draft = self.draft
+		if len(tokens) + self.num_pred >= draft.n_ctx():
+			return []
+		in_context = draft.longest_token_prefix(draft.input_ids[:draft.n_tokens].tolist(), tokens)
+		draft.n_tokens = min(in_context, len(tokens) - 1)
+		draft.eval(tokens[draft.n_tokens:])
+		proposed = []
+		for i in range(self.num_pred):
+			token = self.sampler.sample(draft._ctx, -1)
+			proposed.append(token)
+			if i + 1 < self.num_pred:
+				draft.eval([token])
+		return proposed
+
+# Drafting counters of one request. The generator fills them in, the caller
+# (metrics.RequestMetrics) reports them in the perf trailer and /metrics.
+class SpeculativeStats:
+	def __init__(self, mode: str = "lookup"):
+		self.mode = mode
+		self.started = time.monotonic()
+		self.ended = 0.0
+		self.steps = 0
+		self.drafted = 0
+		self.accepted = 0
+		self.generated = 0
+
+	@property
+	def acceptance_rate(self) -> float:
+		return self.accepted / self.drafted if self.drafted > 0 else 0.0
+
+	@property
+	def tokens_per_second(self) -> float:
+		elapsed = (self.ended or time.monotonic()) - self.started
+		return self.generated / elapsed if elapsed > 0 else 0.0
+
+	def finish(self):
+		self.ended = time.monotonic()
+
+	def perf(self) -> dict:
+		return {
+			"mode": self.mode,
+			"steps": self.steps,
+			"drafted": self.drafted,
+			"accepted": self.accepted,
+			"acceptance_rate": round(self.acceptance_rate, 3),
+			"tokens_per_second": round(self.tokens_per_second, 1),
+		}
+
+# The request's sampler chain. A tool call grammar goes first, so the other
+# samplers only ever see tokens the grammar allows. The repetition penalty
+# looks at the last penalty_last_n generated tokens.
+def make_sampler(
+	model: Llama,
+	top_k: int,
+	top_p: float,
+	min_p: float,
+	temp: float,
+	grammar: ToolGrammar | None = None,
+	repeat_penalty: float = 1.0,
+	penalty_last_n: int = 64,
+):
+	sampler = internals.LlamaSampler()
+	if grammar is not None:
+		sampler.add_grammar_lazy_patterns(model._model, LlamaGrammar.from_string(grammar.grammar), grammar.trigger_patterns, grammar.trigger_tokens)
+	if repeat_penalty != 1.0:
+		sampler.add_penalties(model.n_vocab(), penalty_last_n, repeat_penalty, 0.0, 0.0)
+	if temp <= 0:
+		sampler.add_greedy()
+		return sampler
+	sampler.add_top_k(top_k)
+	sampler.add_top_p(top_p, 1)
+	sampler.add_min_p(min_p, 1)
+	sampler.add_temp(temp)
+	sampler.add_dist(model._seed)
+	return sampler
+
+# Speculative decoding on the single sequence context. Every step decodes the
+# last sampled token plus the drafted ones in one batch, then samples each
+# position in order with the normal sampler and keeps drafts for as long as
+# they equal what was sampled. The output is always the target model's own
+# sample, so quality is unchanged; rejected drafts are dropped from the KV cache.
+#
+# model.input_ids/n_tokens are kept up to date, so the prefix cache and
+# session pins see the same context as after model.generate(). With
+# SPECULATIVE=off this is the plain decode loop, it is still used instead of
+# model.generate() because it owns the sampler chain (tool call grammars).
+class Speculation:
+	def __init__(self, mode: str, draft: DraftModel | None = None):
+		self.mode = mode
+		self.draft = draft
+
+	# SPECULATIVE=off|lookup|draft, draft needs a draft model in the profile
+	@classmethod
+	def from_env(cls, model: Llama, draft_profile: Dict[str, Any] | None):
+		mode = os.environ.get("SPECULATIVE", "lookup")
+		if mode == "draft" and draft_profile is None:
+			print("No draft model for this profile, using prompt lookup")
+			mode = "lookup"
+		if mode == "draft":
+			draft = open_model(draft_profile, n_ctx=model.n_ctx(), n_batch=model.n_batch, verbose=False)
+			return cls(mode, DraftModel(draft))
+		return cls(mode if mode == "lookup" else "off")
+
+	def drafter(self):
+		if self.mode == "off":
+			return None
+		return self.draft if self.draft is not None else PromptLookup()
+
+	# Same contract as model.generate(), expects the prompt minus its last token
+	# to be in the context already (see ChunkedPrefill.run()). stats, if given,
+	# is filled in while the tokens are generated.
+	def generate(
+		self,
+		model: Llama,
+		tokens: List[int],
+		top_k: int = 40,
+		top_p: float = 0.95,
+		min_p: float = 0.05,
+		temp: float = 0.8,
+		repeat_penalty: float = 1.0,
+		stopping_criteria: Callable | None = None,
+		grammar: ToolGrammar | None = None,
+		stats: SpeculativeStats | None = None,
+	) -> Iterator[int]:
+		drafter = self.drafter()
+		sampler = make_sampler(model, top_k, top_p, min_p, temp, grammar, repeat_penalty)
+		if stats is None:
+			stats = SpeculativeStats(self.mode)
+		all_tokens = list(tokens)
+		max_draft = model.n_batch - 1
+		in_context = model.longest_token_prefix(model.input_ids[:model.n_tokens].tolist(), all_tokens)
+		model.n_tokens = min(in_context, len(all_tokens) - 1)
+		pending = all_tokens[model.n_tokens:]
+		try:
+			while True:
+				if len(pending) == 1 and drafter is not None:
+					room = min(max_draft, model.n_ctx() - model.n_tokens - 1)
+					drafts = drafter.propose(all_tokens)[:room] if room > 0 else []
+					pending.extend(drafts)
+				else:
+					# prompt suffix that is not in the context yet, or no drafting
+					drafts = []
+				n_past = model.n_tokens
+				model._ctx.kv_cache_seq_rm(-1, n_past, -1)
+				for start in range(0, len(pending), model.n_batch):
+					chunk = pending[start:start + model.n_batch]
+					model._batch.set_batch(chunk, n_past=n_past + start, logits_all=len(drafts) > 0)
+					model._ctx.decode(model._batch)
+				model.input_ids[n_past:n_past + len(pending)] = pending
+				model.n_tokens = n_past + len(pending)
+				model._requires_eval = False
+				stats.steps += 1
+				stats.drafted += len(drafts)
+
+				accepted = 0
+				for i in range(len(drafts) + 1):
+					# with drafts the step fits one batch and has logits for every position
+					token = sampler.sample(model._ctx, i if len(drafts) > 0 else -1)
+					all_tokens.append(token)
+					stats.generated += 1
+					if stopping_criteria is not None and stopping_criteria(all_tokens, None):
+						return
+					yield token
+					if i < len(drafts) and drafts[i] == token:
+						accepted += 1
+						continue
+					break
+				stats.accepted += accepted
+				# keep the evaluated tokens up to the last accepted draft, the newly
+				# sampled token is evaluated in the next step
+				model.n_tokens = n_past + len(pending) - len(drafts) + accepted
+				model._ctx.kv_cache_seq_rm(-1, model.n_tokens, -1)
+				pending = [all_tokens[-1]]
+		finally:
+			sampler.close()
+			stats.finish()
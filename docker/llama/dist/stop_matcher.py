@@ -0,0 +1,87 @@
+import json
+from typing import List, Tuple
+
+# Finds any of a few strings (stop sequences, tool call openers/closers) in
+# text that arrives piece by piece. Text that could be the start of a match is
+# held back until the next piece decides it, everything else is released right
+# away, so a match split over several tokens or starting in the middle of a
+# token is found without rescanning the whole output.
+class StopMatcher:
+	def __init__(self, patterns: List[str]):
+		self.patterns = [p for p in patterns if p != ""]
+		self.held = ""
+		# text after the last match, the caller decides what to do with it
+		self.remainder = ""
+
+	# Returns the text that is certainly not part of a match and the pattern
+	# that matched (None if no match yet). After a match, the text before it is
+	# returned and the text after it is kept in remainder.
+	def push(self, text: str) -> Tuple[str, str | None]:
+		buffer = self.held + text
+		self.held = ""
+		best = -1
+		matched = None
+		for pattern in self.patterns:
+			i = buffer.find(pattern)
+			if i >= 0 and (best < 0 or i < best):
+				best = i
+				matched = pattern
+		if matched is not None:
+			self.remainder = buffer[best + len(matched):]
+			return buffer[:best], matched
+
+		hold = 0
+		for pattern in self.patterns:
+			for n in range(min(len(pattern) - 1, len(buffer)), hold, -1):
+				if buffer.endswith(pattern[:n]):
+					hold = n
+					break
+		if hold > 0:
+			self.held = buffer[-hold:]
+			return buffer[:-hold], None
+		return buffer, None
+
+	# Held text at the end of the stream, it did not turn into a match
+	def flush(self) -> str:
+		held = self.held
+		self.held = ""
+		return held
+
+# Tracks where a JSON value that arrives piece by piece ends (brackets outside
+# of strings), for tool call formats without a closing tag
+class JsonValueEnd:
+	def __init__(self):
+		self.depth = 0
+		self.started = False
+		self.in_string = False
+		self.escaped = False
+
+	# Returns the offset in text right after the value closes, or -1
+	def push(self, text: str) -> int:
+		for i, c in enumerate(text):
+			if self.in_string:
+				if self.escaped:
+					self.escaped = False
+				elif c == "\\":
+					self.escaped = True
+				elif c == "\"":
+					self.in_string = False
+			elif c == "\"":
+				self.in_string = True
+			elif c in "[{":
+				self.depth += 1
+				self.started = True
+			elif c in "]}" and self.started:
+				# a stray closing bracket before the value is ignored
+				self.depth -= 1
+				if self.depth == 0:
+					return i + 1
+		return -1
+
+# Normalized JSON of a complete tool call, or the raw text if it does not parse
+def normalize_json_call(text: str) -> str:
+	try:
+		return json.dumps(json.loads(text))
+	except Exception as e:
+		print("Error parsing tool call:", text, e)
+		return text
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple
+from llama_cpp.llama_grammar import SchemaConverter
+from chat_template import canonical_tools
+
+# A lazy grammar: sampling is unconstrained until one of the trigger tokens is
+# sampled or the generated text matches one of the trigger patterns, from then
+# on the grammar applies. The grammar starts with the opener itself, llama.cpp
+# feeds it the trigger token's text (or the text from the pattern's first group).
+class ToolGrammar(NamedTuple):
+	grammar: str
+	trigger_patterns: List[str]
+	trigger_tokens: List[int]
+
+REGEX_SPECIAL = set("\\^$.|?*+()[]{}")
+
+# Matches generated text containing text, for llama.cpp's std::regex (ECMAScript)
+def trigger_pattern(text: str) -> str:
+	escaped = "".join("\\n" if c == "\n" else "\\" + c if c in REGEX_SPECIAL else c for c in text)
+	return "[\\s\\S]*?(" + escaped + ")[\\s\\S]*"
+
+def gbnf_literal(text: str) -> str:
+	return json.dumps(text)
+
+def _function(tool: Dict[str, Any]) -> Dict[str, Any]:
+	return tool.get("function", tool)
+
+def _parameters(tool: Dict[str, Any]) -> Dict[str, Any]:
+	parameters = _function(tool).get("parameters")
+	if not isinstance(parameters, dict) or len(parameters) == 0:
+		return {"type": "object", "properties": {}}
+	return parameters
+
+# {"name": <tool name>, "arguments": <arguments matching the tool's parameters>},
+# one alternative per tool. Used by the JSON tool call formats (Qwen, Mistral).
+def json_call_rule(converter: SchemaConverter, tools: List[Dict[str, Any]], name: str) -> str:
+	calls = []
+	for tool in tools:
+		calls.append({
+			"type": "object",
+			"properties": {
+				"name": {"const": _function(tool).get("name")},
+				"arguments": _parameters(tool),
+			},
+			"required": ["name", "arguments"],
+			"additionalProperties": False,
+		})
+	return converter.visit({"oneOf": calls} if len(calls) > 1 else calls[0], name)
+
+def json_tool_call_grammar(opener: str, closer: str, tools: List[Dict[str, Any]], array: bool = False) -> str:
+	converter = SchemaConverter(prop_order={"name": 0, "arguments": 1}, allow_fetch=False, dotall=False, raw_pattern=False)
+	call = json_call_rule(converter, tools, "call")
+	if array:
+		body = f'"[" space {call} ("," space {call})* "]"'
+	else:
+		body = call
+	closer = " " + gbnf_literal(closer) if closer != "" else ""
+	return f"root ::= {gbnf_literal(opener)} {body}{closer}\n" + converter.format_grammar()
+
+PYTHON_VALUES = {
+	"integer": '"-"? [0-9]+',
+	"number": '"-"? [0-9]+ ("." [0-9]+)?',
+	"boolean": '("True" | "False")',
+	"string": '"\\"" [^"\\\\\\n]* "\\""',
+}
+
+def _python_value(converter: SchemaConverter, schema: Dict[str, Any], name: str) -> str:
+	if "enum" in schema:
+		return "(" + " | ".join(gbnf_literal(repr(value)) for value in schema["enum"]) + ")"
+	value = PYTHON_VALUES.get(schema.get("type"))
+	if value is not None:
+		return "(" + value + ")"
+	# lists and dicts, JSON is close enough to a Python literal
+	return converter.visit(schema, name)
+
+# name(arg=value, ...) with the required arguments first in the order of the
+# schema's required list, so the regexes in gemma3.py parse it. Used by the
+# Python tool call format (Gemma 3). Returns the rule's body, the value rules
+# it refers to are added to the converter.
+def python_call_rule(converter: SchemaConverter, tool: Dict[str, Any], name: str) -> str:
+	parameters = _parameters(tool)
+	properties = parameters.get("properties", {})
+	required = [p for p in parameters.get("required", []) if p in properties]
+	optional = [p for p in properties if p not in required]
+	args = []
+	for i, param in enumerate(required + optional):
+		arg = gbnf_literal(param + "=") + " " + _python_value(converter, properties[param], f"{name}-{param}")
+		if i > 0:
+			arg = '", " ' + arg
+		if param in optional:
+			arg = "(" + arg + ")?"
+		args.append(arg)
+	return gbnf_literal(_function(tool).get("name") + "(") + " " + " ".join(args) + ' ")"'
+
+def python_tool_call_grammar(opener: str, closer: str, tools: List[Dict[str, Any]]) -> str:
+	converter = SchemaConverter(prop_order={}, allow_fetch=False, dotall=False, raw_pattern=False)
+	calls = [(f"call{i}", python_call_rule(converter, tool, f"call{i}")) for i, tool in enumerate(tools)]
+	rules = [f'root ::= {gbnf_literal(opener)} call ("\\n" call)* {gbnf_literal(closer)}']
+	rules.append("call ::= " + " | ".join(name for name, _ in calls))
+	rules.extend(f"{name} ::= {body}" for name, body in calls)
+	return "\n".join(rules) + "\n" + converter.format_grammar()
+
+# Tool call grammars by tool set. The backend sends the same few tool sets over
+# and over, so building the grammar from the schemas only happens on the first
+# request with a new set. Shared by the engine threads.
+class ToolGrammarCache:
+	def __init__(self, build: Callable[[List[Dict[str, Any]]], str], trigger_patterns: List[str], trigger_tokens: List[int], max_entries: int = 64):
+		self.build = build
+		self.trigger_patterns = trigger_patterns
+		self.trigger_tokens = trigger_tokens
+		self.max_entries = max_entries
+		self.entries: OrderedDict = OrderedDict()
+		self.lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, tools: List[Dict[str, Any]] | None) -> ToolGrammar | None:
+		tools = canonical_tools(tools)
+		if len(tools) == 0:
+			return None
+		key = hashlib.blake2b(json.dumps(tools).encode("utf-8"), digest_size=16).digest()
+		with self.lock:
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return self.entries[key]
+			self.misses += 1
+
+		try:
+			grammar = ToolGrammar(self.build(tools), self.trigger_patterns, self.trigger_tokens)
+		except Exception as e:
+			# generate unconstrained rather than failing the request, the
+			# failure is cached like a grammar
+			print("Error building tool call grammar:", e)
+			grammar = None
+		with self.lock:
+			self.entries[key] = grammar
+			self.entries.move_to_end(key)
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+		return grammar
+
+	def stats(self):
+		with self.lock:
+			return {
+				"hits": self.hits,
+				"misses": self.misses,
+				"entries": len(self.entries),
+			}
@@ -0,0 +1,134 @@
+import collections
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Any, Callable, Dict, List
+
+# Keys of the elements of a channel message list, as the backend's
+# getRecentChannelMessages/getChannelMessagesRange return them
+MESSAGE_KEYS = {"createdAt", "userName", "text"}
+
+# names at least this long get a short alias if they occur more than once
+ALIAS_MIN_LENGTH = 7
+
+SPACES = re.compile(r"[ \t\u00a0]+")
+
+def is_channel_messages(results: Any) -> bool:
+	return (
+		isinstance(results, list) and len(results) > 0 and
+		all(isinstance(r, dict) and set(r.keys()) == MESSAGE_KEYS and all(isinstance(v, str) for v in r.values()) for r in results)
+	)
+
+def _clean(text: str) -> List[str]:
+	lines = [SPACES.sub(" ", line).strip() for line in text.splitlines()]
+	return [line for line in lines if line != ""] or [""]
+
+def _name(name: str) -> str:
+	return SPACES.sub(" ", name.replace("\n", " ").replace(":", "")).strip() or "?"
+
+# One line per message instead of a JSON object: the date is written once per
+# day, each message carries its time of day, long user names that repeat are
+# replaced by an alias from a dictionary in the header, runs of whitespace are
+# collapsed and continuation lines of multi-line messages are indented.
+#   12 messages, oldest first. Users: u1 = Alexandra Miller, u2 = community-bot
+#   == 2025-01-27 ==
+#   09:12 u1: the stream starts at eight
+#   09:15 Bob: who is joining?
+#     I can bring the slides
+def encode_channel_messages(messages: List[Dict[str, str]]) -> str:
+	names = [_name(m["userName"]) for m in messages]
+	counts = collections.Counter(names)
+	aliases = {}
+	for name, count in counts.most_common():
+		if (count > 1 and len(name) >= ALIAS_MIN_LENGTH) or re.fullmatch(r"u\d+", name):
+			aliases[name] = "u" + str(len(aliases) + 1)
+
+	header = f"{len(messages)} messages, oldest first."
+	if len(aliases) > 0:
+		header += " Users: " + ", ".join(f"{alias} = {name}" for name, alias in aliases.items())
+	lines = [header]
+	day = None
+	for message, name in zip(messages, names):
+		date, _, time = message["createdAt"].strip().partition(" ")
+		if time == "":
+			# not "YYYY-MM-DD HH:mm", written as it is
+			date, time = None, message["createdAt"].strip()
+		elif date != day:
+			day = date
+			lines.append(f"== {date} ==")
+		text = _clean(message["text"])
+		lines.append(f"{time} {aliases.get(name, name)}: {text[0]}")
+		lines.extend("  " + line for line in text[1:])
+	return "\n".join(lines)
+
+# Re-encodes tool results before they are tokenized, per model family:
+# TOOL_RESULT_ENCODING_<FAMILY> or TOOL_RESULT_ENCODING, "compact" (default)
+# or "json" (verbatim, as before). Tool results come back with every later
+# request of a dialog, so the encoding is remembered per content.
+#
+# count_tokens measures the saving once per distinct tool result, exported as
+# the tokens before and after of the stats.
+class ToolResultEncoder:
+	def __init__(self, mode: str, count_tokens: Callable[[str], int], max_entries: int = 256):
+		if mode not in ("compact", "json"):
+			raise ValueError("Unknown tool result encoding: " + mode)
+		self.mode = mode
+		self.count_tokens = count_tokens
+		self.max_entries = max_entries
+		self.entries: collections.OrderedDict = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.encoded = 0
+		self.tokens_before = 0
+		self.tokens_after = 0
+
+	@classmethod
+	def from_env(cls, family: str, count_tokens: Callable[[str], int]):
+		mode = os.environ.get("TOOL_RESULT_ENCODING_" + family.upper(), os.environ.get("TOOL_RESULT_ENCODING", "compact"))
+		return cls(mode, count_tokens)
+
+	# The compact text of a tool message's content, None if it is not a
+	# channel message list (or the encoding is off), then the caller
+	# tokenizes it the way it always did
+	def encode(self, content: str) -> str | None:
+		if self.mode == "json":
+			return None
+		key = hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				self.entries.move_to_end(key)
+		if entry is None:
+			try:
+				results = json.loads(content)
+			except ValueError:
+				results = None
+			if not is_channel_messages(results):
+				entry = (None, 0, 0)
+			else:
+				text = encode_channel_messages(results)
+				before = self.count_tokens("\n".join(json.dumps(r) for r in results))
+				after = self.count_tokens(text)
+				print("Tool result encoded:", before, "->", after, "tokens")
+				entry = (text, before, after)
+			with self.lock:
+				self.entries[key] = entry
+				while len(self.entries) > self.max_entries:
+					self.entries.popitem(last=False)
+		text, before, after = entry
+		if text is not None:
+			with self.lock:
+				self.encoded += 1
+				self.tokens_before += before
+				self.tokens_after += after
+		return text
+
+	def stats(self) -> dict:
+		with self.lock:
+			return {
+				"encoded": self.encoded,
+				"tokens_before": self.tokens_before,
+				"tokens_after": self.tokens_after,
+				"entries": len(self.entries),
+			}
@@ -0,0 +1,210 @@
+import collections
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from tool_results import encode_channel_messages, is_channel_messages
+
+# System prompt of every chunk summary. It is the same for all requests, so
+# consecutive chunks only prefill their own text after it.
+SUMMARY_PROMPT = (
+	"You condense the output of a tool call for an assistant that cannot read all of it. "
+	"You get one part of the output, for example a range of chat messages of a channel "
+	"(a line per message: time, user, text). Write a summary of that part only: keep the "
+	"names of the users, the dates, numbers, decisions, open questions and links, and who "
+	"said what when it matters; leave out greetings, small talk and repetitions. Answer "
+	"with the summary as plain text, no introduction, a few short paragraphs at most."
+)
+
+# the user's question is added to every chunk prompt, cut to this length
+QUESTION_CHARS = 600
+
+# Map-reduce summarization of tool outputs that are too large for the
+# context. A tool message of the current turn (after the last user message)
+# with more than threshold tokens is split into chunks of at most chunk_tokens
+# tokens, every chunk is summarized with SUMMARY_PROMPT and the summaries
+# replace the tool output. Summaries that are still above threshold are
+# summarized again, at most max_rounds times. Older tool outputs are left to
+# the context planner, which elides them.
+#
+# The server passes start(messages), which tokenizes a chunk prompt and
+# returns the iterator of generated tokens, and detokenize(tokens). With the
+# batch engine (batched) all chunks of a round are started before the first is
+# read, so they are decoded together; without it one after the other.
+#
+# A tool output comes back with every later request of its turn, the
+# summaries are remembered per content and question.
+class ToolSummarizer:
+	def __init__(self, threshold: int, chunk_tokens: int, summary_tokens: int, batched: bool, max_rounds: int = 3, max_entries: int = 64):
+		self.threshold = threshold
+		self.chunk_tokens = chunk_tokens
+		self.summary_tokens = summary_tokens
+		self.batched = batched
+		self.max_rounds = max_rounds
+		self.max_entries = max_entries
+		self.entries: collections.OrderedDict = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.summarized = 0
+		self.chunks = 0
+		self.hits = 0
+		self.tokens_before = 0
+		self.tokens_after = 0
+
+	# TOOL_SUMMARY_THRESHOLD (tokens, default half the context, 0 turns it
+	# off), TOOL_SUMMARY_CHUNK_TOKENS, TOOL_SUMMARY_TOKENS
+	@classmethod
+	def from_env(cls, n_ctx: int, batched: bool):
+		summary_tokens = int(os.environ.get("TOOL_SUMMARY_TOKENS", "384"))
+		return cls(
+			threshold=int(os.environ.get("TOOL_SUMMARY_THRESHOLD", str(n_ctx // 2))),
+			chunk_tokens=max(256, int(os.environ.get("TOOL_SUMMARY_CHUNK_TOKENS", str(n_ctx - summary_tokens - 512)))),
+			summary_tokens=summary_tokens,
+			batched=batched,
+		)
+
+	# The messages with the oversized tool outputs of the current turn replaced
+	# by their summaries, plus one action per summarized message for the
+	# context frame. progress(done, total) is called per finished chunk.
+	def apply(
+		self,
+		messages: List[Dict[str, Any]],
+		tools,
+		tokenize: Callable,
+		count_tokens: Callable[[str], int],
+		start: Callable[[List[Dict[str, str]]], Iterator[int]],
+		detokenize: Callable[[List[int]], str],
+		progress: Callable[[int, int], None],
+		cancelled: Callable[[], bool],
+	) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+		if self.threshold <= 0:
+			return messages, []
+		last_user = max([i for i in range(1, len(messages)) if messages[i].get("role") == "user"], default=0)
+		candidates = [i for i in range(last_user + 1, len(messages)) if messages[i].get("role") == "tool"]
+		if len(candidates) == 0:
+			return messages, []
+		_, boundaries = tokenize(messages, tools)
+		# boundaries[i] is where messages[i] ends
+		oversized = [i for i in candidates if boundaries[i] - boundaries[i - 1] > self.threshold]
+		if len(oversized) == 0:
+			return messages, []
+
+		question = str(messages[last_user].get("content") or "")[-QUESTION_CHARS:] if last_user > 0 else ""
+		messages = list(messages)
+		actions = []
+		for i in oversized:
+			before = boundaries[i] - boundaries[i - 1]
+			summary, chunks = self._summarize(messages[i].get("content"), question, count_tokens, start, detokenize, progress, cancelled)
+			if cancelled():
+				return messages, actions
+			messages[i] = dict(messages[i], content=summary)
+			_, boundaries = tokenize(messages, tools)
+			after = boundaries[i] - boundaries[i - 1]
+			actions.append({"action": "summarize_tool_output", "messages": 1, "chunks": chunks, "tokens": before - after})
+			with self.lock:
+				self.summarized += 1
+				self.tokens_before += before
+				self.tokens_after += after
+		return messages, actions
+
+	# (content of the replacement tool message, chunks of the first round)
+	def _summarize(self, content: str, question: str, count_tokens, start, detokenize, progress, cancelled) -> Tuple[str, int]:
+		key = hashlib.blake2b((question + "\0" + content).encode("utf-8"), digest_size=16).digest()
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is not None:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return entry
+
+		try:
+			results = json.loads(content)
+		except ValueError:
+			results = None
+		if is_channel_messages(results):
+			text = encode_channel_messages(results)
+			what = f"{len(results)} channel messages"
+		else:
+			text = content
+			what = "a tool output"
+
+		chunks = self._chunks(text, count_tokens)
+		first = len(chunks)
+		for attempt in range(self.max_rounds):
+			print(f"Summarizing {what}: round {attempt + 1}, {len(chunks)} chunks")
+			summaries = self._map(chunks, question, start, detokenize, progress, cancelled)
+			if cancelled():
+				return content, first
+			if len(summaries) == 1:
+				text = summaries[0]
+			else:
+				text = "\n\n".join(f"Part {k + 1} of {len(summaries)}:\n{s}" for k, s in enumerate(summaries))
+			if len(chunks) == 1 or count_tokens(text) <= self.threshold:
+				break
+			chunks = self._chunks(text, count_tokens)
+
+		# a list like the tool results of the backend, so every chat template accepts it
+		entry = (json.dumps([{"summarized": f"{what} that did not fit the context window, summarized in {first} parts", "summary": text}]), first)
+		with self.lock:
+			self.chunks += first
+			self.entries[key] = entry
+			while len(self.entries) > self.max_entries:
+				self.entries.popitem(last=False)
+		return entry
+
+	# Splits text at line ends into pieces of at most chunk_tokens tokens, a
+	# line longer than that is cut by characters
+	def _chunks(self, text: str, count_tokens) -> List[str]:
+		pieces = []
+		for line in text.split("\n"):
+			tokens = count_tokens(line) + 1
+			if tokens <= self.chunk_tokens:
+				pieces.append((line, tokens))
+				continue
+			step = max(1, len(line) * self.chunk_tokens // tokens)
+			pieces.extend((line[p:p + step], self.chunk_tokens) for p in range(0, len(line), step))
+		chunks = []
+		lines: List[str] = []
+		size = 0
+		for piece, tokens in pieces:
+			if len(lines) > 0 and size + tokens > self.chunk_tokens:
+				chunks.append("\n".join(lines))
+				lines = []
+				size = 0
+			lines.append(piece)
+			size += tokens
+		if len(lines) > 0:
+			chunks.append("\n".join(lines))
+		return chunks
+
+	def _prompt(self, chunk: str, part: int, parts: int, question: str) -> List[Dict[str, str]]:
+		content = f"Part {part + 1} of {parts} of the tool output:\n\n{chunk}"
+		if question != "":
+			content += "\n\nThe user's request, for what matters most:\n" + question
+		return [{"role": "system", "content": SUMMARY_PROMPT}, {"role": "user", "content": content}]
+
+	def _map(self, chunks: List[str], question: str, start, detokenize, progress, cancelled) -> List[str]:
+		summaries = []
+		running = []
+		for k, chunk in enumerate(chunks):
+			if cancelled():
+				break
+			running.append(start(self._prompt(chunk, k, len(chunks), question)))
+			if not self.batched:
+				summaries.append(detokenize(list(running.pop())).strip())
+				progress(len(summaries), len(chunks))
+		for tokens in running:
+			summaries.append(detokenize(list(tokens)).strip())
+			progress(len(summaries), len(chunks))
+		return summaries
+
+	def stats(self) -> dict:
+		with self.lock:
+			return {
+				"summarized": self.summarized,
+				"chunks": self.chunks,
+				"hits": self.hits,
+				"tokens_before": self.tokens_before,
+				"tokens_after": self.tokens_after,
+				"entries": len(self.entries),
+			}
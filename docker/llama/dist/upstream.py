@@ -0,0 +1,164 @@
+import asyncio
+import collections
+import subprocess
+import time
+from typing import Callable, Dict, List
+import httpx
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from framing import error_frame
+
+# Child server processes and the proxying of their streams, shared by the
+# model router (router.py) and the CPU worker supervisor (workers.py).
+
+FORWARDED_HEADERS = ("authorization", "content-type", "last-event-id")
+
+# request ids remembered for interrupts and resumes
+MAX_REQUESTS = 10000
+
+def forwarded(http_request: Request) -> Dict[str, str]:
+	return {k: v for k, v in http_request.headers.items() if k in FORWARDED_HEADERS}
+
+# A server process (qwen.py, mistral.py or gemma3.py) listening on a local port
+class ServerProcess:
+	def __init__(self, name: str, command: List[str], env: Dict[str, str], port: int, memory_bytes: int = 0):
+		self.name = name
+		self.command = command
+		self.env = env
+		self.port = port
+		self.url = f"http://127.0.0.1:{port}"
+		self.memory_bytes = memory_bytes
+		self.process: subprocess.Popen | None = None
+		self.loading: asyncio.Future | None = None
+		self.ready = False
+		self.draining = False
+		# proxied streams, a process is only stopped when it has none
+		self.active = 0
+		self.last_used = time.monotonic()
+
+	# preexec_fn runs in the child before the server starts (CPU affinity)
+	def launch(self, preexec_fn: Callable[[], None] | None = None):
+		env = dict(self.env)
+		env["HOST"] = "127.0.0.1"
+		env["PORT"] = str(self.port)
+		print("Starting", self.name, "on port", self.port)
+		self.ready = False
+		self.process = subprocess.Popen(self.command, env=env, preexec_fn=preexec_fn)
+
+	def alive(self) -> bool:
+		return self.process is not None and self.process.poll() is None
+
+	async def wait_ready(self, client: httpx.AsyncClient, timeout: float):
+		deadline = time.monotonic() + timeout
+		while True:
+			if not self.alive():
+				raise RuntimeError(f"{self.name} exited with code {self.process.returncode}")
+			try:
+				response = await client.get(self.url + "/ready", timeout=5)
+				if response.status_code == 200:
+					self.ready = True
+					print(self.name, "is ready")
+					return
+			except httpx.TransportError:
+				pass
+			if time.monotonic() > deadline:
+				raise TimeoutError(f"{self.name} was not ready after {timeout} s")
+			await asyncio.sleep(0.5)
+
+	# SIGTERM runs the server's shutdown handler, which closes the model
+	async def stop(self, timeout: float = 30):
+		if not self.alive():
+			return
+		print("Stopping", self.name, "on port", self.port)
+		self.process.terminate()
+		try:
+			await asyncio.get_running_loop().run_in_executor(None, self.process.wait, timeout)
+		except subprocess.TimeoutExpired:
+			print(self.name, "did not stop, killing it")
+			self.process.kill()
+			await asyncio.get_running_loop().run_in_executor(None, self.process.wait)
+
+# Forwards a /generate request to the process and streams the answer back.
+# release() is called once the stream ended (or failed), requests maps the
+# latest MAX_REQUESTS request ids to their process for interrupts and resumes.
+async def proxy_generate(
+	client: httpx.AsyncClient,
+	process: ServerProcess,
+	http_request: Request,
+	body: bytes,
+	release: Callable[[], None],
+	requests: collections.OrderedDict,
+) -> Response:
+	try:
+		upstream = await client.send(
+			client.build_request("POST", process.url + "/generate", content=body, headers=forwarded(http_request)),
+			stream=True,
+		)
+	except httpx.TransportError as e:
+		release()
+		print("Error forwarding to", process.name, e)
+		return Response(status_code=502, content="Model server unavailable")
+	if upstream.status_code != 200:
+		content = await upstream.aread()
+		await upstream.aclose()
+		release()
+		headers = {"Retry-After": upstream.headers["retry-after"]} if "retry-after" in upstream.headers else None
+		return Response(status_code=upstream.status_code, content=content, headers=headers)
+
+	request_id = upstream.headers["x-request-id"]
+	requests[request_id] = process
+	requests.move_to_end(request_id)
+	while len(requests) > MAX_REQUESTS:
+		requests.popitem(last=False)
+
+	async def relay():
+		try:
+			async for chunk in upstream.aiter_raw():
+				yield chunk
+		except httpx.TransportError as e:
+			print("Error streaming from", process.name, e)
+			yield error_frame("Error: Model server went away")
+		finally:
+			await upstream.aclose()
+			release()
+
+	return StreamingResponse(relay(), media_type="text/event-stream", headers={"X-Request-Id": request_id})
+
+def _with_label(line: str, label: str) -> str:
+	name, _, rest = line.partition(" ")
+	if "{" in name or "{" in rest[:1]:
+		head, _, tail = line.partition("{")
+		return head + "{" + label + "," + tail
+	return name + "{" + label + "} " + rest
+
+# The metrics of several processes in one exposition, HELP/TYPE once per
+# metric. Samples of processes that share their labels get an extra label
+# (e.g. worker="1") to tell them apart.
+async def merge_metrics(
+	client: httpx.AsyncClient,
+	processes: List[ServerProcess],
+	headers: Dict[str, str],
+	families: Dict[str, List[str]],
+	label: Callable[[ServerProcess], str] | None = None,
+) -> str:
+	for process in processes:
+		try:
+			response = await client.get(process.url + "/metrics", headers=headers, timeout=10)
+		except httpx.TransportError as e:
+			print("Error reading metrics of", process.name, e)
+			continue
+		extra = label(process) if label is not None else None
+		current = None
+		first = False
+		for line in response.text.splitlines():
+			if line.startswith("# "):
+				name = line.split(" ")[2]
+				if name != current:
+					current = name
+					first = name not in families
+					families.setdefault(name, [])
+				if first:
+					families[name].append(line)
+			elif line and current is not None:
+				families[current].append(_with_label(line, extra) if extra is not None else line)
+	return "\n".join(line for lines in families.values() for line in lines) + "\n"
@@ -0,0 +1,271 @@
+import asyncio
+import collections
+import glob
+import json
+import os
+import sys
+from typing import Dict, List
+import httpx
+from fastapi import FastAPI, Request, Security, HTTPException
+from fastapi.responses import Response
+from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from upstream import ServerProcess, forwarded, merge_metrics, proxy_generate
+
+# Supervisor for CPU hosts: runs WORKERS copies of one server (qwen.py,
+# mistral.py or gemma3.py) and sends every /generate to the worker with the
+# fewest running streams.
+#
+#   python3 /dist/workers.py qwen
+#
+# Workers are spread over the NUMA nodes, each one pinned to its share of the
+# cores of its node and running llama.cpp with one thread per physical core of
+# that share (N_THREADS/N_THREADS_BATCH, see registry.py). The KV cache of a
+# worker is then allocated on its own node. The weights are mmap'd (llama.cpp's
+# default), so all workers share one copy of them in the page cache; what a
+# worker adds is its context and its caches. PREFIX_CACHE_BYTES and
+# SESSION_CACHE_BYTES are budgets for the host, every worker gets an equal
+# share of them.
+#
+# WORKERS defaults to one per NUMA node, WORKER_BASE_PORT to 9100.
+
+DIST = os.path.dirname(os.path.abspath(__file__))
+
+# sessions remembered for routing follow-up requests to the same worker
+MAX_SESSIONS = 10000
+
+# host cache budgets that are split between the workers, with the servers'
+# defaults (prefix_cache.py, sessions.py)
+CACHE_BUDGETS = {
+	"PREFIX_CACHE_BYTES": 4 * 1024 * 1024 * 1024,
+	"SESSION_CACHE_BYTES": 2 * 1024 * 1024 * 1024,
+}
+
+def _cpu_list(text: str) -> List[int]:
+	cpus = []
+	for part in text.strip().split(","):
+		if part == "":
+			continue
+		if "-" in part:
+			start, end = part.split("-")
+			cpus.extend(range(int(start), int(end) + 1))
+		else:
+			cpus.append(int(part))
+	return cpus
+
+# CPUs of every NUMA node that this process may run on
+def numa_nodes() -> List[List[int]]:
+	allowed = os.sched_getaffinity(0)
+	nodes = []
+	for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist"), key=lambda p: int(p.split("/")[-2][4:])):
+		with open(path, "r") as f:
+			cpus = [c for c in _cpu_list(f.read()) if c in allowed]
+		if len(cpus) > 0:
+			nodes.append(cpus)
+	return nodes if len(nodes) > 0 else [sorted(allowed)]
+
+# The CPUs grouped by physical core (SMT siblings together)
+def physical_cores(cpus: List[int]) -> List[List[int]]:
+	cores: Dict[int, List[int]] = {}
+	for cpu in cpus:
+		try:
+			with open(f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list", "r") as f:
+				siblings = [c for c in _cpu_list(f.read()) if c in cpus]
+		except OSError:
+			siblings = [cpu]
+		cores.setdefault(min(siblings + [cpu]), []).append(cpu)
+	return [cores[k] for k in sorted(cores)]
+
+# CPU sets of count workers: round robin over the nodes, the cores of a node
+# split evenly between its workers
+def plan_workers(count: int, nodes: List[List[int]]) -> List[List[int]]:
+	per_node = [0] * len(nodes)
+	for i in range(count):
+		per_node[i % len(nodes)] += 1
+	plans = []
+	for node, workers in zip(nodes, per_node):
+		cores = physical_cores(node)
+		if workers > len(cores):
+			raise ValueError(f"{workers} workers for {len(cores)} cores")
+		for i in range(workers):
+			share = cores[i * len(cores) // workers:(i + 1) * len(cores) // workers]
+			plans.append([cpu for core in share for cpu in core])
+	return plans
+
+class WorkerPool:
+	def __init__(self, command: List[str], plans: List[List[int]], base_port: int, load_timeout: float):
+		self.plans = plans
+		self.load_timeout = load_timeout
+		self.workers: List[ServerProcess] = []
+		for i, cpus in enumerate(plans):
+			threads = str(len(physical_cores(cpus)))
+			env = dict(os.environ)
+			env["N_THREADS"] = threads
+			env["N_THREADS_BATCH"] = threads
+			for name, default in CACHE_BUDGETS.items():
+				env[name] = str(int(os.environ.get(name, str(default))) // len(plans))
+			self.workers.append(ServerProcess(f"worker {i}", command, env, base_port + i))
+		# request id -> worker, for interrupts and resumes
+		self.requests: collections.OrderedDict = collections.OrderedDict()
+		# session id -> worker that has the session cached
+		self.sessions: collections.OrderedDict = collections.OrderedDict()
+		self.restarts = 0
+		self.client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=10))
+
+	@classmethod
+	def from_env(cls, server: str):
+		nodes = numa_nodes()
+		count = int(os.environ.get("WORKERS", str(len(nodes))))
+		return cls(
+			[sys.executable, os.path.join(DIST, server + ".py")],
+			plan_workers(count, nodes),
+			base_port=int(os.environ.get("WORKER_BASE_PORT", "9100")),
+			load_timeout=float(os.environ.get("WORKER_LOAD_TIMEOUT", "1800")),
+		)
+
+	def _launch(self, i: int):
+		cpus = set(self.plans[i])
+		worker = self.workers[i]
+		worker.launch(preexec_fn=lambda: os.sched_setaffinity(0, cpus))
+		worker.loading = asyncio.ensure_future(worker.wait_ready(self.client, self.load_timeout))
+
+	def start(self):
+		for i, cpus in enumerate(self.plans):
+			print(f"Worker {i}: CPUs {','.join(map(str, cpus))}, {self.workers[i].env['N_THREADS']} threads")
+			self._launch(i)
+
+	# Restarts workers that died
+	async def supervise(self):
+		while True:
+			await asyncio.sleep(5)
+			for i, worker in enumerate(self.workers):
+				if not worker.alive():
+					print(worker.name, "exited with code", worker.process.returncode, "restarting it")
+					self.restarts += 1
+					for request_id in [r for r, w in self.requests.items() if w is worker]:
+						del self.requests[request_id]
+					for session_id in [s for s, w in self.sessions.items() if w is worker]:
+						del self.sessions[session_id]
+					self._launch(i)
+
+	# The ready worker with the fewest streams, the one that has the session
+	# cached if it is among them
+	def pick(self, session_id: str | None) -> ServerProcess | None:
+		ready = [w for w in self.workers if w.ready and w.alive()]
+		if len(ready) == 0:
+			return None
+		fewest = min(w.active for w in ready)
+		cached = self.sessions.get(session_id) if session_id is not None else None
+		if cached is not None and cached in ready and cached.active == fewest:
+			worker = cached
+		else:
+			worker = min(ready, key=lambda w: (w.active, w.last_used))
+		if session_id is not None:
+			self.sessions[session_id] = worker
+			self.sessions.move_to_end(session_id)
+			while len(self.sessions) > MAX_SESSIONS:
+				self.sessions.popitem(last=False)
+		return worker
+
+	def release(self, worker: ServerProcess):
+		worker.active -= 1
+
+	async def render_metrics(self, headers: Dict[str, str]) -> str:
+		ready = [w for w in self.workers if w.ready and w.alive()]
+		families: Dict[str, List[str]] = {
+			"llama_workers": ["# TYPE llama_workers gauge", f"llama_workers {len(self.workers)}"],
+			"llama_workers_ready": ["# TYPE llama_workers_ready gauge", f"llama_workers_ready {len(ready)}"],
+			"llama_worker_restarts_total": ["# TYPE llama_worker_restarts_total counter", f"llama_worker_restarts_total {self.restarts}"],
+		}
+		return await merge_metrics(self.client, ready, headers, families, lambda w: f"worker=\"{self.workers.index(w)}\"")
+
+	async def close(self):
+		await asyncio.gather(*(w.stop() for w in self.workers))
+		await self.client.aclose()
+
+server = sys.argv[1] if len(sys.argv) > 1 else os.environ.get("WORKER_SERVER", "qwen")
+if server not in ("qwen", "mistral", "gemma3"):
+	raise ValueError("Unknown server: " + server)
+
+app = FastAPI()
+security = HTTPBasic()
+pool = WorkerPool.from_env(server)
+
+correct_username = os.environ.get("AI_USERNAME", None)
+correct_password = os.environ.get("AI_PASSWORD", None)
+if not correct_username or not correct_password:
+	raise ValueError("AI_USERNAME and AI_PASSWORD must be set")
+
+def authenticate(credentials: HTTPBasicCredentials):
+	if not (credentials.username == correct_username and
+			credentials.password == correct_password):
+		raise HTTPException(
+			status_code=401,
+			detail="Incorrect username or password",
+			headers={"WWW-Authenticate": "Basic"},
+		)
+	return credentials
+
+@app.on_event("startup")
+async def start_workers():
+	pool.start()
+	asyncio.ensure_future(pool.supervise())
+
+@app.post("/generate")
+async def generate_text(http_request: Request, credentials: HTTPBasicCredentials = Security(security)):
+	authenticate(credentials)
+	body = await http_request.body()
+	try:
+		request = json.loads(body)
+	except ValueError:
+		return Response(status_code=400, content="Invalid JSON")
+	session_id = request.get("session_id")
+	worker = None
+	# a resumed stream has to go to the worker that runs it
+	if "last-event-id" in http_request.headers:
+		worker = pool.requests.get(request.get("request_id"))
+	if worker is None or not worker.alive():
+		worker = pool.pick(session_id if isinstance(session_id, str) else None)
+	if worker is None:
+		return Response(status_code=503, content="No worker ready", headers={"Retry-After": "5"})
+	worker.active += 1
+	return await proxy_generate(pool.client, worker, http_request, body, lambda: pool.release(worker), pool.requests)
+
+@app.delete("/sessions/{session_id}")
+async def release_session(session_id: str, http_request: Request, credentials: HTTPBasicCredentials = Security(security)):
+	authenticate(credentials)
+	worker = pool.sessions.pop(session_id, None)
+	if worker is None or not worker.alive():
+		return Response(status_code=404, content="Session not found")
+	response = await pool.client.delete(worker.url + "/sessions/" + session_id, headers=forwarded(http_request))
+	return Response(status_code=response.status_code, content=response.content)
+
+@app.post("/interrupt/{request_id}")
+async def interrupt_stream(request_id: str, http_request: Request, credentials: HTTPBasicCredentials = Security(security)):
+	authenticate(credentials)
+	worker = pool.requests.get(request_id)
+	if worker is None or not worker.alive():
+		return Response(status_code=404, content="Request not found")
+	response = await pool.client.post(worker.url + "/interrupt/" + request_id, headers=forwarded(http_request))
+	return Response(status_code=response.status_code, content=response.content)
+
+# Ready as soon as one worker is
+@app.get("/ready")
+async def readiness():
+	ready = sum(1 for w in pool.workers if w.ready and w.alive())
+	if ready == 0:
+		return Response(status_code=503, content="Not ready")
+	return {"ready": True, "workers": ready}
+
+@app.get("/metrics")
+async def get_metrics(http_request: Request, credentials: HTTPBasicCredentials = Security(security)):
+	authenticate(credentials)
+	return Response(content=await pool.render_metrics(forwarded(http_request)), media_type="text/plain; version=0.0.4")
+
+@app.on_event("shutdown")
+async def stop_workers():
+	await pool.close()
+
+# Run the server
+if __name__ == "__main__":
+	import uvicorn
+	uvicorn.run(app, host=os.environ.get("HOST", "0.0.0.0"), port=int(os.environ.get("PORT", "8443")))
@@ -0,0 +1,110 @@
+import json
+import os
+import signal
+import sys
+import pytest
+
+# The servers import their modules top-level from /dist, as in the image
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, "..", "dist"))
+sys.path.insert(0, os.path.join(HERE, "..", "bench"))
+
+import llama_cpp
+import pipeline
+from chat_template import TokenCache
+from fake_llama import FakeBatch, FakeContext, FakeLlama, FakeSampler, perf_context
+from framing import Frame
+from registry import LoadedModel
+from tool_grammar import ToolGrammarCache, json_tool_call_grammar
+from tool_results import ToolResultEncoder
+
+# A ChatML model family on FakeLlama, like qwen.py without its profiles: the
+# template ends a boundary after every message, parse() turns <tool_call>
+# blocks into tool frames
+class ChatML:
+	def __init__(self, model: FakeLlama):
+		self.model = model
+		self.eos_token_id = self.special(b"<|im_end|>")
+		self.tool_call_start = self.special(b"<tool_call>")
+		self.tool_call_end = self.special(b"</tool_call>")
+
+	def special(self, text: bytes) -> int:
+		return self.model.tokenize(text, add_bos=False, special=True)[0]
+
+	def tokenize(self, messages, tools):
+		text = ""
+		boundaries = []
+		for i, message in enumerate(messages):
+			content = message.get("content") or ""
+			if i == 0 and tools is not None:
+				content += "\n<tools>\n" + "\n".join(json.dumps(tool) for tool in tools) + "\n</tools>"
+			for call in message.get("tool_calls") or []:
+				content += "<tool_call>\n" + json.dumps(call) + "\n</tool_call>"
+			text += "<|im_start|>" + message["role"] + "\n" + content + "<|im_end|>\n"
+			boundaries.append(len(self.model.tokenize(text.encode("utf-8"), add_bos=False, special=True)))
+		text += "<|im_start|>assistant\n"
+		return self.model.tokenize(text.encode("utf-8"), add_bos=False, special=True), boundaries
+
+	def parse(self, pieces, stop):
+		tool_text = None
+		for token_id, text, is_special in pieces:
+			if token_id == self.tool_call_start:
+				tool_text = []
+			elif tool_text is not None:
+				if token_id == self.tool_call_end:
+					yield Frame("".join(tool_text).strip(), is_tool=True)
+					return
+				tool_text.append(text)
+			elif text != "":
+				yield Frame(text, is_special=is_special)
+
+# The fake llama.cpp context, batch and sampler in place of the real ones, so
+# the decode loops (speculative.py, batching.py) run on FakeLlama
+@pytest.fixture
+def fake_llama_cpp(monkeypatch):
+	monkeypatch.setattr(llama_cpp._internals, "LlamaContext", FakeContext)
+	monkeypatch.setattr(llama_cpp._internals, "LlamaBatch", FakeBatch)
+	monkeypatch.setattr(llama_cpp._internals, "LlamaSampler", FakeSampler)
+	monkeypatch.setattr(llama_cpp, "llama_perf_context", perf_context)
+
+# Builds RequestPipelines on FakeLlama with the fake llama.cpp. Keyword
+# arguments are environment variables for the caches and engines; the engines
+# are closed after the test.
+@pytest.fixture
+def make_pipeline(monkeypatch, fake_llama_cpp):
+	monkeypatch.setattr(pipeline, "correct_username", "user")
+	monkeypatch.setattr(pipeline, "correct_password", "password")
+	# the test session keeps its own SIGINT handler
+	monkeypatch.setattr(signal, "signal", lambda signum, handler: None)
+	created = []
+
+	def make(n_ctx: int = 4096, tool_rate: float = 0.0, output_tokens: int = 40, **env) -> pipeline.RequestPipeline:
+		environ = {"SNAPSHOT_DIR_BYTES": "0", "WARMUP_MANIFEST": "", "BATCH_SLOTS": "1", "STREAM_COALESCE_MS": "0"}
+		environ.update(env)
+		for name, value in environ.items():
+			monkeypatch.setenv(name, str(value))
+		model = FakeLlama("qwen", n_ctx=n_ctx, tool_rate=tool_rate, output_tokens=output_tokens)
+		family = ChatML(model)
+		request_pipeline = pipeline.RequestPipeline(
+			"qwen",
+			LoadedModel(model, None, "test", 0.5),
+			family.tokenize,
+			family.parse,
+			eos_token_id=family.eos_token_id,
+			sampling={"top_k": 40, "top_p": 0.95, "temp": 0.15},
+			token_cache=TokenCache(model),
+			tool_results=ToolResultEncoder.from_env("qwen", len),
+			tool_grammars=ToolGrammarCache(
+				lambda tools: json_tool_call_grammar("<tool_call>\n", "\n</tool_call>", tools),
+				trigger_patterns=[],
+				trigger_tokens=[family.tool_call_start],
+			),
+		)
+		created.append(request_pipeline)
+		return request_pipeline
+
+	yield make
+	for request_pipeline in created:
+		request_pipeline.engine.close(timeout=5)
+		if request_pipeline.batch_engine is not None:
+			request_pipeline.batch_engine.close(timeout=2)
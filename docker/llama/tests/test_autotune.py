@@ -0,0 +1,131 @@
+import json
+import sys
+from types import SimpleNamespace
+import pytest
+import llama_cpp
+import autotune
+from registry import TUNED_KEYS, read_tuning
+
+# prefill tokens/s at 8 threads by (n_batch, n_ubatch), flash attention adds
+# a fifth; n_batch 2048 does not fit
+PREFILL = {(512, 256): 400, (512, 512): 450, (1024, 256): 500, (1024, 512): 600, (1024, 1024): 550}
+# decode tokens/s by thread count, memory bound beyond 4 threads
+DECODE = {1: 4.0, 2: 8.0, 4: 12.0, 8: 10.0}
+
+# A model that only knows its settings and its current thread count
+class TimedModel:
+	def __init__(self, spec, **kwargs):
+		if kwargs["n_batch"] == 2048:
+			raise ValueError("failed to create context")
+		self.spec = spec
+		self.kwargs = kwargs
+		self.threads = kwargs["n_threads"]
+		self._ctx = SimpleNamespace(ctx=self)
+		self.closed = False
+
+	def tokenize(self, text: bytes, add_bos: bool = True):
+		return list(text)
+
+	def close(self):
+		self.closed = True
+
+# The fake timing function: the speeds follow from the model's settings
+def fake_measure(model, prompt, output_tokens, repeat):
+	prefill = PREFILL[(model.kwargs["n_batch"], model.kwargs["n_ubatch"])] * model.threads / 8
+	if model.kwargs["flash_attn"]:
+		prefill *= 1.2
+	return prefill, DECODE[model.threads]
+
+def set_n_threads(ctx, n_threads, n_threads_batch):
+	ctx.threads = n_threads
+
+@pytest.fixture
+def tune(tmp_path, monkeypatch):
+	opened = []
+	def open_model(spec, **kwargs):
+		model = TimedModel(spec, **kwargs)
+		opened.append(model)
+		return model
+	monkeypatch.setattr(autotune, "open_model", open_model)
+	monkeypatch.setattr(autotune, "measure", fake_measure)
+	monkeypatch.setattr(llama_cpp, "llama_set_n_threads", set_n_threads)
+	monkeypatch.setenv("MODEL_MANIFEST", str(tmp_path / "models.json"))
+	monkeypatch.setenv("MODEL_TUNING", str(tmp_path / "tuning.json"))
+	monkeypatch.setenv("MODEL_TUNING_HOST", "test host")
+	(tmp_path / "models.json").write_text(json.dumps({"qwen/cpu": {
+		"path": "/models/qwen.gguf", "n_ctx": 32768, "n_threads": 2, "n_batch": 128, "draft": {"path": "/models/draft.gguf"},
+	}}))
+
+	def run(*args):
+		monkeypatch.setattr(sys, "argv", ["autotune.py", "qwen/cpu", "--threads", "1,2,4,8", "--batch", "512,1024,2048", "--ubatch", "256,512,1024", *args])
+		autotune.main()
+		return opened
+	return run
+
+def test_best_configuration_is_picked(tune, tmp_path):
+	opened = tune()
+	configs = [(m.kwargs["n_batch"], m.kwargs["n_ubatch"], m.kwargs["flash_attn"]) for m in opened]
+	# n_ubatch is never larger than n_batch
+	assert configs == [(b, u, fa) for b, u in PREFILL for fa in (False, True)]
+	assert all(m.closed for m in opened)
+	# the manifest's tuned keys and draft are not used for the benchmark
+	assert opened[0].spec == {"path": "/models/qwen.gguf", "n_ctx": 32768}
+	assert opened[0].kwargs["n_ctx"] == 1024 + 64 + 16
+
+	best = json.loads((tmp_path / "tuning.json").read_text())["test host"]["qwen/cpu"]
+	# prefill is fastest on all threads, decode on 4
+	assert {k: best[k] for k in TUNED_KEYS} == {"n_threads": 4, "n_threads_batch": 8, "n_batch": 1024, "n_ubatch": 512, "flash_attn": True}
+	assert best["prefill_tokens_per_second"] == 720.0
+	assert best["decode_tokens_per_second"] == 12.0
+	assert best["reference_request_seconds"] == round(4000 / 720 + 200 / 12, 3)
+
+def test_quantized_kv_cache_needs_flash_attention(tune, tmp_path):
+	(tmp_path / "models.json").write_text(json.dumps({"qwen/cpu": {"path": "/models/qwen.gguf", "type_k": "q8_0"}}))
+	opened = tune("--flash-attn", "off")
+	assert all(m.kwargs["flash_attn"] for m in opened)
+
+def test_tuning_file_is_merged_and_read_by_the_registry(tune, tmp_path):
+	tuning = tmp_path / "tuning.json"
+	tuning.write_text(json.dumps({
+		"test host": {"qwen/cpu": {"n_threads": 1}, "gemma3/cpu": {"n_threads": 6}},
+		"other host": {"qwen/cpu": {"n_threads": 32}},
+	}))
+	tune()
+	saved = json.loads(tuning.read_text())
+	# only this host's entry for the profile is replaced
+	assert saved["test host"]["gemma3/cpu"] == {"n_threads": 6}
+	assert saved["other host"] == {"qwen/cpu": {"n_threads": 32}}
+	assert not (tmp_path / "tuning.json.tmp").exists()
+	assert read_tuning("qwen", "cpu") == {"n_threads": 4, "n_threads_batch": 8, "n_batch": 1024, "n_ubatch": 512, "flash_attn": True}
+
+def test_dry_run_writes_nothing(tune, tmp_path):
+	tune("--dry-run")
+	assert not (tmp_path / "tuning.json").exists()
+	assert read_tuning("qwen", "cpu") == {}
+
+def test_nothing_measured(tune):
+	with pytest.raises(SystemExit, match="No configuration"):
+		tune("--batch", "2048")
+
+# Model whose evaluations advance a fake clock
+class ClockModel:
+	def __init__(self, clock, prefill_seconds: float, decode_seconds: list):
+		self.clock = clock
+		self.prefill_seconds = prefill_seconds
+		self.decode_seconds = decode_seconds
+		self.runs = 0
+
+	def reset(self):
+		self.runs += 1
+
+	def eval(self, tokens):
+		self.clock.now += self.prefill_seconds if len(tokens) > 1 else self.decode_seconds[self.runs - 1]
+
+def test_measure_keeps_the_best_run(monkeypatch):
+	clock = SimpleNamespace(now=0.0)
+	monkeypatch.setattr(autotune, "time", SimpleNamespace(perf_counter=lambda: clock.now))
+	model = ClockModel(clock, 0.5, [0.1, 0.05, 0.2])
+	prefill, decode = autotune.measure(model, list(range(100)), 10, 3)
+	assert model.runs == 3
+	assert prefill == pytest.approx(200.0)
+	assert decode == pytest.approx(20.0)
@@ -0,0 +1,104 @@
+import time
+import pytest
+from llama_cpp import _internals as internals
+from batching import BatchEngine
+from fake_llama import FakeContext, FakeLlama
+from speculative import SpeculativeStats
+
+# Records the sequence ids of every decode and the KV cell removals
+class RecordingContext(FakeContext):
+	def __init__(self, **kwargs):
+		super().__init__(**kwargs)
+		self.steps = []
+		self.removed = []
+
+	def decode(self, batch):
+		self.steps.append([batch.batch.seq_id[i][0] for i in range(batch.batch.n_tokens)])
+		return super().decode(batch)
+
+	def kv_cache_seq_rm(self, seq_id: int, p0: int, p1: int) -> bool:
+		self.removed.append((seq_id, p0, p1))
+		return super().kv_cache_seq_rm(seq_id, p0, p1)
+
+@pytest.fixture
+def engine(fake_llama_cpp, monkeypatch):
+	monkeypatch.setattr(internals, "LlamaContext", RecordingContext)
+	model = FakeLlama("qwen", n_ctx=1024, n_batch=64)
+	engine = BatchEngine(model, n_slots=2, prefill_chunk=32)
+	yield engine
+	engine.close(timeout=5)
+
+# A raw prompt of about n byte tokens
+def prompt_tokens(word: str, n: int = 80):
+	return list(((word + " ") * (n // (len(word) + 1)) + "\n").encode("utf-8"))
+
+def stop_after(n: int):
+	return lambda tokens, scores: len(tokens) >= n
+
+def wait_for(condition, timeout: float = 5.0):
+	deadline = time.monotonic() + timeout
+	while not condition():
+		assert time.monotonic() < deadline, "timed out"
+		time.sleep(0.001)
+
+def test_sequences_share_the_decode_steps(engine):
+	a, b = prompt_tokens("alpha"), prompt_tokens("beta", 120)
+	# both are admitted in the same step
+	with engine.cond:
+		first = engine.generate(a, temp=0.0, stopping_criteria=stop_after(len(a) + 20))
+		second = engine.generate(b, temp=0.0, stopping_criteria=stop_after(len(b) + 20))
+	out_a, out_b = list(first), list(second)
+	# the stopping token is not yielded
+	assert len(out_a) == len(out_b) == 19
+	# the same tokens as the fake model answers on its own
+	assert out_a == engine.model.answer(a)[:19]
+	assert out_b == engine.model.answer(b)[:19]
+	# prompt chunks of 32 tokens, then one token per sequence and step
+	assert any(set(step) == {0, 1} for step in engine.ctx.steps)
+	assert max(len(step) for step in engine.ctx.steps) <= 64
+
+def test_slots_are_reused_after_a_sequence_finishes(engine):
+	prompts = [prompt_tokens(word) for word in ("one", "two", "three")]
+	with engine.cond:
+		outputs = [engine.generate(tokens, temp=0.0, stopping_criteria=stop_after(len(tokens) + 5)) for tokens in prompts]
+	assert [len(list(output)) for output in outputs] == [4, 4, 4]
+	assert {seq_id for step in engine.ctx.steps for seq_id in step} == {0, 1}
+	# every finished sequence has its cells removed and its slot back
+	wait_for(lambda: sorted(engine.free_slots) == [0, 1])
+	assert len([removed for removed in engine.ctx.removed if removed[1:] == (-1, -1)]) == 3
+	assert all(len(tokens) == 0 for tokens in engine.ctx.sequences.values())
+
+def test_closing_the_iterator_retires_the_sequence(engine):
+	tokens = prompt_tokens("cancel")
+	output = engine.generate(tokens, temp=0.0)
+	next(output)
+	next(output)
+	output.close()
+	wait_for(lambda: len(engine.active) == 0 and len(engine.free_slots) == 2)
+	assert engine.ctx.removed[-1] == (0, -1, -1)
+	assert engine.ctx.sequences[0] == []
+	# the slot takes the next request
+	tokens = prompt_tokens("next")
+	assert list(engine.generate(tokens, temp=0.0, stopping_criteria=stop_after(len(tokens) + 3))) == engine.model.answer(tokens)[:2]
+
+def test_prompt_has_to_fit_a_slot(engine):
+	with pytest.raises(ValueError):
+		engine.generate([ord("a")] * engine.slot_size)
+	with pytest.raises(ValueError):
+		engine.generate([])
+
+def test_rejected_drafts_leave_the_kv_cells(fake_llama_cpp, monkeypatch):
+	monkeypatch.setattr(internals, "LlamaContext", RecordingContext)
+	model = FakeLlama("qwen", n_ctx=1024, n_batch=64)
+	engine = BatchEngine(model, n_slots=2, prefill_chunk=32, speculative=True)
+	try:
+		# the answer repeats words of the prompt, prompt lookup drafts them
+		tokens = list(" ".join(model.detokenize(model.answer([1])).decode("utf-8").split()[:20]).encode("utf-8"))
+		stats = SpeculativeStats("lookup")
+		output = list(engine.generate(tokens, temp=0.0, stopping_criteria=stop_after(len(tokens) + 60), stats=stats))
+		assert output == model.answer(tokens)[:59]
+		assert stats.drafted > 0 and stats.accepted < stats.drafted
+		# a removal from the first rejected position for every step that had one
+		assert any(seq_id == 0 and p0 > 0 for seq_id, p0, _ in engine.ctx.removed)
+	finally:
+		engine.close(timeout=5)
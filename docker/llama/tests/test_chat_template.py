@@ -0,0 +1,54 @@
+import threading
+import time
+from chat_template import TokenCache, canonical_tools
+
+# Byte tokens; the sleep releases the GIL like the ctypes call of llama.cpp
+class SlowTokenizer:
+	def tokenize(self, text: bytes, add_bos: bool = False, special: bool = False):
+		time.sleep(0.001)
+		return list(text)
+
+def test_text_is_cached():
+	cache = TokenCache(SlowTokenizer())
+	assert list(cache.text("abc")) == [97, 98, 99]
+	assert list(cache.text("abc")) == [97, 98, 99]
+	assert cache.stats() == {"hits": 1, "misses": 1, "entries": 1, "tokens": 3}
+
+def test_eviction_keeps_the_budget():
+	cache = TokenCache(SlowTokenizer(), max_tokens=10)
+	for text in ("aaaa", "bbbb", "cccc"):
+		cache.text(text)
+	stats = cache.stats()
+	assert stats["entries"] == 2
+	assert stats["tokens"] == 8
+	# "aaaa" was evicted
+	cache.text("aaaa")
+	assert cache.stats()["misses"] == 4
+
+def test_concurrent_misses_count_once():
+	cache = TokenCache(SlowTokenizer(), max_tokens=100)
+	texts = ["text %d" % (i % 12) for i in range(400)]
+	errors = []
+
+	def run(offset: int):
+		try:
+			for text in texts[offset:] + texts[:offset]:
+				cache.text(text)
+		except Exception as e:
+			errors.append(e)
+
+	threads = [threading.Thread(target=run, args=(i * 7,)) for i in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert errors == []
+	assert cache.total_tokens == sum(len(tokens) for tokens in cache.entries.values())
+	assert cache.total_tokens <= 100
+	assert len(cache.entries) > 0
+
+def test_canonical_tools_ignores_order():
+	a = {"type": "function", "function": {"name": "b", "parameters": {"y": 1, "x": 2}}}
+	b = {"type": "function", "function": {"name": "a"}}
+	assert canonical_tools([a, b]) == canonical_tools([b, a])
+	assert [t["function"]["name"] for t in canonical_tools([a, b])] == ["a", "b"]
@@ -0,0 +1,72 @@
+import pytest
+from context_planner import ELIDED_TOOL_OUTPUT, ContextOverflow, ContextPlanner
+
+# one token per character, the same offsets as the servers' tokenize()
+def tokenize(messages, tools):
+	tokens = []
+	boundaries = []
+	for message in messages:
+		tokens.extend([0] * len(message["content"]))
+		boundaries.append(len(tokens))
+	return tokens, boundaries
+
+def dialog(turns: int, tool_tokens: int = 100):
+	messages = [{"role": "system", "content": "s" * 10}]
+	for turn in range(turns):
+		messages.append({"role": "user", "content": f"question {turn}".ljust(20)})
+		messages.append({"role": "assistant", "content": "", "tool_calls": []})
+		messages.append({"role": "tool", "content": "t" * tool_tokens})
+		messages.append({"role": "assistant", "content": "a" * 20})
+	return messages
+
+def test_a_prompt_that_fits_is_left_alone():
+	planner = ContextPlanner(n_ctx=1000, policy="elide_tools", keep_turns=4, min_output=100)
+	messages = dialog(2)
+	plan = planner.plan(messages, None, tokenize, 2048)
+	assert plan.messages is messages
+	assert plan.actions == []
+	assert plan.max_length == 1000 - len(plan.tokens)
+
+def test_elide_tools_removes_old_tool_outputs_first():
+	planner = ContextPlanner(n_ctx=500, policy="elide_tools", keep_turns=4, min_output=100)
+	# 10 + 3 * 140 = 430 tokens, 30 too many
+	plan = planner.plan(dialog(3), None, tokenize, 2048)
+	tool_outputs = [m["content"] for m in plan.messages if m["role"] == "tool"]
+	assert tool_outputs == [ELIDED_TOOL_OUTPUT, "t" * 100, "t" * 100]
+	assert plan.actions == [{"action": "elide_tool_outputs", "messages": 1, "tokens": 100 - len(ELIDED_TOOL_OUTPUT)}]
+	assert len(plan.tokens) + 100 <= 500
+
+def test_elide_tools_drops_turns_once_nothing_is_left_to_elide():
+	planner = ContextPlanner(n_ctx=300, policy="elide_tools", keep_turns=4, min_output=100)
+	plan = planner.plan(dialog(3), None, tokenize, 2048)
+	assert [a["action"] for a in plan.actions] == ["elide_tool_outputs", "drop_turns"]
+	assert plan.messages[0]["role"] == "system"
+	assert plan.messages[1]["content"].startswith("question 2")
+	# the tool output of the last turn is never elided
+	assert plan.messages[-2]["content"] == "t" * 100
+
+def test_drop_oldest_keeps_the_system_prompt_and_the_last_turn():
+	planner = ContextPlanner(n_ctx=400, policy="drop_oldest", keep_turns=4, min_output=100)
+	plan = planner.plan(dialog(3), None, tokenize, 2048)
+	assert plan.actions == [{"action": "drop_turns", "turns": 1, "messages": 4, "tokens": 140}]
+	assert plan.messages[1]["content"].startswith("question 1")
+
+def test_last_turns_keeps_keep_turns_turns():
+	planner = ContextPlanner(n_ctx=600, policy="last_turns", keep_turns=2, min_output=100)
+	plan = planner.plan(dialog(5), None, tokenize, 2048)
+	assert plan.actions[0] == {"action": "keep_last_turns", "turns": 3, "messages": 12, "tokens": 420}
+	assert [m["content"].strip() for m in plan.messages if m["role"] == "user"] == ["question 3", "question 4"]
+
+def test_max_length_is_capped_to_the_room_left():
+	planner = ContextPlanner(n_ctx=500, policy="none", keep_turns=4, min_output=100)
+	plan = planner.plan(dialog(2), None, tokenize, 2048)
+	assert plan.max_length == 500 - 290
+
+def test_overflow_when_nothing_can_be_removed():
+	planner = ContextPlanner(n_ctx=200, policy="elide_tools", keep_turns=4, min_output=100)
+	with pytest.raises(ContextOverflow):
+		planner.plan(dialog(1), None, tokenize, 2048)
+
+def test_unknown_policy():
+	with pytest.raises(ValueError):
+		ContextPlanner(n_ctx=200, policy="shrink", keep_turns=4, min_output=100)
@@ -0,0 +1,51 @@
+from detokenizer import PieceTable, StreamDetokenizer
+from fake_llama import FakeLlama
+
+MODEL = FakeLlama("qwen", n_ctx=64)
+TABLE = PieceTable(MODEL)
+
+def special(text: str) -> int:
+	return MODEL.tokenize(text.encode("utf-8"), add_bos=False, special=True)[0]
+
+def push_all(token_ids):
+	detokenizer = StreamDetokenizer(TABLE)
+	return [detokenizer.push(token_id) for token_id in token_ids], detokenizer.flush()
+
+def test_piece_table():
+	assert TABLE.pieces[ord("a")] == b"a"
+	assert TABLE.pieces[special("<tool_call>")] == b"<tool_call>"
+	assert TABLE.special == frozenset(range(256, MODEL.n_vocab()))
+
+def test_characters_split_across_tokens_come_out_complete():
+	text = "a🙂b日本"
+	token_ids = list(text.encode("utf-8"))
+	pushed, rest = push_all(token_ids)
+	assert [t for t, _ in pushed] == ["a", "", "", "", "🙂", "b", "", "", "日", "", "", "本"]
+	assert "".join(t for t, _ in pushed) == MODEL.detokenize(token_ids).decode("utf-8")
+	assert rest == ""
+
+def test_special_pieces():
+	token_ids = [special("<tool_call>")] + list(b"{}") + [special("</tool_call>")]
+	pushed, _ = push_all(token_ids)
+	assert pushed == [("<tool_call>", True), ("{", False), ("}", False), ("</tool_call>", True)]
+
+def test_special_piece_after_an_incomplete_character():
+	emoji = list("🙂".encode("utf-8"))
+	pushed, _ = push_all(emoji[:2] + [special("<|im_end|>")])
+	assert pushed[-1] == ("�<|im_end|>", True)
+
+def test_flush_at_the_end_of_the_generation():
+	emoji = list("🙂".encode("utf-8"))
+	pushed, rest = push_all([ord("a")] + emoji[:3])
+	assert [t for t, _ in pushed] == ["a", "", "", ""]
+	assert rest == "�"
+	# the decoder starts over after a flush
+	detokenizer = StreamDetokenizer(TABLE)
+	detokenizer.push(emoji[0])
+	assert detokenizer.flush() == "�"
+	assert [detokenizer.push(token_id)[0] for token_id in emoji] == ["", "", "", "🙂"]
+
+def test_invalid_bytes_are_replaced():
+	pushed, rest = push_all([0xff, ord("a")])
+	assert [t for t, _ in pushed] == ["�", "a"]
+	assert rest == ""
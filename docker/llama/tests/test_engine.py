@@ -0,0 +1,54 @@
+import asyncio
+import time
+from engine import Engine
+from scheduler import AdmissionScheduler
+
+def frames(job):
+	for i in range(1000):
+		yield f"frame {i}\n"
+
+def test_close_wakes_a_job_waiting_for_its_reader(monkeypatch):
+	monkeypatch.setenv("STREAM_MAX_UNREAD", "4")
+	monkeypatch.setenv("STREAM_STALL_TIMEOUT", "30")
+
+	async def run():
+		engine = Engine(None, AdmissionScheduler(max_backlog_tokens=100000, max_waiting=8))
+		job = engine.submit(frames, "r1")
+		# nobody reads: the job parks in wait_for_reader
+		while job.unread < 4:
+			await asyncio.sleep(0.01)
+		started = time.monotonic()
+		# the SIGTERM handler runs on the event loop thread too
+		assert engine.close(timeout=5)
+		assert time.monotonic() - started < 1
+		assert job.cancelled.is_set()
+
+	asyncio.run(run())
+
+def test_interrupt_wakes_the_waiting_job(monkeypatch):
+	monkeypatch.setenv("STREAM_MAX_UNREAD", "4")
+
+	async def run():
+		engine = Engine(None, AdmissionScheduler(max_backlog_tokens=100000, max_waiting=8))
+		job = engine.submit(frames, "r1")
+		while job.unread < 4:
+			await asyncio.sleep(0.01)
+		assert engine.interrupt("r1")
+		started = time.monotonic()
+		while "r1" in engine.jobs:
+			await asyncio.sleep(0.01)
+		assert time.monotonic() - started < 1
+		assert not engine.interrupt("r1")
+		engine.close(timeout=1)
+
+	asyncio.run(run())
+
+def test_stream_reads_everything():
+	async def run():
+		engine = Engine(None, AdmissionScheduler(max_backlog_tokens=100000, max_waiting=8))
+		job = engine.submit(lambda job: iter(["a", "b", "c"]), "r1")
+		chunks = [chunk async for chunk in engine.stream(job)]
+		assert "".join(chunks) == "abc"
+		engine.close(timeout=1)
+
+	asyncio.run(run())
@@ -0,0 +1,80 @@
+import json
+from types import SimpleNamespace
+import pytest
+import framing
+from framing import Frame, coalesce_frames, encode_frame, perf_frame, progress_frame
+
+TEXTS = ["plain", "", "quote \" backslash \\ newline \n tab \t", "🙂 日本 é", "\x00\x1f\x7f", "</tool_call>"]
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_frames_are_byte_identical_to_json_dumps(text):
+	for is_special in (False, True):
+		for is_tool in (False, True):
+			for is_error in (False, True):
+				expected = json.dumps({"text": text, "is_special": is_special, "is_tool": is_tool, "is_error": is_error}) + "\n"
+				assert encode_frame(text, is_special, is_tool, is_error) == expected
+
+def test_constant_frames_are_json():
+	assert json.loads(progress_frame(512, 2001)) == {"progress": {"tokens": 512, "total": 2001}}
+	assert json.loads(perf_frame({"total_ms": 1.5})) == {"perf": {"total_ms": 1.5}}
+
+# Frames that arrive at the given times of a fake clock
+def timed(monkeypatch, frames):
+	now = [0.0]
+	monkeypatch.setattr(framing, "time", SimpleNamespace(monotonic=lambda: now[0]))
+	for at, frame in frames:
+		now[0] = at
+		yield frame
+
+def texts(encoded):
+	return [json.loads(frame)["text"] for frame in encoded]
+
+def test_window_merges_text_frames(monkeypatch):
+	frames = timed(monkeypatch, [(0.0, Frame("a")), (0.001, Frame("b")), (0.010, Frame("c")), (0.021, Frame("d")), (0.022, Frame("e"))])
+	# the first frame goes out right away, "d" arrives after the 20 ms window
+	assert texts(coalesce_frames(frames, 0.020, 64)) == ["a", "bcd", "e"]
+
+def test_max_bytes_flushes_before_the_window(monkeypatch):
+	frames = timed(monkeypatch, [(0.0, Frame("a")), (0.001, Frame("bb")), (0.002, Frame("cc")), (0.003, Frame("d"))])
+	assert texts(coalesce_frames(frames, 1.0, 4)) == ["a", "bbcc", "d"]
+
+def test_special_tool_and_error_frames_are_not_delayed(monkeypatch):
+	frames = timed(monkeypatch, [
+		(0.0, Frame("a")),
+		(0.001, Frame("b")),
+		(0.002, Frame("<tool_call>", is_special=True)),
+		(0.003, Frame("c")),
+		(0.004, Frame("{}", is_tool=True)),
+		(0.005, Frame("Error", is_error=True)),
+	])
+	encoded = list(coalesce_frames(frames, 1.0, 64))
+	assert encoded == [
+		encode_frame("a"),
+		encode_frame("b"),
+		encode_frame("<tool_call>", is_special=True),
+		encode_frame("c"),
+		encode_frame("{}", is_tool=True),
+		encode_frame("Error", is_error=True),
+	]
+
+def test_encoded_frames_keep_their_place(monkeypatch):
+	frames = timed(monkeypatch, [(0.0, Frame("a")), (0.001, Frame("b")), (0.002, perf_frame({})), (0.003, Frame("c"))])
+	assert list(coalesce_frames(frames, 1.0, 64)) == [encode_frame("a"), encode_frame("b"), perf_frame({}), encode_frame("c")]
+
+def test_closing_the_stream_closes_the_generator():
+	closed = []
+	def frames():
+		try:
+			while True:
+				yield Frame("x")
+		finally:
+			closed.append(True)
+	stream = coalesce_frames(frames(), 1.0, 64)
+	next(stream)
+	stream.close()
+	assert closed == [True]
+
+def test_coalescing_off(monkeypatch):
+	monkeypatch.setenv("STREAM_COALESCE_MS", "0")
+	frames = [Frame("a"), Frame("b"), perf_frame({})]
+	assert list(framing.coalesce_from_env(iter(frames))) == [encode_frame("a"), encode_frame("b"), perf_frame({})]
@@ -0,0 +1,160 @@
+import json
+import re
+import time
+from fastapi.testclient import TestClient
+from metrics import Counter, Histogram, ServerMetrics
+
+AUTH = ("user", "password")
+
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\]|\\.)*",?)*\})? (\S+)$')
+LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+# Checks the text exposition format and returns {(name, labels): value}:
+# every sample belongs to the family of the last TYPE line, there is one TYPE
+# line per family and the values are numbers
+def parse(text: str) -> dict:
+	assert text.endswith("\n")
+	samples = {}
+	types = {}
+	family = None
+	for line in text.splitlines():
+		if line.startswith("# HELP "):
+			continue
+		if line.startswith("# TYPE "):
+			_, _, name, kind = line.split(" ")
+			assert name not in types
+			assert kind in ("counter", "gauge", "histogram")
+			types[name] = kind
+			family = name
+			continue
+		match = SAMPLE.match(line)
+		assert match is not None, line
+		name, labels, value = match.group(1), match.group(2) or "", match.group(3)
+		suffixes = ("_bucket", "_sum", "_count") if types[family] == "histogram" else ("",)
+		assert any(name == family + suffix for suffix in suffixes), line
+		key = (name, tuple(sorted(LABEL.findall(labels))))
+		assert key not in samples, line
+		samples[key] = float(value)
+	return samples
+
+CONST = (("model_family", "qwen"), ("model_profile", "test"))
+
+def value(samples: dict, name: str, **labels) -> float:
+	return samples[(name, tuple(sorted(CONST + tuple(labels.items()))))]
+
+def test_counter_labels_are_escaped():
+	counter = Counter("llama_requests_total", "Requests.", "outcome")
+	counter.inc(label="completed")
+	counter.inc(2, label="quote \" backslash \\")
+	lines = counter.render([("model_profile", "test")])
+	assert lines[:2] == ["# HELP llama_requests_total Requests.", "# TYPE llama_requests_total counter"]
+	assert lines[2:] == [
+		'llama_requests_total{model_profile="test",outcome="completed"} 1',
+		'llama_requests_total{model_profile="test",outcome="quote \\" backslash \\\\"} 2',
+	]
+
+def test_unlabelled_counter_starts_at_zero():
+	assert Counter("llama_tool_calls_total", "Tool calls.").render([])[-1] == "llama_tool_calls_total 0"
+
+def test_histogram_buckets_are_cumulative():
+	histogram = Histogram("llama_queue_wait_seconds", "Wait.", [0.1, 1])
+	for observed in (0.05, 0.5, 0.7, 5):
+		histogram.observe(observed)
+	assert histogram.render([])[2:] == [
+		'llama_queue_wait_seconds_bucket{le="0.1"} 1',
+		'llama_queue_wait_seconds_bucket{le="1"} 3',
+		'llama_queue_wait_seconds_bucket{le="+Inf"} 4',
+		"llama_queue_wait_seconds_sum 6.25",
+		"llama_queue_wait_seconds_count 4",
+	]
+
+def test_stats_become_counters_and_gauges():
+	metrics = ServerMetrics("qwen", "test", 4096)
+	metrics.add_stats("llama_prefix_cache", lambda: {"hits": 3, "bytes": 1024, "mode": "lookup"})
+	text = metrics.render()
+	samples = parse(text)
+	assert "# TYPE llama_prefix_cache_hits_total counter" in text
+	assert "# TYPE llama_prefix_cache_bytes gauge" in text
+	assert value(samples, "llama_prefix_cache_hits_total") == 3
+	assert value(samples, "llama_prefix_cache_bytes") == 1024
+	# strings are not exported
+	assert not any(name.startswith("llama_prefix_cache_mode") for name, _ in samples)
+	assert value(samples, "llama_context_size_tokens") == 4096
+
+def test_scrape_after_a_generation(make_pipeline):
+	request_pipeline = make_pipeline(SPECULATIVE="lookup")
+	client = TestClient(request_pipeline.app)
+	messages = [{"role": "system", "content": "You read channels."}, {"role": "user", "content": "What happened in general today?"}]
+	response = client.post("/generate", json={"messages": messages, "tools": []}, auth=AUTH)
+	assert response.status_code == 200
+
+	assert client.get("/metrics").status_code == 401
+	response = client.get("/metrics", auth=AUTH)
+	assert response.status_code == 200
+	assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+	samples = parse(response.text)
+	assert value(samples, "llama_requests_total", outcome="completed") == 1
+	assert value(samples, "llama_completion_tokens_total") > 0
+	assert value(samples, "llama_prompt_tokens_total") == value(samples, "llama_prefill_tokens_total")
+	assert value(samples, "llama_time_to_first_token_seconds_count") == 1
+	assert value(samples, "llama_queue_wait_seconds_bucket", le="+Inf") == 1
+	assert value(samples, "llama_speculative_drafted_tokens_total") >= value(samples, "llama_speculative_accepted_tokens_total")
+	assert value(samples, "llama_prefix_cache_misses_total") == 1
+	assert value(samples, "llama_session_cache_sessions") == 0
+	assert value(samples, "llama_kv_cache_bytes") > 0
+	assert value(samples, "llama_model_load_seconds") == 0.5
+	# every sample has the model labels
+	assert all(dict(labels).keys() >= {"model_family", "model_profile"} for _, labels in samples)
+
+def test_request_timings():
+	metrics = ServerMetrics("qwen", "test", 4096)
+	request = metrics.start(time.monotonic())
+	with request.phase("tokenize"):
+		pass
+	assert list(request.timed(iter([1, 2, 3]))) == [1, 2, 3]
+	perf = request.perf(client_wait=0.0)
+	assert list(perf) == ["queue_ms", "tokenize_ms", "prefill_ms", "decode_ms", "handling_ms", "client_wait_ms", "total_ms", "prompt_tokens", "prefill_tokens", "completion_tokens"]
+	assert perf["completion_tokens"] == 3
+	# the first token counts as prefill
+	assert request.first_token_at > 0
+
+PERF_KEYS = {
+	"queue_ms", "summarize_ms", "tokenize_ms", "prefill_ms", "decode_ms", "handling_ms", "client_wait_ms", "total_ms",
+	"prompt_tokens", "prefill_tokens", "completion_tokens", "speculative", "llama",
+}
+
+def perf_trailer(client) -> dict:
+	messages = [{"role": "system", "content": "You read channels."}, {"role": "user", "content": "What happened in general today?"}]
+	response = client.post("/generate", json={"messages": messages, "tools": []}, auth=AUTH)
+	frames = [json.loads(line) for line in response.text.splitlines()]
+	assert "perf" in frames[-1]
+	return frames[-1]["perf"]
+
+def test_perf_trailer(make_pipeline):
+	request_pipeline = make_pipeline(SPECULATIVE="lookup", output_tokens=60)
+	perf = perf_trailer(TestClient(request_pipeline.app))
+	assert set(perf) == PERF_KEYS
+	assert all(perf[key] >= 0 for key in PERF_KEYS if key.endswith("_ms"))
+	assert perf["prefill_tokens"] == perf["prompt_tokens"]
+	assert set(perf["speculative"]) == {"mode", "steps", "drafted", "accepted", "acceptance_rate", "tokens_per_second"}
+	assert perf["speculative"]["mode"] == "lookup"
+	# llama.cpp's counters of this request: every prompt and generated token
+	# is decoded, rejected drafts on top
+	llama = perf["llama"]
+	assert set(llama) == {"prompt_eval_ms", "prompt_eval_tokens", "eval_ms", "eval_tokens"}
+	assert llama["prompt_eval_tokens"] + llama["eval_tokens"] >= perf["prompt_tokens"] + perf["completion_tokens"]
+
+def test_perf_trailer_without_drafting(make_pipeline):
+	request_pipeline = make_pipeline(SPECULATIVE="off")
+	perf = perf_trailer(TestClient(request_pipeline.app))
+	assert "speculative" not in perf
+	# the prompt minus its last token in one batch, then one token per step
+	assert perf["llama"]["prompt_eval_tokens"] == perf["prompt_tokens"] - 1
+	assert perf["llama"]["eval_tokens"] == perf["completion_tokens"] + 1
+
+def test_perf_trailer_on_the_batch_path(make_pipeline):
+	request_pipeline = make_pipeline(BATCH_SLOTS="2", SPECULATIVE="off")
+	perf = perf_trailer(TestClient(request_pipeline.app))
+	# llama.cpp's counters cover all slots, they are left out
+	assert "llama" not in perf
+	assert perf["prefill_tokens"] == perf["prompt_tokens"]
@@ -0,0 +1,26 @@
+from types import SimpleNamespace
+from detokenizer import PieceTable
+from fake_llama import FakeLlama
+from pipeline import RequestPipeline
+
+def pieces(token_ids):
+	pipeline = SimpleNamespace(piece_table=PieceTable(FakeLlama("qwen", n_ctx=64)))
+	all_token_ids = []
+	return list(RequestPipeline.pieces(pipeline, iter(token_ids), all_token_ids)), all_token_ids
+
+def test_pieces_hold_back_split_characters():
+	# the fake vocabulary is bytes, the emoji takes four tokens
+	emoji = list("🙂".encode("utf-8"))
+	result, all_token_ids = pieces([ord("a")] + emoji)
+	assert [text for _, text, _ in result] == ["a", "", "", "", "🙂"]
+	assert all_token_ids == [ord("a")] + emoji
+
+def test_pieces_flush_an_incomplete_character_last():
+	emoji = list("🙂".encode("utf-8"))
+	result, all_token_ids = pieces([ord("a")] + emoji[:2])
+	assert result[-1] == (None, "�", False)
+	assert len(all_token_ids) == 3
+
+def test_pieces_without_leftover():
+	result, _ = pieces([ord("a"), ord("b")])
+	assert result == [(ord("a"), "a", False), (ord("b"), "b", False)]
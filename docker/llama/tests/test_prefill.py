@@ -0,0 +1,69 @@
+import json
+import pytest
+from fastapi.testclient import TestClient
+from fake_llama import FakeLlama
+from prefill import ChunkedPrefill, PrefillCancelled
+
+TOKENS = list(range(1, 101))
+
+# FakeLlama that records the size of every eval() call
+class CountingLlama(FakeLlama):
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self.evals = []
+
+	def eval(self, tokens):
+		self.evals.append(len(tokens))
+		super().eval(tokens)
+
+def prefill(model, chunk: int, should_stop=lambda: False):
+	progress = []
+	return ChunkedPrefill(model, len(TOKENS), chunk, lambda done, total: progress.append((done, total)), should_stop), progress
+
+def test_chunks_and_progress():
+	model = CountingLlama("qwen", n_ctx=256)
+	run, progress = prefill(model, 32)
+	run.run(TOKENS)
+	# the last prompt token is left to generate()
+	assert model.evals == [32, 32, 32, 3]
+	assert progress == [(32, 100), (64, 100), (96, 100), (99, 100)]
+	assert run.evaluated == 99
+	assert model.input_ids[:model.n_tokens].tolist() == TOKENS[:99]
+
+def test_single_chunk_reports_nothing():
+	model = CountingLlama("qwen", n_ctx=256)
+	run, progress = prefill(model, 128)
+	run.run(TOKENS)
+	assert model.evals == [99]
+	assert progress == []
+
+def test_prefix_in_context_is_kept():
+	model = CountingLlama("qwen", n_ctx=256)
+	model.eval(TOKENS[:80])
+	model.evals = []
+	run, progress = prefill(model, 16)
+	run.run(TOKENS)
+	assert model.evals == [16, 3]
+	assert progress == [(96, 100), (99, 100)]
+	assert run.evaluated == 19
+
+def test_cancelled_between_chunks():
+	model = CountingLlama("qwen", n_ctx=256)
+	run, progress = prefill(model, 32, lambda: len(model.evals) == 2)
+	with pytest.raises(PrefillCancelled):
+		run.run(TOKENS)
+	assert model.evals == [32, 32]
+	assert model.n_tokens == 64
+	assert progress == [(32, 100), (64, 100)]
+
+def test_progress_frames_come_before_the_text(make_pipeline):
+	request_pipeline = make_pipeline(PREFILL_CHUNK="64")
+	client = TestClient(request_pipeline.app)
+	messages = [{"role": "system", "content": "You read channels."}, {"role": "user", "content": "What happened? " * 20}]
+	response = client.post("/generate", json={"messages": messages, "tools": []}, auth=("user", "password"))
+	frames = [json.loads(line) for line in response.text.splitlines()]
+	progress = [frame["progress"] for frame in frames if "progress" in frame]
+	total = progress[0]["total"]
+	assert [p["tokens"] for p in progress] == list(range(64, total - 1, 64)) + [total - 1]
+	assert all("progress" not in frame for frame in frames[len(progress):])
+	assert "text" in frames[len(progress)]
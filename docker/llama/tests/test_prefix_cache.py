@@ -0,0 +1,76 @@
+from fake_llama import FakeLlama
+from prefix_cache import PrefixCache, common_length
+
+def edges(node) -> dict:
+	return {child.edge: edges(child) for child in node.children.values()}
+
+def test_lookup_returns_the_longest_cached_prefix():
+	cache = PrefixCache(max_bytes=100, min_tokens=0)
+	cache.insert([1, 2], "short", 1)
+	cache.insert([1, 2, 3, 4], "long", 1)
+	assert cache.lookup([1, 2, 3, 4, 5]) == (4, "long")
+	assert cache.lookup([1, 2, 3, 9]) == (2, "short")
+	assert cache.lookup([1, 9]) == (0, None)
+
+def test_insert_splits_the_edge_where_prefixes_diverge():
+	cache = PrefixCache(max_bytes=100, min_tokens=0)
+	cache.insert([1, 2, 3, 4], "a", 1)
+	cache.insert([1, 2, 5], "b", 1)
+	assert edges(cache.root) == {(1, 2): {(3, 4): {}, (5,): {}}}
+	middle = cache.root.children[1]
+	assert middle.state is None
+	assert middle.children[3].parent is middle
+	assert cache.lookup([1, 2, 3, 4]) == (4, "a")
+	assert cache.lookup([1, 2, 5, 6]) == (3, "b")
+
+def test_remove_merges_pass_through_nodes():
+	cache = PrefixCache(max_bytes=100, min_tokens=0)
+	cache.insert([1, 2, 3, 4], "a", 1)
+	cache.insert([1, 2, 5], "b", 1)
+	cache.remove(cache.root.children[1].children[5])
+	assert edges(cache.root) == {(1, 2, 3, 4): {}}
+	assert cache.root.children[1].parent is cache.root
+	assert cache.lookup([1, 2, 3, 4]) == (4, "a")
+	assert cache.total_bytes == 1
+
+def test_evicts_least_recently_used_first():
+	cache = PrefixCache(max_bytes=3, min_tokens=0)
+	cache.insert([1], "a", 1)
+	cache.insert([2], "b", 1)
+	cache.insert([3], "c", 1)
+	# a hit makes [1] the most recently used
+	cache.lookup([1])
+	cache.insert([4], "d", 1)
+	assert cache.lookup([2]) == (0, None)
+	assert [cache.lookup([t])[1] for t in (1, 3, 4)] == ["a", "c", "d"]
+	assert cache.total_bytes == 3
+
+def test_replacing_a_state_keeps_the_size_right():
+	cache = PrefixCache(max_bytes=10, min_tokens=0)
+	cache.insert([1, 2], "a", 4)
+	cache.insert([1, 2], "b", 6)
+	assert cache.total_bytes == 6
+	assert cache.lookup([1, 2]) == (2, "b")
+
+def test_oversized_states_are_not_cached():
+	cache = PrefixCache(max_bytes=10, min_tokens=0)
+	cache.insert([1], "a", 1)
+	cache.insert([2], "huge", 11)
+	assert cache.lookup([1]) == (1, "a")
+	assert cache.lookup([2]) == (0, None)
+
+def test_prepare_snapshots_the_boundary_and_restores_it():
+	model = FakeLlama("qwen", n_ctx=256)
+	cache = PrefixCache(max_bytes=1 << 20, min_tokens=4)
+	system = [ord(c) for c in "system prompt"]
+	first = system + [ord(c) for c in "first question"]
+	assert cache.prepare(model, first, [len(system)]) == 0
+	assert cache.lookup(first)[0] == len(system)
+
+	# another dialog with the same system prompt starts from the snapshot
+	model.reset()
+	second = system + [ord(c) for c in "another one"]
+	assert cache.prepare(model, second, [len(system)]) == len(system)
+	assert model.n_tokens == len(system)
+	assert common_length(model.input_ids[:model.n_tokens].tolist(), second) == len(system)
+	assert cache.stats()["hits"] == 1
@@ -0,0 +1,67 @@
+import json
+import os
+import threading
+import time
+from fastapi.testclient import TestClient
+from profiling import SamplingProfiler, StackSampler
+
+def busy_loop(seconds: float):
+	deadline = time.monotonic() + seconds
+	while time.monotonic() < deadline:
+		pass
+
+def test_every_nth_request_is_sampled(tmp_path):
+	profiler = SamplingProfiler(every=2, interval=0.001, directory=str(tmp_path), threads=[])
+	samplers = [profiler.start("request") for _ in range(4)]
+	assert [sampler is not None for sampler in samplers] == [False, True, False, True]
+	for sampler in samplers:
+		if sampler is not None:
+			sampler.stop()
+	assert SamplingProfiler(every=0, interval=0.001, directory=str(tmp_path), threads=[]).start("request") is None
+
+def test_sampler_writes_folded_stacks(tmp_path):
+	profiler = SamplingProfiler(every=1, interval=0.001, directory=str(tmp_path / "profiles"), threads=[])
+	sampler = profiler.start("req/1 a")
+	assert isinstance(sampler, StackSampler)
+	assert sampler.thread_ids == [threading.get_ident()]
+	busy_loop(0.05)
+	sampler.stop()
+	assert not sampler.thread.is_alive()
+	assert sampler.samples > 0
+	# the request id is made safe for a file name
+	assert os.path.basename(sampler.path).endswith("-req_1_a.folded")
+	with open(sampler.path) as f:
+		lines = f.read().splitlines()
+	assert len(lines) > 0
+	for line in lines:
+		stack, count = line.rsplit(" ", 1)
+		assert int(count) > 0
+	assert any("busy_loop (test_profiling.py:" in line for line in lines)
+	# nothing is sampled after stop()
+	samples = sampler.samples
+	time.sleep(0.01)
+	assert sampler.samples == samples
+
+def test_extra_threads_are_sampled(tmp_path):
+	stop = threading.Event()
+	worker = threading.Thread(target=stop.wait, name="worker")
+	worker.start()
+	try:
+		sampler = SamplingProfiler(every=1, interval=0.001, directory=str(tmp_path), threads=[worker]).start("request")
+		time.sleep(0.02)
+		sampler.stop()
+	finally:
+		stop.set()
+		worker.join()
+	assert sampler.thread_ids == [threading.get_ident(), worker.ident]
+	with open(sampler.path) as f:
+		assert "wait (threading.py:" in f.read()
+
+def test_profiled_generation(make_pipeline, tmp_path):
+	request_pipeline = make_pipeline(PROFILE_EVERY="1", PROFILE_INTERVAL_MS="1", PROFILE_DIR=str(tmp_path))
+	client = TestClient(request_pipeline.app)
+	messages = [{"role": "system", "content": "You read channels."}, {"role": "user", "content": "What happened in general today?"}]
+	response = client.post("/generate", json={"messages": messages, "tools": [], "request_id": "profiled"}, auth=("user", "password"))
+	assert "perf" in json.loads(response.text.splitlines()[-1])
+	# written when the generation ends, before the perf trailer
+	assert [name.split("-", 1)[1] for name in os.listdir(tmp_path)] == ["profiled.folded"]
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import pytest
+import llama_cpp
+from fastapi.testclient import TestClient
+import registry
+from registry import load_model, profile_name, verify
+
+PROFILES = {
+	"cpu": {"repo_id": "Qwen/hub", "filename": "hub.gguf", "n_ctx": 8192, "n_threads": 8},
+}
+
+# Records how the model was opened instead of loading it
+class RecordingLlama:
+	def __init__(self, **kwargs):
+		self.kwargs = kwargs
+
+	@classmethod
+	def from_pretrained(cls, **kwargs):
+		model = cls(**kwargs)
+		model.hub = True
+		return model
+
+@pytest.fixture
+def models(tmp_path, monkeypatch):
+	monkeypatch.setattr(registry, "Llama", RecordingLlama)
+	monkeypatch.setenv("MODEL_MANIFEST", str(tmp_path / "models.json"))
+	monkeypatch.setenv("MODEL_TUNING", str(tmp_path / "tuning.json"))
+	monkeypatch.setenv("MODEL_TUNING_HOST", "test host")
+	for name in ("MODEL_PROFILE", "MODEL_SIZE", "MODEL_VERIFY", "N_THREADS", "N_THREADS_BATCH"):
+		monkeypatch.delenv(name, raising=False)
+	gguf = tmp_path / "model.gguf"
+	gguf.write_bytes(b"GGUF weights")
+	return tmp_path
+
+def write_manifest(directory, manifest):
+	(directory / "models.json").write_text(json.dumps(manifest))
+
+def sha256(path) -> str:
+	return hashlib.sha256(path.read_bytes()).hexdigest()
+
+def test_profile_name(monkeypatch):
+	monkeypatch.delenv("MODEL_PROFILE", raising=False)
+	monkeypatch.delenv("MODEL_SIZE", raising=False)
+	assert profile_name("cpu") == "cpu"
+	assert profile_name("cuda") == "medium"
+	monkeypatch.setenv("MODEL_SIZE", "large")
+	assert profile_name("cuda") == "large"
+	monkeypatch.setenv("MODEL_PROFILE", "custom")
+	assert profile_name("cpu") == "custom"
+
+def test_built_in_profile_without_manifest(models):
+	loaded = load_model("qwen", PROFILES, "cpu")
+	assert loaded.model.hub
+	assert loaded.model.kwargs == PROFILES["cpu"]
+	assert loaded.profile == "cpu"
+	assert loaded.draft is None
+
+def test_manifest_entry_wins(models):
+	gguf = models / "model.gguf"
+	draft = {"path": "/models/draft.gguf", "n_gpu_layers": -1}
+	write_manifest(models, {"qwen/cpu": {
+		"path": str(gguf), "sha256": sha256(gguf), "family": "qwen", "prefetch": False,
+		"n_ctx": 4096, "use_mlock": True, "type_k": "q8_0", "type_v": "f16", "draft": draft,
+	}})
+	loaded = load_model("qwen", PROFILES, "cpu")
+	assert not hasattr(loaded.model, "hub")
+	# the manifest keys are not Llama() arguments, cache types are given by name
+	assert loaded.model.kwargs == {
+		"model_path": str(gguf), "n_ctx": 4096, "use_mlock": True,
+		"type_k": llama_cpp.GGML_TYPE_Q8_0, "type_v": llama_cpp.GGML_TYPE_F16,
+	}
+	assert loaded.draft == draft
+
+def test_other_family_or_unknown_profile(models, monkeypatch):
+	write_manifest(models, {"qwen/cpu": {"path": str(models / "model.gguf"), "family": "mistral"}})
+	with pytest.raises(ValueError, match="is a mistral model"):
+		load_model("qwen", PROFILES, "cpu")
+	monkeypatch.setenv("MODEL_PROFILE", "huge")
+	with pytest.raises(ValueError, match="Unknown model profile: qwen/huge"):
+		load_model("qwen", PROFILES, "cpu")
+
+def test_tuning_and_worker_threads(models, monkeypatch):
+	(models / "tuning.json").write_text(json.dumps({
+		"test host": {"qwen/cpu": {"n_threads": 12, "n_batch": 1024, "n_ctx": 1}},
+		"other host": {"qwen/cpu": {"n_threads": 2}},
+	}))
+	assert load_model("qwen", PROFILES, "cpu").model.kwargs["n_threads"] == 12
+	monkeypatch.setenv("N_THREADS", "4")
+	monkeypatch.setenv("N_THREADS_BATCH", "6")
+	kwargs = load_model("qwen", PROFILES, "cpu").model.kwargs
+	# only the tuned keys are taken from the tuning file
+	assert (kwargs["n_threads"], kwargs["n_threads_batch"], kwargs["n_batch"], kwargs["n_ctx"]) == (4, 6, 1024, 8192)
+
+def test_checksum_mismatch_stops_the_load(models):
+	gguf = models / "model.gguf"
+	write_manifest(models, {"qwen/cpu": {"path": str(gguf), "sha256": "0" * 64}})
+	with pytest.raises(ValueError, match="Checksum mismatch"):
+		load_model("qwen", PROFILES, "cpu")
+	assert not (models / "models.verified.json").exists()
+
+def test_checksum_is_skipped_with_model_verify_off(models, monkeypatch):
+	monkeypatch.setenv("MODEL_VERIFY", "off")
+	write_manifest(models, {"qwen/cpu": {"path": str(models / "model.gguf"), "sha256": "0" * 64}})
+	assert load_model("qwen", PROFILES, "cpu").model.kwargs["model_path"] == str(models / "model.gguf")
+
+def test_verified_file_is_not_read_again(models, monkeypatch):
+	gguf = models / "model.gguf"
+	stamps = models / "models.verified.json"
+	digest = sha256(gguf)
+	verify(str(gguf), digest.upper(), str(stamps))
+	assert list(json.loads(stamps.read_text()).values()) == [digest]
+	def unexpected():
+		raise AssertionError("hashed again")
+	monkeypatch.setattr(registry.hashlib, "sha256", unexpected)
+	verify(str(gguf), digest, str(stamps))
+
+def test_ready(make_pipeline):
+	request_pipeline = make_pipeline()
+	client = TestClient(request_pipeline.app)
+	# no credentials needed
+	response = client.get("/ready")
+	assert response.status_code == 200
+	assert response.json() == {"ready": True, "profile": "test"}
+	request_pipeline.shutting_down.set()
+	assert client.get("/ready").status_code == 503
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+import pytest
+from engine import Engine
+from resumable import ResumableStreams, StreamBuffer, StreamGone
+from scheduler import AdmissionScheduler
+
+def test_buffer_ids_count_lines():
+	buffer = StreamBuffer(None, max_frames=3)
+	assert (buffer.first_id, buffer.next_id) == (1, 1)
+	# a coalesced chunk holds several frames
+	buffer.append("a\nb\n")
+	buffer.append("c\n")
+	assert (buffer.first_id, buffer.next_id) == (1, 4)
+	buffer.append("d\n")
+	# only the last max_frames are kept
+	assert (buffer.first_id, buffer.next_id) == (2, 5)
+	assert list(buffer.frames) == ["b\n", "c\n", "d\n"]
+
+# before frames before the gate opens, after frames after it
+def gated_frames(gate: threading.Event, before: int = 3, after: int = 3):
+	def run(job):
+		for i in range(before):
+			yield f"frame {i}\n"
+		gate.wait(5)
+		for i in range(before, before + after):
+			yield f"frame {i}\n"
+	return run
+
+async def read_lines(frames, count: int | None = None) -> list:
+	lines = []
+	async for chunk in frames:
+		lines.extend(chunk.splitlines(keepends=True))
+		if count is not None and len(lines) >= count:
+			await frames.aclose()
+			break
+	return lines
+
+def test_resume_replays_the_missed_frames():
+	async def run():
+		engine = Engine(None, AdmissionScheduler(max_backlog_tokens=100000, max_waiting=8))
+		streams = ResumableStreams(engine, ttl=5, max_frames=100)
+		gate = threading.Event()
+		job = engine.submit(gated_frames(gate), "r1")
+		first = await read_lines(streams.stream(job), 3)
+		assert first[:3] == ["frame 0\n", "frame 1\n", "frame 2\n"]
+		# the connection is gone, the generation is not
+		gate.set()
+		while not streams.buffers["r1"].done:
+			await asyncio.sleep(0.01)
+		assert streams.buffers["r1"].next_id == 7
+		rest = await read_lines(streams.resume("r1", 3))
+		assert rest == ["frame 3\n", "frame 4\n", "frame 5\n"]
+		assert await read_lines(streams.resume("r1", 5)) == ["frame 5\n"]
+		engine.close(timeout=1)
+
+	asyncio.run(run())
+
+def test_resume_rejects_ids_it_cannot_serve():
+	async def run():
+		engine = Engine(None, AdmissionScheduler(max_backlog_tokens=100000, max_waiting=8))
+		streams = ResumableStreams(engine, ttl=5, max_frames=2)
+		gate = threading.Event()
+		job = engine.submit(gated_frames(gate, 2, 2), "r1")
+		await read_lines(streams.stream(job), 2)
+		gate.set()
+		while not streams.buffers["r1"].done:
+			await asyncio.sleep(0.01)
+		# a client that got everything gets nothing more
+		assert await read_lines(streams.resume("r1", 4)) == []
+		with pytest.raises(ValueError):
+			streams.resume("r1", 5)
+		with pytest.raises(ValueError):
+			streams.resume("r1", -1)
+		# frames 1 and 2 were dropped from the buffer
+		with pytest.raises(StreamGone):
+			streams.resume("r1", 1)
+		assert await read_lines(streams.resume("r1", 2)) == ["frame 2\n", "frame 3\n"]
+		with pytest.raises(KeyError):
+			streams.resume("r2", 0)
+		engine.close(timeout=1)
+
+	asyncio.run(run())
+
+def test_abandoned_streams_are_cancelled_after_ttl():
+	async def run():
+		engine = Engine(None, AdmissionScheduler(max_backlog_tokens=100000, max_waiting=8))
+		streams = ResumableStreams(engine, ttl=0.05, max_frames=100)
+		gate = threading.Event()
+		job = engine.submit(gated_frames(gate), "r1")
+		await read_lines(streams.stream(job), 1)
+		await asyncio.sleep(0.2)
+		assert job.cancelled.is_set()
+		gate.set()
+		engine.close(timeout=1)
+
+	asyncio.run(run())
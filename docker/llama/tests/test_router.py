@@ -0,0 +1,159 @@
+import asyncio
+import importlib
+import pytest
+from fastapi.testclient import TestClient
+from upstream import ServerProcess
+
+AUTH = ("user", "password")
+
+# names of the models whose loads wait until they are taken out
+HELD = set()
+
+# A Popen that runs until it is terminated
+class FakePopen:
+	def __init__(self):
+		self.returncode = None
+
+	def poll(self):
+		return self.returncode
+
+	def terminate(self):
+		self.returncode = -15
+
+	def kill(self):
+		self.returncode = -9
+
+	def wait(self, timeout=None):
+		return self.returncode
+
+# A server process without a server: it is ready as soon as its name is not held
+class FakeProcess(ServerProcess):
+	def launch(self, preexec_fn=None):
+		self.ready = False
+		self.process = FakePopen()
+
+	async def wait_ready(self, client, timeout: float):
+		while self.name in HELD:
+			await asyncio.sleep(0.01)
+		self.ready = True
+
+@pytest.fixture
+def router_module(tmp_path, monkeypatch):
+	# router.py builds its router from the environment when it is imported
+	monkeypatch.setenv("AI_USERNAME", "user")
+	monkeypatch.setenv("AI_PASSWORD", "password")
+	monkeypatch.setenv("ROUTER_CONFIG", str(tmp_path / "router.json"))
+	monkeypatch.setenv("MODEL_MANIFEST", str(tmp_path / "models.json"))
+	module = importlib.import_module("router")
+	monkeypatch.setattr(module, "ServerProcess", FakeProcess)
+	monkeypatch.setattr(module, "correct_username", "user")
+	monkeypatch.setattr(module, "correct_password", "password")
+	HELD.clear()
+	return module
+
+def make_router(router_module, budget_bytes: int = 100):
+	models = {name: {"server": "qwen", "profile": name, "memory_bytes": 40} for name in ("a", "b", "c")}
+	return router_module.ModelRouter(models, budget_bytes, idle_seconds=0, default="a", base_port=9000, load_timeout=5, drain_grace=0)
+
+async def use(router, name: str):
+	router.release(await router.acquire(name))
+
+def test_least_recently_used_model_is_evicted(router_module):
+	async def run():
+		router = make_router(router_module)
+		await use(router, "a")
+		await use(router, "b")
+		# b is now the least recently used
+		await use(router, "a")
+		await use(router, "c")
+		assert sorted(router.resident) == ["a", "c"]
+		assert (router.loads, router.evictions) == (3, 1)
+		assert router.used_bytes() == 80
+		# the evicted model is loaded again on its next request
+		await use(router, "b")
+		assert sorted(router.resident) == ["b", "c"]
+		assert [p.name for p in router.processes] == ["c", "b"]
+		await router.close()
+
+	asyncio.run(run())
+
+def test_busy_models_are_not_evicted(router_module):
+	async def run():
+		router = make_router(router_module)
+		a = await router.acquire("a")
+		await router.acquire("b")
+		with pytest.raises(router_module.MemoryBudgetError) as error:
+			await router.acquire("c")
+		assert error.value.retry_after == 10
+		# once a stream ended its model can make room
+		router.release(a)
+		await use(router, "c")
+		assert sorted(router.resident) == ["b", "c"]
+		await router.close()
+
+	asyncio.run(run())
+
+def test_model_larger_than_the_budget(router_module):
+	async def run():
+		router = make_router(router_module, budget_bytes=30)
+		with pytest.raises(router_module.MemoryBudgetError) as error:
+			await router.acquire("a")
+		assert error.value.retry_after == 3600
+		assert router.processes == []
+		await router.close()
+
+	asyncio.run(run())
+
+def test_reload_swaps_without_dropping_streams(router_module):
+	async def run():
+		router = make_router(router_module)
+		old = await router.acquire("a")
+		HELD.add("a")
+		reload = asyncio.ensure_future(router.reload("a", {"env": {"BATCH_SLOTS": "2"}}))
+		while len(router.processes) < 2:
+			await asyncio.sleep(0.01)
+		# requests keep going to the old process while the new one loads
+		assert router.status()[0]["state"] == "ready"
+		second = await router.acquire("a")
+		assert second is old
+		router.release(second)
+		with pytest.raises(ValueError):
+			await router.reload("a", {})
+		HELD.discard("a")
+		assert await reload
+		new = router.resident["a"]
+		assert new is not old and new.env["BATCH_SLOTS"] == "2"
+		assert router.models["a"]["env"] == {"BATCH_SLOTS": "2"}
+		assert await router.acquire("a") is new
+		# the old process drains: it is stopped after its last stream
+		assert old.draining and old.alive()
+		router.release(old)
+		while old in router.processes:
+			await asyncio.sleep(0.05)
+		assert not old.alive()
+		assert new.alive()
+		await router.close()
+
+	asyncio.run(run())
+
+def test_reload_of_an_unloaded_model_changes_the_next_load(router_module):
+	async def run():
+		router = make_router(router_module)
+		assert not await router.reload("b", {"env": {"N_THREADS": "4"}})
+		assert router.processes == []
+		process = await router.acquire("b")
+		assert process.env["N_THREADS"] == "4"
+		await router.close()
+
+	asyncio.run(run())
+
+def test_unknown_model(router_module, monkeypatch):
+	monkeypatch.setattr(router_module, "router", make_router(router_module))
+	client = TestClient(router_module.app)
+	response = client.post("/generate", json={"model": "missing", "messages": []}, auth=AUTH)
+	assert response.status_code == 404
+	assert client.post("/admin/models/missing/reload", auth=AUTH).status_code == 404
+	assert client.post("/admin/models/missing/unload", auth=AUTH).status_code == 404
+	with pytest.raises(KeyError):
+		asyncio.run(router_module.router.acquire("missing"))
+	assert router_module.router.processes == []
@@ -0,0 +1,81 @@
+import threading
+import pytest
+from scheduler import AdmissionScheduler, QueueFullError, estimate_tokens
+
+class Job:
+	def __init__(self, name: str):
+		self.name = name
+
+def push(scheduler: AdmissionScheduler, name: str, priority: int, cost: int = 10) -> Job:
+	job = Job(name)
+	scheduler.push(job, priority, cost)
+	return job
+
+def test_pops_by_priority_then_arrival():
+	scheduler = AdmissionScheduler(max_backlog_tokens=1000, max_waiting=10)
+	push(scheduler, "low", 3)
+	push(scheduler, "first", 1)
+	push(scheduler, "urgent", 0)
+	push(scheduler, "second", 1)
+	assert [scheduler.pop().name for _ in range(4)] == ["urgent", "first", "second", "low"]
+
+def test_rejects_when_too_many_wait():
+	scheduler = AdmissionScheduler(max_backlog_tokens=1000, max_waiting=2)
+	push(scheduler, "a", 1)
+	push(scheduler, "b", 1)
+	with pytest.raises(QueueFullError):
+		push(scheduler, "c", 0)
+	assert len(scheduler) == 2
+
+def test_retry_after_covers_the_backlog():
+	scheduler = AdmissionScheduler(max_backlog_tokens=500, max_waiting=10)
+	push(scheduler, "a", 1, cost=400)
+	with pytest.raises(QueueFullError) as error:
+		push(scheduler, "b", 1, cost=200)
+	# 600 tokens at the initial 100 tokens/s
+	assert error.value.retry_after == 6
+	assert scheduler.backlog_tokens == 400
+
+def test_empty_queue_admits_oversized_requests():
+	scheduler = AdmissionScheduler(max_backlog_tokens=100, max_waiting=10)
+	push(scheduler, "huge", 1, cost=1000)
+	assert scheduler.pop().name == "huge"
+
+def test_done_updates_the_throughput_estimate():
+	scheduler = AdmissionScheduler(max_backlog_tokens=1000, max_waiting=10)
+	job = push(scheduler, "a", 1, cost=600)
+	scheduler.pop()
+	scheduler.done(job, elapsed=1.0, completed=True)
+	assert scheduler.backlog_tokens == 0
+	assert scheduler.tokens_per_second == pytest.approx(0.8 * 100 + 0.2 * 600)
+	# a cancelled job releases its backlog but says nothing about throughput
+	job = push(scheduler, "b", 1, cost=600)
+	scheduler.pop()
+	scheduler.done(job, elapsed=0.1, completed=False)
+	assert scheduler.tokens_per_second == pytest.approx(200)
+
+def test_remove_releases_the_backlog():
+	scheduler = AdmissionScheduler(max_backlog_tokens=1000, max_waiting=10)
+	a = push(scheduler, "a", 1, cost=100)
+	push(scheduler, "b", 2, cost=50)
+	assert scheduler.remove(a)
+	assert not scheduler.remove(a)
+	assert scheduler.backlog_tokens == 50
+	assert scheduler.pop().name == "b"
+
+def test_close_wakes_pop_and_returns_the_waiting_jobs():
+	scheduler = AdmissionScheduler(max_backlog_tokens=1000, max_waiting=10)
+	popped = []
+	thread = threading.Thread(target=lambda: popped.append(scheduler.pop()))
+	thread.start()
+	thread.join(0.05)
+	assert thread.is_alive()
+	assert scheduler.close() == []
+	thread.join(1)
+	assert popped == [None]
+	with pytest.raises(RuntimeError):
+		push(scheduler, "late", 1)
+
+def test_estimate_tokens():
+	messages = [{"role": "user", "content": "x" * 400}, {"role": "assistant", "content": "", "tool_calls": [{"name": "f"}]}]
+	assert estimate_tokens(messages, None, 100) == (400 + len('[{"name": "f"}]')) // 4 + 100
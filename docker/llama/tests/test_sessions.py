@@ -0,0 +1,108 @@
+import json
+from types import SimpleNamespace
+from fastapi.testclient import TestClient
+import sessions
+from fake_llama import FakeLlama
+from loadgen import TOOLS
+from sessions import SessionStore
+
+AUTH = ("user", "password")
+
+def evaluated(tokens, n_ctx: int = 256) -> FakeLlama:
+	model = FakeLlama("qwen", n_ctx=n_ctx)
+	model.eval(tokens)
+	return model
+
+def test_restore_loads_the_pinned_state_once():
+	store = SessionStore(max_bytes=1 << 20, ttl=60)
+	model = evaluated([1, 2, 3, 4, 5])
+	store.pin(model, "a")
+	# another request in between
+	model.reset()
+	model.eval([9, 9])
+	assert store.restore(model, "a", [1, 2, 3, 4, 5, 6, 7]) == 5
+	assert model.n_tokens == 5
+	assert model.input_ids[:5].tolist() == [1, 2, 3, 4, 5]
+	assert store.stats()["sessions"] == 0
+	# the pin is consumed
+	model.reset()
+	assert store.restore(model, "a", [1, 2, 3, 4, 5, 6, 7]) == 0
+	assert (store.hits, store.misses) == (1, 1)
+
+def test_restore_keeps_a_longer_context():
+	store = SessionStore(max_bytes=1 << 20, ttl=60)
+	model = evaluated([1, 2])
+	store.pin(model, "a")
+	model.eval([3, 4])
+	assert store.restore(model, "a", [1, 2, 3, 4, 5]) == 4
+	assert model.n_tokens == 4
+
+def test_pins_expire_after_the_ttl(monkeypatch):
+	now = [100.0]
+	monkeypatch.setattr(sessions, "time", SimpleNamespace(monotonic=lambda: now[0]))
+	store = SessionStore(max_bytes=1 << 20, ttl=10)
+	model = evaluated([1, 2, 3])
+	store.pin(model, "a")
+	now[0] = 105.0
+	store.pin(model, "b")
+	now[0] = 110.0
+	model.reset()
+	assert store.restore(model, "a", [1, 2, 3, 4]) == 0
+	assert store.restore(model, "b", [1, 2, 3, 4]) == 3
+	assert (store.hits, store.misses) == (1, 1)
+
+def test_pins_closest_to_expiring_are_evicted_over_the_budget(monkeypatch):
+	now = [100.0]
+	monkeypatch.setattr(sessions, "time", SimpleNamespace(monotonic=lambda: now[0]))
+	model = evaluated([1, 2, 3])
+	size = model.input_ids.nbytes + 4
+	store = SessionStore(max_bytes=2 * size, ttl=10)
+	for i, session_id in enumerate(["a", "b", "c"]):
+		now[0] = 100.0 + i
+		store.pin(model, session_id)
+	assert sorted(store.sessions) == ["b", "c"]
+	assert store.total_bytes == 2 * size
+	assert store.evictions == 1
+	# a state over the whole budget is not pinned
+	store.max_bytes = size - 1
+	store.pin(model, "d")
+	assert "d" not in store.sessions
+
+def generate(client, messages, session_id=None):
+	body = {"messages": messages, "tools": TOOLS}
+	if session_id is not None:
+		body["session_id"] = session_id
+	response = client.post("/generate", json=body, auth=AUTH)
+	assert response.status_code == 200
+	return [json.loads(line) for line in response.text.splitlines()]
+
+def dialog(question: str):
+	return [{"role": "system", "content": "You read channels."}, {"role": "user", "content": question}]
+
+def test_tool_call_pins_the_session_for_the_follow_up(make_pipeline):
+	request_pipeline = make_pipeline(tool_rate=1.0)
+	client = TestClient(request_pipeline.app)
+	messages = dialog("What happened in general today?")
+	frames = generate(client, messages, "s1")
+	call = [frame["text"] for frame in frames if frame.get("is_tool")]
+	assert len(call) == 1
+	assert request_pipeline.session_store.stats()["sessions"] == 1
+
+	# another dialog takes the context while the backend runs the tool
+	generate(client, dialog("Who asked about the voice issue?"))
+	messages += [
+		{"role": "assistant", "content": "", "tool_calls": [json.loads(call[0])]},
+		{"role": "tool", "content": json.dumps([{"userName": "Bob", "text": "hi"}])},
+	]
+	perf = generate(client, messages, "s1")[-1]["perf"]
+	assert request_pipeline.session_store.hits == 1
+	assert perf["prefill_tokens"] < perf["prompt_tokens"] // 2
+
+def test_delete_session(make_pipeline):
+	request_pipeline = make_pipeline(tool_rate=1.0)
+	client = TestClient(request_pipeline.app)
+	generate(client, dialog("What happened in general today?"), "s1")
+	assert client.delete("/sessions/s1", auth=AUTH).status_code == 204
+	assert request_pipeline.session_store.stats()["sessions"] == 0
+	assert client.delete("/sessions/s1", auth=AUTH).status_code == 404
+	assert client.delete("/sessions/s1").status_code == 401
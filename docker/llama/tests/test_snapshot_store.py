@@ -0,0 +1,53 @@
+import os
+import time
+import numpy
+from llama_cpp.llama import LlamaState
+from snapshot_store import SnapshotStore
+
+def make_state(tokens, size: int = 1000):
+	input_ids = numpy.zeros((64,), dtype=numpy.intc)
+	input_ids[:len(tokens)] = tokens
+	return LlamaState(
+		input_ids=input_ids,
+		scores=numpy.zeros((1, 8), dtype=numpy.single),
+		n_tokens=len(tokens),
+		llama_state=bytes([len(tokens)]) * size,
+		llama_state_size=size,
+		seed=7,
+	)
+
+def test_save_is_written_by_the_writer(tmp_path):
+	store = SnapshotStore(str(tmp_path), "model", 1 << 20)
+	store.save([1, 2, 3], make_state([1, 2, 3]))
+	# saving the same prefix again while it is queued does nothing
+	store.save([1, 2, 3], make_state([1, 2, 3]))
+	store.close()
+	state = store.load([1, 2, 3])
+	assert state is not None
+	assert state.n_tokens == 3
+	assert list(state.input_ids[:3]) == [1, 2, 3]
+	assert bytes(state.llama_state) == bytes([3]) * 1000
+	assert state.seed == 7
+	assert store.load([1, 2]) is None
+	assert os.listdir(tmp_path / "model") == [os.path.basename(store.path([1, 2, 3]))]
+
+def test_running_total_and_eviction(tmp_path):
+	# room for two snapshots of about 1 KB
+	store = SnapshotStore(str(tmp_path), "model", 2500)
+	for i in range(1, 4):
+		store.save([i], make_state([i]))
+		# the oldest file is evicted first, by mtime
+		time.sleep(0.01)
+	store.close()
+	assert store.load([1]) is None
+	assert store.load([2]) is not None
+	assert store.load([3]) is not None
+	assert store.total_bytes == sum(os.path.getsize(p) for p in store.files())
+
+def test_total_is_read_at_start(tmp_path):
+	store = SnapshotStore(str(tmp_path), "model", 1 << 20)
+	store.save([5], make_state([5]))
+	store.close()
+	reopened = SnapshotStore(str(tmp_path), "other-model", 1 << 20)
+	assert reopened.total_bytes == store.total_bytes > 0
+	reopened.close()
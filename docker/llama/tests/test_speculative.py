@@ -0,0 +1,64 @@
+import time
+import pytest
+from metrics import ServerMetrics
+from speculative import PromptLookup, Speculation, SpeculativeStats
+
+def test_lookup_continues_the_latest_occurrence():
+	lookup = PromptLookup(max_ngram=3, num_pred=4)
+	tokens = [1, 2, 3, 4, 5, 6, 9, 2, 3, 7, 8, 2, 3]
+	# the trigram "x 2 3" does not repeat, the bigram "2 3" last occurred before 7 8
+	assert lookup.propose(tokens) == [7, 8, 2, 3]
+
+def test_lookup_prefers_the_longest_ngram():
+	lookup = PromptLookup(max_ngram=3, num_pred=2)
+	tokens = [1, 2, 3, 10, 11, 9, 2, 3, 20, 21, 1, 2, 3]
+	# "1 2 3" occurred at the start, "2 3" later before 20 21
+	assert lookup.propose(tokens) == [10, 11]
+
+def test_lookup_without_match():
+	lookup = PromptLookup()
+	assert lookup.propose([1, 2, 3]) == []
+	assert lookup.propose([5]) == []
+
+def test_lookup_indexes_incrementally():
+	lookup = PromptLookup(max_ngram=2, num_pred=3)
+	tokens = [4, 5, 6, 7]
+	assert lookup.propose(tokens) == []
+	indexed = lookup.indexed
+	tokens += [4, 5]
+	assert lookup.propose(tokens) == [6, 7, 4]
+	assert lookup.indexed == len(tokens) > indexed
+	# later occurrences win
+	tokens += [8, 4, 5]
+	assert lookup.propose(tokens) == [8, 4, 5]
+
+def test_stats():
+	stats = SpeculativeStats("lookup")
+	stats.steps, stats.drafted, stats.accepted, stats.generated = 3, 8, 6, 9
+	time.sleep(0.01)
+	stats.finish()
+	perf = stats.perf()
+	assert perf["acceptance_rate"] == 0.75
+	assert perf["drafted"] == 8 and perf["accepted"] == 6 and perf["mode"] == "lookup"
+	# frozen once finished
+	assert stats.tokens_per_second == stats.tokens_per_second > 0
+	assert SpeculativeStats().acceptance_rate == 0.0
+
+def test_unknown_arguments_are_rejected():
+	with pytest.raises(TypeError):
+		Speculation("off").generate(None, [1, 2], repetition_penalty=1.1)
+
+def test_stats_in_perf_and_metrics():
+	metrics = ServerMetrics("qwen", "cpu", 4096)
+	request = metrics.start(time.monotonic())
+	request.speculative = SpeculativeStats("lookup")
+	request.speculative.drafted = 10
+	request.speculative.accepted = 4
+	assert request.perf(0.0)["speculative"]["acceptance_rate"] == 0.4
+	request.finish("completed")
+	# a request without drafts does not count
+	metrics.start(time.monotonic()).finish("completed")
+	text = metrics.render()
+	assert 'llama_speculative_drafted_tokens_total{model_profile="cpu",model_family="qwen"} 10' in text
+	assert 'llama_speculative_accepted_tokens_total{model_profile="cpu",model_family="qwen"} 4' in text
+	assert 'llama_speculative_acceptance_ratio_count{model_profile="cpu",model_family="qwen"} 1' in text
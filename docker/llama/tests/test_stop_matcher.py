@@ -0,0 +1,59 @@
+from stop_matcher import JsonValueEnd, StopMatcher, normalize_json_call
+
+def feed(matcher: StopMatcher, pieces):
+	out = []
+	for piece in pieces:
+		text, matched = matcher.push(piece)
+		out.append(text)
+		if matched is not None:
+			return "".join(out), matched
+	return "".join(out) + matcher.flush(), None
+
+def test_match_split_over_pieces():
+	matcher = StopMatcher(["STOP"])
+	assert matcher.push("hello ST") == ("hello ", None)
+	assert matcher.held == "ST"
+	assert matcher.push("OP and more") == ("", "STOP")
+	assert matcher.remainder == " and more"
+
+def test_held_text_is_released_when_it_does_not_match():
+	matcher = StopMatcher(["STOP"])
+	assert matcher.push("a S") == ("a ", None)
+	assert matcher.push("Tx") == ("STx", None)
+	assert matcher.held == ""
+
+def test_flush_returns_the_held_text():
+	assert feed(StopMatcher(["STOP"]), ["one ", "STO"]) == ("one STO", None)
+
+def test_earliest_match_wins():
+	assert feed(StopMatcher(["c", "abc"]), ["xxabc"]) == ("xx", "abc")
+	assert feed(StopMatcher(["```tool_code\n", "END"]), ["text ``", "`tool", "_code\nf()"]) == ("text ", "```tool_code\n")
+
+def test_holds_back_the_longest_possible_start():
+	matcher = StopMatcher(["abcd", "bce"])
+	assert matcher.push("xabc") == ("x", None)
+	assert matcher.held == "abc"
+	assert matcher.push("e") == ("a", "bce")
+
+def test_empty_patterns_are_ignored():
+	assert feed(StopMatcher([""]), ["some", "text"]) == ("sometext", None)
+
+def test_json_value_end_of_an_array_split_over_pieces():
+	end = JsonValueEnd()
+	assert end.push('[{"name": "f", ') == -1
+	assert end.push('"arguments": {"a": [1, 2]}}') == -1
+	assert end.push(']</s>') == 1
+
+def test_json_value_end_ignores_brackets_in_strings():
+	end = JsonValueEnd()
+	text = '{"text": "a ] } \\" ]"}'
+	assert end.push(text + " trailing") == len(text)
+
+def test_json_value_end_waits_for_the_value_to_start():
+	end = JsonValueEnd()
+	assert end.push(" ] ") == -1
+	assert end.push("[]") == 2
+
+def test_normalize_json_call():
+	assert normalize_json_call('{"name":"f","arguments":{}}') == '{"name": "f", "arguments": {}}'
+	assert normalize_json_call("not json") == "not json"
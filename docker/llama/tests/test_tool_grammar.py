@@ -0,0 +1,146 @@
+import ast
+import ctypes
+import json
+import os
+import re
+import threading
+import time
+import llama_cpp
+from chat_template import canonical_tools
+from loadgen import TOOLS
+from tool_grammar import ToolGrammarCache, json_tool_call_grammar, python_tool_call_grammar, trigger_pattern
+
+# Runs the grammar through llama.cpp's parser the way the speculative sampler
+# does. The vocab is only needed to tokenize trigger words, so none is loaded.
+def parse(grammar: str, trigger_patterns=(), trigger_tokens=()) -> bool:
+	patterns = (ctypes.c_char_p * max(1, len(trigger_patterns)))(*[p.encode("utf-8") for p in trigger_patterns])
+	tokens = (llama_cpp.llama_token * max(1, len(trigger_tokens)))(*trigger_tokens)
+	sampler = llama_cpp.llama_sampler_init_grammar_lazy_patterns(
+		None, grammar.encode("utf-8"), b"root", patterns, len(trigger_patterns), tokens, len(trigger_tokens),
+	)
+	if not sampler:
+		return False
+	llama_cpp.llama_sampler_free(sampler)
+	return True
+
+# The call regexes of gemma3.py, read from its source: importing the server
+# loads a model.
+def gemma3_call_regexes():
+	with open(os.path.join(os.path.dirname(__file__), "..", "dist", "gemma3.py")) as f:
+		tree = ast.parse(f.read())
+	regexes = {}
+	for node in tree.body:
+		if isinstance(node, ast.Assign) and node.targets[0].id.startswith("re_"):
+			regexes[node.targets[0].id[3:]] = re.compile(ast.literal_eval(node.value.args[0]))
+	return regexes
+
+def test_parse_rejects_broken_grammars():
+	assert parse('root ::= "x"')
+	assert not parse('root ::= "x" undefined')
+	assert not parse('root ::= ("x"')
+
+def test_python_grammar():
+	grammar = python_tool_call_grammar("```tool_code\n", "\n```", canonical_tools(TOOLS))
+	assert grammar.split("\n")[:4] == [
+		'root ::= "```tool_code\\n" call ("\\n" call)* "\\n```"',
+		"call ::= call0 | call1",
+		'call0 ::= "getChannelMessagesRange(" "channelIndex=" ("-"? [0-9]+) ", " "startDate=" ("\\"" [^"\\\\\\n]* "\\"") ", " "endDate=" ("\\"" [^"\\\\\\n]* "\\"") ")"',
+		'call1 ::= "getRecentChannelMessages(" "channelIndex=" ("-"? [0-9]+) ", " "limit=" ("-"? [0-9]+) ")"',
+	]
+	assert parse(grammar, [trigger_pattern("```tool_code\n")])
+
+# A call the rule accepts: each value group of the rule is replaced by the next
+# of values, then the literals are concatenated
+def instantiate(rule: str, values) -> str:
+	values = iter(values)
+	body = re.sub(r'\("-"\? \[0-9\]\+\)|\("\\"" \[\^"\\\\\\n\]\* "\\""\)', lambda m: json.dumps(next(values)), rule.split(" ::= ", 1)[1])
+	return "".join(json.loads(literal) for literal in re.findall(r'"(?:[^"\\]|\\.)*"', body))
+
+def test_python_grammar_argument_order_matches_gemma3():
+	# canonical_tools sorts the schema keys, the properties of
+	# getChannelMessagesRange come out as channelIndex, endDate, startDate. The
+	# arguments follow the required list instead, in the order gemma3.py parses.
+	tools = canonical_tools(list(reversed(TOOLS)))
+	assert [tool["function"]["name"] for tool in tools] == ["getChannelMessagesRange", "getRecentChannelMessages"]
+	assert list(tools[0]["function"]["parameters"]["properties"]) == ["channelIndex", "endDate", "startDate"]
+	rules = python_tool_call_grammar("```tool_code\n", "\n```", tools).split("\n")
+	regexes = gemma3_call_regexes()
+	call = instantiate(rules[2], ["2", '"2025-01-27"', '"2025-01-28"'])
+	assert call == 'getChannelMessagesRange(channelIndex=2, startDate="2025-01-27", endDate="2025-01-28")'
+	assert regexes["getChannelMessagesRange"].match(call)
+	call = instantiate(rules[3], ["0", "20"])
+	assert call == "getRecentChannelMessages(channelIndex=0, limit=20)"
+	assert regexes["getRecentChannelMessages"].match(call)
+
+def test_python_grammar_optional_and_list_arguments():
+	tools = [{"type": "function", "function": {"name": "f", "parameters": {"type": "object", "properties": {
+		"a": {"type": "string", "enum": ["x", "y"]},
+		"b": {"type": "array", "items": {"type": "integer"}},
+	}, "required": ["b"]}}}]
+	grammar = python_tool_call_grammar("<", ">", tools)
+	assert "call0 ::= \"f(\" \"b=\" call0-b" in grammar
+	assert "(\", \" \"a=\" (\"'x'\" | \"'y'\"))?" in grammar
+	assert "call0-b ::= \"[\" space (integer (\",\" space integer)*)? \"]\" space\n" in grammar
+	assert parse(grammar)
+
+def test_json_grammar():
+	grammar = json_tool_call_grammar("<tool_call>\n", "\n</tool_call>", canonical_tools(TOOLS))
+	lines = grammar.split("\n")
+	assert lines[:3] == [
+		'root ::= "<tool_call>\\n" call "\\n</tool_call>"',
+		"call ::= call-0 | call-1",
+		'call-0 ::= "{" space call-0-name-kv "," space call-0-arguments-kv "}" space',
+	]
+	assert 'call-0-name ::= "\\"getChannelMessagesRange\\""' in lines
+	assert 'call-1-arguments ::= "{" space call-1-arguments-channelIndex-kv "," space call-1-arguments-limit-kv "}" space' in lines
+	assert parse(grammar, [], [151657])
+
+def test_json_array_grammar():
+	grammar = json_tool_call_grammar("[TOOL_CALLS]", "", canonical_tools(TOOLS), array=True)
+	assert grammar.startswith('root ::= "[TOOL_CALLS]" "[" space call ("," space call)* "]"\n')
+	assert parse(grammar, [], [9])
+
+def test_trigger_pattern_escapes():
+	assert trigger_pattern("[TOOL_CALLS]") == "[\\s\\S]*?(\\[TOOL_CALLS\\])[\\s\\S]*"
+
+def test_cache_hits_and_bounds():
+	built = []
+	cache = ToolGrammarCache(lambda tools: built.append(tools) or "root ::= \"x\"", [], [1], max_entries=2)
+	assert cache.get(None) is None
+	first = cache.get(TOOLS)
+	assert cache.get(list(reversed(TOOLS))) is first
+	cache.get(TOOLS[:1])
+	cache.get(TOOLS[1:])
+	assert cache.stats() == {"hits": 1, "misses": 3, "entries": 2}
+	assert len(built) == 3
+
+def test_failed_build_is_cached():
+	def build(tools):
+		raise ValueError("bad schema")
+	cache = ToolGrammarCache(build, [], [])
+	assert cache.get(TOOLS) is None
+	assert cache.get(TOOLS) is None
+	assert cache.stats()["misses"] == 1
+
+def test_concurrent_gets():
+	def build(tools):
+		time.sleep(0.001)
+		return "root ::= \"x\""
+	cache = ToolGrammarCache(build, [], [], max_entries=3)
+	tool_sets = [[{"type": "function", "function": {"name": f"t{i}"}}] for i in range(8)]
+	errors = []
+
+	def run(offset: int):
+		try:
+			for i in range(200):
+				cache.get(tool_sets[(i + offset) % len(tool_sets)])
+		except Exception as e:
+			errors.append(e)
+
+	threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	assert errors == []
+	assert cache.stats()["entries"] == 3
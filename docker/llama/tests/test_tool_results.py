@@ -0,0 +1,78 @@
+import json
+import pytest
+from tool_results import ToolResultEncoder, encode_channel_messages, is_channel_messages
+
+def message(created_at: str, user: str, text: str) -> dict:
+	return {"createdAt": created_at, "userName": user, "text": text}
+
+def test_repeated_long_names_get_an_alias():
+	encoded = encode_channel_messages([
+		message("2025-01-27 09:12", "Alexandra Miller", "the stream starts at eight"),
+		message("2025-01-27 09:15", "Bob", "who is joining?"),
+		message("2025-01-27 09:16", "Alexandra Miller", "me"),
+		message("2025-01-27 09:17", "Bob", "ok"),
+	])
+	assert encoded.split("\n") == [
+		"4 messages, oldest first. Users: u1 = Alexandra Miller",
+		"== 2025-01-27 ==",
+		"09:12 u1: the stream starts at eight",
+		"09:15 Bob: who is joining?",
+		"09:16 u1: me",
+		"09:17 Bob: ok",
+	]
+
+def test_long_names_that_occur_once_are_kept():
+	encoded = encode_channel_messages([message("2025-01-27 09:12", "Alexandra Miller", "hi")])
+	assert encoded.split("\n")[0] == "1 messages, oldest first."
+	assert encoded.endswith("09:12 Alexandra Miller: hi")
+
+def test_names_that_look_like_aliases_are_aliased_too():
+	encoded = encode_channel_messages([
+		message("2025-01-27 09:12", "community-bot", "a"),
+		message("2025-01-27 09:13", "u1", "b"),
+		message("2025-01-27 09:14", "community-bot", "c"),
+	])
+	lines = encoded.split("\n")
+	assert lines[0] == "3 messages, oldest first. Users: u1 = community-bot, u2 = u1"
+	assert lines[3] == "09:13 u2: b"
+
+def test_days_whitespace_and_continuation_lines():
+	encoded = encode_channel_messages([
+		message("2025-01-27 23:59", "Bob", "a  \t b"),
+		message("2025-01-28 00:01", "Bob: the builder", "first\n\n  second line"),
+		message("yesterday", "Bob", "c"),
+	])
+	assert encoded.split("\n")[1:] == [
+		"== 2025-01-27 ==",
+		"23:59 Bob: a b",
+		"== 2025-01-28 ==",
+		"00:01 Bob the builder: first",
+		"  second line",
+		"yesterday Bob: c",
+	]
+
+def test_is_channel_messages():
+	assert is_channel_messages([message("2025-01-27 09:12", "Bob", "hi")])
+	assert not is_channel_messages([])
+	assert not is_channel_messages([{"createdAt": "x", "userName": "Bob"}])
+	assert not is_channel_messages({"createdAt": "x", "userName": "Bob", "text": "hi"})
+
+def test_encoder_remembers_contents_and_counts_the_saving():
+	counted = []
+	encoder = ToolResultEncoder("compact", lambda text: counted.append(text) or len(text))
+	content = json.dumps([message("2025-01-27 09:12", "Bob", "hi")] * 3)
+	first = encoder.encode(content)
+	assert encoder.encode(content) == first
+	# measured once per distinct content
+	assert len(counted) == 2
+	stats = encoder.stats()
+	assert stats["encoded"] == 2 and stats["entries"] == 1
+	assert stats["tokens_before"] > stats["tokens_after"] > 0
+
+def test_encoder_leaves_other_results_alone():
+	encoder = ToolResultEncoder("compact", len)
+	assert encoder.encode('[{"id": 1}]') is None
+	assert encoder.encode("not json") is None
+	assert ToolResultEncoder("json", len).encode(json.dumps([message("2025-01-27 09:12", "Bob", "hi")])) is None
+	with pytest.raises(ValueError):
+		ToolResultEncoder("yaml", len)
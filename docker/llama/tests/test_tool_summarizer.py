@@ -0,0 +1,99 @@
+import json
+from tool_summarizer import ToolSummarizer
+
+# one token per character
+def tokenize(messages, tools):
+	tokens = []
+	boundaries = []
+	for message in messages:
+		tokens.extend([0] * len(message["content"]))
+		boundaries.append(len(tokens))
+	return tokens, boundaries
+
+class Model:
+	def __init__(self):
+		self.prompts = []
+
+	# the "summary" of a chunk is the start of its first line
+	def start(self, messages):
+		self.prompts.append(messages)
+		chunk = messages[1]["content"].split("\n\n")[1]
+		return iter(chunk[:6].encode("utf-8"))
+
+	def detokenize(self, tokens):
+		return bytes(tokens).decode("utf-8")
+
+def apply(summarizer: ToolSummarizer, messages, model: Model, progress=None):
+	return summarizer.apply(
+		messages, None, tokenize, len, model.start, model.detokenize,
+		progress or (lambda done, total: None), lambda: False,
+	)
+
+def test_chunks_split_at_line_ends():
+	summarizer = ToolSummarizer(threshold=100, chunk_tokens=10, summary_tokens=8, batched=False)
+	# a line costs its length plus the newline
+	assert summarizer._chunks("aaaa\nbbbb\ncccc", len) == ["aaaa\nbbbb", "cccc"]
+
+def test_long_lines_are_cut_by_characters():
+	summarizer = ToolSummarizer(threshold=100, chunk_tokens=10, summary_tokens=8, batched=False)
+	chunks = summarizer._chunks("x" * 25 + "\nend", len)
+	assert all(len(chunk) <= 10 for chunk in chunks)
+	assert "".join(chunks).replace("\n", "") == "x" * 25 + "end"
+
+def test_oversized_tool_output_of_the_current_turn_is_summarized():
+	summarizer = ToolSummarizer(threshold=100, chunk_tokens=45, summary_tokens=8, batched=False)
+	output = "\n".join(f"line {i}".ljust(40, ".") for i in range(4))
+	messages = [
+		{"role": "system", "content": "sys"},
+		{"role": "user", "content": "what happened?"},
+		{"role": "tool", "content": output},
+	]
+	progress = []
+	model = Model()
+	summarized, actions = apply(summarizer, messages, model, lambda done, total: progress.append((done, total)))
+	assert messages[2]["content"] == output
+	summary = json.loads(summarized[2]["content"])[0]
+	assert summary["summary"].split("\n\n") == [f"Part {i + 1} of 4:\nline {i}" for i in range(4)]
+	assert actions == [{"action": "summarize_tool_output", "messages": 1, "chunks": 4, "tokens": len(output) - len(summarized[2]["content"])}]
+	assert progress == [(1, 4), (2, 4), (3, 4), (4, 4)]
+	# every chunk prompt carries the question
+	assert all("what happened?" in prompt[1]["content"] for prompt in model.prompts)
+
+def test_summaries_are_remembered():
+	summarizer = ToolSummarizer(threshold=70, chunk_tokens=40, summary_tokens=8, batched=True)
+	messages = [
+		{"role": "system", "content": "sys"},
+		{"role": "user", "content": "q"},
+		{"role": "tool", "content": "\n".join(["y" * 30] * 3)},
+	]
+	model = Model()
+	first, _ = apply(summarizer, messages, model)
+	second, _ = apply(summarizer, messages, model)
+	assert first == second
+	assert len(model.prompts) == 3
+	assert summarizer.stats()["hits"] == 1
+
+def test_small_and_older_tool_outputs_are_left_alone():
+	summarizer = ToolSummarizer(threshold=50, chunk_tokens=40, summary_tokens=8, batched=False)
+	messages = [
+		{"role": "system", "content": "sys"},
+		{"role": "user", "content": "q"},
+		{"role": "tool", "content": "z" * 200},
+		{"role": "user", "content": "and now?"},
+		{"role": "tool", "content": "small"},
+	]
+	assert apply(summarizer, messages, Model()) == (messages, [])
+
+def test_summaries_above_threshold_are_summarized_again():
+	summarizer = ToolSummarizer(threshold=30, chunk_tokens=25, summary_tokens=8, batched=False, max_rounds=2)
+	messages = [
+		{"role": "system", "content": "sys"},
+		{"role": "user", "content": "q"},
+		{"role": "tool", "content": "\n".join(["w" * 20] * 4)},
+	]
+	model = Model()
+	summarized, actions = apply(summarizer, messages, model)
+	# four chunks, then the joined summaries of the first round
+	assert len(model.prompts) > 4
+	assert all(prompt[1]["content"].startswith("Part 1 of") for prompt in (model.prompts[0], model.prompts[4]))
+	assert actions[0]["chunks"] == 4